@@ -0,0 +1,533 @@
+"""
+Channel list handling for the Virgin Tivo boxes
+
+Kept free of Home Assistant imports so the tools in /resources can use it.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+from html.parser import HTMLParser
+from types import MappingProxyType
+
+_LOGGER = logging.getLogger(__name__)
+
+LINEUP_CACHE_FILE = 'virgin_tivo_lineup.json'
+LINEUP_CACHE_VERSION = 1
+LINEUP_FILE_VERSION = 1
+CHANNEL_TABLE_CLASS = 'wikitable sortable'
+
+# Cell positions in the tvchannellists.com TV and radio tables
+TV_CELLS = {'hd': 0, 'sd': 1, 'plus_one': 2, 'name': 3, 'package_hd': 9, 'package_sd': 10}
+RADIO_CELLS = {'hd': 0, 'sd': 0, 'plus_one': 0, 'name': 1, 'package_hd': 7, 'package_sd': 7}
+
+
+class ChannelListing:
+    __slots__ = ('channel_id', 'channel_name', 'package', 'is_hd', 'is_plus_one', 'base_name', 'show', 'hd_ver',
+                 'plus_one_ver', 'logo', 'target', 'source')
+
+    def __init__(self, channel_id, channel_name, package, is_hd, is_plus_one = False, base_name = ""):
+        self.channel_id = channel_id
+        self.channel_name = channel_name
+        self.package = package
+        self.is_hd = is_hd
+        self.is_plus_one = is_plus_one
+        self.base_name = base_name
+        self.show = ""
+        self.hd_ver = ""
+        self.plus_one_ver = ""
+        self.logo = ""
+        self.target = ""
+        self.source = ""
+
+
+def pair_channels(all_channels):
+    """Link each channel to the HD and +1 versions sharing its base name
+
+    Works on anything with channel_id keys and is_hd, is_plus_one, base_name,
+    hd_ver and plus_one_ver attributes.  The first HD or +1 channel found for
+    a base name wins.
+    """
+    hd_versions = {}
+    plus_one_versions = {}
+    for channel_id, channel in all_channels.items():
+        if channel.is_hd:
+            hd_versions.setdefault(channel.base_name, channel_id)
+        if channel.is_plus_one:
+            plus_one_versions.setdefault(channel.base_name, channel_id)
+
+    for channel in all_channels.values():
+        if not channel.is_plus_one:
+            if not channel.is_hd and channel.base_name in hd_versions:
+                channel.hd_ver = hd_versions[channel.base_name]
+            if channel.base_name in plus_one_versions:
+                channel.plus_one_ver = plus_one_versions[channel.base_name]
+
+
+class ChannelTableParser(HTMLParser):
+    """Streaming extractor for the channel tables on a tvchannellists.com page.
+
+    Feed the page in pieces of any size and take the finished tables from
+    tables.  Each is (first header text, rows) where a row is a list of its
+    <td> cells and a cell is the list of text pieces in it.  Anything outside
+    the channel tables is skipped as it is read.
+    """
+
+    def __init__(self, table_class=CHANNEL_TABLE_CLASS):
+        """Initialize the parser for tables with the given class."""
+        super().__init__(convert_charrefs=True)
+        self.table_class = table_class
+        self.tables = []
+        self._depth = 0
+        self._header = None
+        self._header_text = None
+        self._rows = None
+        self._row = None
+        self._cell = None
+        self._after_tag = True
+
+    def handle_starttag(self, tag, attrs):
+        self._after_tag = True
+        if tag == 'table':
+            if self._depth:
+                self._depth += 1
+            elif dict(attrs).get('class') == self.table_class:
+                self._depth = 1
+                self._header = None
+                self._rows = []
+        elif not self._depth:
+            return
+        elif tag == 'tr':
+            self._row = []
+            self._rows.append(self._row)
+        elif tag == 'td' and self._row is not None:
+            self._cell = []
+            self._row.append(self._cell)
+        elif tag == 'th' and self._header is None and self._header_text is None:
+            self._header_text = []
+
+    def handle_endtag(self, tag):
+        self._after_tag = True
+        if not self._depth:
+            return
+        if tag == 'td':
+            self._cell = None
+        elif tag == 'th' and self._header_text is not None:
+            self._header = "".join(self._header_text)
+            self._header_text = None
+        elif tag == 'tr':
+            self._row = None
+            self._cell = None
+        elif tag == 'table':
+            self._depth -= 1
+            if not self._depth:
+                self.tables.append((self._header, self._rows))
+                self._rows = None
+                self._row = None
+                self._cell = None
+
+    def handle_data(self, data):
+        # Text between two tags can arrive in more than one piece
+        if self._cell is not None:
+            if self._cell and not self._after_tag:
+                self._cell[-1] += data
+            else:
+                self._cell.append(data)
+        if self._header_text is not None:
+            self._header_text.append(data)
+        self._after_tag = False
+
+
+def first_text(cell):
+    """First piece of text in a cell, stripped"""
+    return cell[0].strip() if cell else ""
+
+
+def add_html_channels(text, all_channels, ignore_channels):
+    """Add the channels from the tables on a tvchannellists.com page
+
+    Channels in the ignore_channels set are skipped, and each channel added
+    is put in the set.  Returns True if any channel rows were found.
+    """
+    parser = ChannelTableParser()
+    parser.feed(text)
+    parser.close()
+
+    parsed = False
+    for header, rows in parser.tables:
+        header = (header or "").strip()
+        if header == "HD":
+            is_tv_table = True
+            cell_no = TV_CELLS
+        elif header == "SD":
+            is_tv_table = False
+            cell_no = RADIO_CELLS
+        else:
+            _LOGGER.debug("Ignoring unknown table found in channel lists")
+            break
+
+        # The first row is the header, and rows continuing a channel from the row above are short
+        for row in rows[1:]:
+            if len(row) < 6 or not row[cell_no['name']]:
+                continue
+            channel_name = "".join(row[cell_no['name']]).lstrip().split('\n')[0]
+            channel_name = re.sub(' e$', '', channel_name)
+            channel_name = "'{}'".format(channel_name) if "&" in channel_name else channel_name
+            package = first_text(row[cell_no['package_hd']])
+            if not package:
+                package = first_text(row[cell_no['package_sd']])
+            parsed = True
+
+            versions = [(row[cell_no['sd']], channel_name, False, False),
+                        (row[cell_no['plus_one']], channel_name + " +1", False, True)]
+            if is_tv_table:
+                versions.insert(0, (row[cell_no['hd']], channel_name + " HD", True, False))
+            for cell, name, is_hd, is_plus_one in versions:
+                channel_id = first_text(cell)
+                if channel_id and channel_id not in ignore_channels:
+                    ignore_channels.add(channel_id)
+                    all_channels[channel_id] = ChannelListing(channel_id, name, package, is_hd=is_hd,
+                                                              is_plus_one=is_plus_one, base_name=channel_name)
+    return parsed
+
+
+def base_name(name):
+    """Channel name without HD, +1 or ja vu"""
+    return str(name).replace(" +1", "").replace(" ja vu", "").replace(" HD", "")
+
+
+def add_override_channels(overrides, all_channels, ignore_channels):
+    """Add channels set by hand, {channel id: (name, package, is HD)}
+
+    Each channel is put in the ignore_channels set so the channel list
+    doesn't replace it.
+    """
+    for channel_id, (channel_name, package, is_hd) in overrides.items():
+        str_channel_id = str(channel_id)
+        channel_name = channel_name.strip()
+        channel_name = "'{}'".format(channel_name) if "&" in channel_name else channel_name
+        ignore_channels.add(str_channel_id)
+        all_channels[str_channel_id] = ChannelListing(str_channel_id, channel_name, package.strip(), is_hd,
+                                                      "+1" in channel_name or "ja vu" in channel_name,
+                                                      base_name(channel_name))
+
+
+def add_csv_channels(text, all_channels, ignore_channels, region):
+    """Add the channels from a CSV channel list with ID,Name,Package columns
+
+    Channels numbered for a region, e.g. 862E, are only added for that
+    region.  Returns True if any channel rows were found.
+    """
+    parsed = False
+    for row in text.splitlines():
+        items = row.split(',')
+        if items[0] == "ID" or len(items) < 3:
+            continue
+        str_channel_id = items[0]
+        match = re.match(r'\d+', str_channel_id)
+        if match is None:
+            continue
+        channel_no = match[0]
+        if channel_no != str_channel_id:
+            channel_region = str_channel_id[len(channel_no):]
+            if region not in channel_region:
+                continue
+        channel_name = items[1]
+        package = items[2]
+        parsed = True
+        if channel_no not in all_channels and channel_no not in ignore_channels:
+            all_channels[channel_no] = ChannelListing(channel_no, channel_name, package, "HD" in channel_name,
+                                                      "+1" in channel_name, base_name(channel_name))
+    return parsed
+
+
+def set_channel_options(all_channels, show_channels=(), hide_channels=(), logos=None, targets=None, sources=None):
+    """Apply the per channel settings, channel ids can be strings or ints"""
+    for channel_id in show_channels:
+        if str(channel_id) in all_channels:
+            all_channels[str(channel_id)].show = "true"
+
+    for channel_id in hide_channels:
+        if str(channel_id) in all_channels:
+            all_channels[str(channel_id)].show = "false"
+
+    for channel_id, logo_url in (logos or {}).items():
+        if str(channel_id) in all_channels:
+            all_channels[str(channel_id)].logo = logo_url
+
+    for channel_id, source_name in (sources or {}).items():
+        if str(channel_id) in all_channels:
+            all_channels[str(channel_id)].source = source_name
+
+    for channel_id, target_name in (targets or {}).items():
+        if str(channel_id) in all_channels:
+            all_channels[str(channel_id)].target = target_name
+
+
+def to_channel_listings(all_channels):
+    """The channels as {channel number: settings}, in the form of the channels configuration"""
+    channel_listings = {}
+    for channel_id, channel in sorted(all_channels.items()):
+        try:
+            channel_no = int(channel_id)
+        except ValueError:
+            _LOGGER.debug("unexpected channel_id: %s (%s)", channel_id, channel.channel_name)
+            continue
+        channel_listings[channel_no] = {
+            'name': channel.channel_name,
+            'logo': channel.logo,
+            'hd_channel': int(channel.hd_ver) if channel.hd_ver != "" else 0,
+            'plus_one': int(channel.plus_one_ver) if channel.plus_one_ver != "" else 0,
+            'show': channel.show if channel.show != "" else "UNSET",
+            'target': channel.target,
+            'source': channel.source,
+            'package': channel.package if channel.package != "" else "UNSET",
+        }
+    return channel_listings
+
+
+def full_base_name(name):
+    """Channel name without HD or +1"""
+    return name.replace(' HD', '').replace(' +1', '')
+
+
+class ChannelGraph:
+    """Read-only index of how SD, HD and +1 channels relate to each other.
+
+    Built once from the channel list and shared by all Tivo boxes so lookups
+    don't need to scan every channel.
+    """
+
+    def __init__(self, names, hd_channels, plus_one_channels):
+        """Build from {id: name}, {sd id: hd id} and {id: plus one id}."""
+        hd_sources = {}
+        for channel_id, hd_id in hd_channels.items():
+            hd_sources.setdefault(hd_id, []).append(channel_id)
+        plus_one_sources = {}
+        for channel_id, plus_one_id in plus_one_channels.items():
+            plus_one_sources.setdefault(plus_one_id, []).append(channel_id)
+        groups = {}
+        for channel_id, name in names.items():
+            groups.setdefault(full_base_name(name), set()).add(channel_id)
+
+        # Where both the SD and HD versions list the same +1 channel, use the SD one
+        sd_channels = {}
+        for channel_id, sources in plus_one_sources.items():
+            sd_channels[channel_id] = next((source for source in sources if source not in hd_sources), sources[0])
+        for channel_id, sources in hd_sources.items():
+            sd_channel = sources[0]
+            sd_channels[channel_id] = sd_channels.get(sd_channel, sd_channel)
+
+        self._names = MappingProxyType(dict(names))
+        self._hd_sources = MappingProxyType({k: tuple(v) for k, v in hd_sources.items()})
+        self._plus_one_sources = MappingProxyType({k: tuple(v) for k, v in plus_one_sources.items()})
+        self._sd_channels = MappingProxyType(sd_channels)
+        self._groups = MappingProxyType({k: frozenset(v) for k, v in groups.items()})
+
+    def __contains__(self, channel_id):
+        return channel_id in self._names
+
+    def is_hd(self, channel_id):
+        """Check if channel is the HD version of another channel"""
+        return channel_id in self._hd_sources
+
+    def is_plus_one(self, channel_id):
+        """Check if channel is the +1 version of another channel"""
+        return channel_id in self._plus_one_sources
+
+    def sd_channel(self, channel_id):
+        """Get the SD, non +1 version of a channel"""
+        return self._sd_channels.get(channel_id, channel_id)
+
+    def related_channels(self, channel_id):
+        """Get the channel along with its HD and +1 versions"""
+        related_channels = {channel_id}
+        related_channels.update(self._hd_sources.get(channel_id, ()))
+        related_channels.update(self._plus_one_sources.get(channel_id, ()))
+        if channel_id in self._names:
+            base_channel_name = self._names[channel_id].replace(' HD', '')
+            related_channels.update(self._groups.get(base_channel_name, ()))
+        return related_channels
+
+
+class Lineup:
+    """The resolved channels and the lookups built from them, shared read-only by all the Tivo boxes.
+
+    channels is {channel id: settings} with name, hd_channel, plus_one, show,
+    target and source.  When the channel list changes, updated() only
+    indexes the channels that differ, and keeps the graph and source list
+    if the changes don't affect them.
+    """
+
+    # Settings each lookup depends on
+    GRAPH_KEYS = ('name', 'hd_channel', 'plus_one')
+    SOURCE_LIST_KEYS = ('name', 'show')
+
+    def __init__(self, channels, graph=None, indexes=None):
+        """Index the channels, graph and indexes are reused from a previous lineup by updated()."""
+        self.channels = MappingProxyType(dict(channels))
+        if indexes is None:
+            indexes = ({k: v['name'] for k, v in channels.items()},
+                       {v['name']: k for k, v in channels.items()},
+                       {k: v['target'] for k, v in channels.items() if v['target'] != ""},
+                       {k: v['source'] for k, v in channels.items() if v['target'] != ""})
+        id_name, name_id, target_ids, sources = indexes
+        self.id_name = MappingProxyType(id_name)
+        self.name_id = MappingProxyType(name_id)
+        self.target_ids = MappingProxyType(target_ids)
+        self.sources = MappingProxyType(sources)
+        self.graph = graph if graph is not None else self._build_graph(channels)
+        self._source_list = None
+
+    def __len__(self):
+        return len(self.channels)
+
+    @property
+    def source_list(self):
+        """Names of the channels to show, in channel number order"""
+        if self._source_list is None:
+            enabled = {v['name']: k for k, v in self.channels.items() if v['show']}
+            self._source_list = tuple(sorted(enabled, key=enabled.get))
+        return self._source_list
+
+    def updated(self, channels):
+        """Return the lineup for a new set of channels, or this one if nothing has changed"""
+        changed = [channel_id for channel_id in self.channels.keys() | channels.keys()
+                   if self.channels.get(channel_id) != channels.get(channel_id)]
+        if not changed:
+            return self
+
+        id_name = dict(self.id_name)
+        name_id = dict(self.name_id)
+        target_ids = dict(self.target_ids)
+        sources = dict(self.sources)
+        renamed = set()
+        for channel_id in changed:
+            old = self.channels.get(channel_id)
+            new = channels.get(channel_id)
+            for channel in (old, new):
+                if channel is not None:
+                    renamed.add(channel['name'])
+            id_name.pop(channel_id, None)
+            target_ids.pop(channel_id, None)
+            sources.pop(channel_id, None)
+            if new is not None:
+                id_name[channel_id] = new['name']
+                if new['target'] != "":
+                    target_ids[channel_id] = new['target']
+                    sources[channel_id] = new['source']
+
+        # Where channels share a name the last one wins, as when built from scratch
+        for name in renamed:
+            name_id.pop(name, None)
+        for channel_id, channel in channels.items():
+            if channel['name'] in renamed:
+                name_id[channel['name']] = channel_id
+
+        graph = self.graph if self._unchanged(changed, channels, self.GRAPH_KEYS) else None
+        lineup = Lineup(channels, graph, (id_name, name_id, target_ids, sources))
+        if self._unchanged(changed, channels, self.SOURCE_LIST_KEYS):
+            lineup._source_list = self._source_list
+        return lineup
+
+    def _unchanged(self, changed, channels, keys):
+        """Check the changed channels all existed before and still have the same settings for keys"""
+        for channel_id in changed:
+            old = self.channels.get(channel_id)
+            new = channels.get(channel_id)
+            if old is None or new is None or any(old[key] != new[key] for key in keys):
+                return False
+        return True
+
+    @staticmethod
+    def _build_graph(channels):
+        return ChannelGraph({k: v['name'] for k, v in channels.items()},
+                            {k: v['hd_channel'] for k, v in channels.items() if v['hd_channel']},
+                            {k: v['plus_one'] for k, v in channels.items() if v['plus_one']})
+
+
+def content_hash(text):
+    """Hash identifying a channel list or configuration"""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class LineupCache:
+    """The resolved channels saved as JSON, so an unchanged channel list isn't parsed again.
+
+    The file records hashes of the channel list it was built from and the
+    settings used, and is ignored when either differs.  Every method blocks,
+    so call them from the executor.
+    """
+
+    def __init__(self, path):
+        """Initialize the cache, the file is created when first saved."""
+        self.path = path
+
+    def load(self, settings_hash, source_hash=None):
+        """Return the saved channels if built with the same settings and source, or None
+
+        With no source_hash, e.g. when the channel list can't be downloaded,
+        channels built from any source are returned.
+        """
+        try:
+            with open(self.path) as cache_file:
+                saved = json.load(cache_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            _LOGGER.warning("Channel cache %s is unreadable, ignoring it [%s]", self.path, str(e))
+            return None
+
+        try:
+            if saved["version"] != LINEUP_CACHE_VERSION:
+                _LOGGER.debug("Ignoring channel cache from version %s", saved["version"])
+                return None
+            if saved["settings"] != settings_hash or source_hash not in (None, saved["source"]):
+                _LOGGER.debug("Channel list or settings have changed since the channel cache was saved")
+                return None
+            return {int(channel_id): channel for channel_id, channel in saved["channels"].items()}
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            _LOGGER.warning("Channel cache %s is corrupt, ignoring it [%s]", self.path, str(e))
+            return None
+
+    def save(self, settings_hash, source_hash, channels):
+        """Replace the saved channels"""
+        saved = {
+            "version": LINEUP_CACHE_VERSION,
+            "settings": settings_hash,
+            "source": source_hash,
+            "channels": channels,
+        }
+        temp_file = self.path + '.tmp'
+        try:
+            with open(temp_file, 'w') as cache_file:
+                json.dump(saved, cache_file)
+            os.replace(temp_file, self.path)
+        except (OSError, TypeError, ValueError) as e:
+            _LOGGER.warning("Could not save channel cache %s [%s]", self.path, str(e))
+
+
+def write_lineup_file(path, channel_listings, source_hash=None):
+    """Save channel listings compiled by resources/virginchannels.py, raises OSError on failure"""
+    saved = {
+        "version": LINEUP_FILE_VERSION,
+        "source": source_hash,
+        "channels": channel_listings,
+    }
+    temp_file = path + '.tmp'
+    with open(temp_file, 'w') as lineup_file:
+        json.dump(saved, lineup_file, separators=(',', ':'))
+    os.replace(temp_file, path)
+
+
+def read_lineup_file(path):
+    """Load compiled channel listings, raises OSError or ValueError if they can't be used"""
+    with open(path) as lineup_file:
+        saved = json.load(lineup_file)
+    try:
+        if saved["version"] != LINEUP_FILE_VERSION:
+            raise ValueError("unsupported version {}".format(saved["version"]))
+        return {int(channel_id): channel for channel_id, channel in saved["channels"].items()}
+    except (KeyError, TypeError, AttributeError) as e:
+        raise ValueError("missing {}".format(str(e)))
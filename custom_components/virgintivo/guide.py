@@ -0,0 +1,524 @@
+"""
+Programme guide handling for the Virgin Tivo boxes
+
+Each station's listings are kept sorted by start time alongside arrays of
+start and end timestamps, so the current programme is found with a bisect.
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import time
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from .metrics import Timing
+
+_LOGGER = logging.getLogger(__name__)
+
+GUIDE_HOST = 'web-api-pepper.horizon.tv'
+GUIDE_PATH = 'oesp/api/GB/eng/web/'
+GUIDE_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 '
+                               'Safari/537.36'}
+
+DEFAULT_CACHE_MB = 5
+PROGRAMME_BYTES = 512       # rough memory used by one cached programme, see resources/benchmark.py
+
+GUIDE_STORE_FILE = 'virgin_tivo_guide.db'
+GUIDE_STORE_VERSION = 2
+CHANNELS_MAX_AGE = 24 * 3600
+PREFETCH_CONCURRENCY = 4
+PREFETCH_INTERVAL = timedelta(minutes=15)
+PLUS_ONE_OFFSET = 3600
+
+GUIDE_STORE_SCHEMA = """
+DROP TABLE IF EXISTS channels;
+DROP TABLE IF EXISTS listings;
+DROP TABLE IF EXISTS programmes;
+CREATE TABLE channels (channel_number INTEGER PRIMARY KEY, station_id TEXT, title TEXT, url TEXT, logo TEXT,
+                       saved REAL);
+CREATE TABLE listings (station_id TEXT PRIMARY KEY, next_refresh REAL);
+CREATE TABLE programmes (station_id TEXT, start_time REAL, end_time REAL, title TEXT, description TEXT,
+                         prog_type TEXT, episode_title TEXT, episode_number TEXT, series_number TEXT);
+CREATE INDEX programmes_station ON programmes (station_id, start_time);
+PRAGMA user_version = {};
+""".format(GUIDE_STORE_VERSION)
+
+
+class Programme:
+    """One programme in a channel's listings, with start and end in epoch seconds.
+
+    Listings can hold thousands of these, so they have slots rather than a
+    dict and the datetimes are only created when asked for.
+    """
+
+    __slots__ = ('start', 'end', 'title', 'description', 'id', 'prog_type', 'prog_episode_title',
+                 'prog_episode_number', 'prog_series_number')
+
+    def __init__(self, start, end, title, description, station_id, prog_type, episode_title=None,
+                 episode_number=None, series_number=None):
+        """Initialize the programme, repeated strings are shared."""
+        self.start = start
+        self.end = end
+        self.title = sys.intern(title)
+        self.description = description
+        self.id = sys.intern(station_id)
+        self.prog_type = sys.intern(prog_type)
+        self.prog_episode_title = episode_title
+        self.prog_episode_number = episode_number
+        self.prog_series_number = series_number
+
+    @property
+    def start_time(self):
+        return datetime.fromtimestamp(self.start)
+
+    @property
+    def end_time(self):
+        return datetime.fromtimestamp(self.end)
+
+    @property
+    def duration(self):
+        return timedelta(seconds=self.end - self.start)
+
+    def shifted(self, offset):
+        """Copy of the programme shown offset seconds later"""
+        return Programme(self.start + offset, self.end + offset, self.title, self.description, self.id,
+                         self.prog_type, self.prog_episode_title, self.prog_episode_number, self.prog_series_number)
+
+
+class GuideStation:
+    """A station in the guide, shared by every channel showing it."""
+
+    __slots__ = ('channel_number', 'id', 'title', 'url', 'logo')
+
+    def __init__(self, channel_number, station_id, title, url, logo):
+        """Initialize the station listed under channel_number in the guide."""
+        self.channel_number = channel_number
+        self.id = station_id
+        self.title = title
+        self.url = url
+        self.logo = logo
+
+
+class GuideChannel:
+    """A channel showing a guide station, possibly in HD or an hour later.
+
+    Only what differs from the station is kept here, so the HD and +1
+    versions of a channel don't need their own copy of it.
+    """
+
+    __slots__ = ('channel_number', 'station', 'hd', 'plus_one')
+
+    def __init__(self, channel_number, station, hd=False, plus_one=False):
+        """Initialize the channel."""
+        self.channel_number = channel_number
+        self.station = station
+        self.hd = hd
+        self.plus_one = plus_one
+
+    @property
+    def id(self):
+        return self.station.id
+
+    @property
+    def title(self):
+        return self.station.title + (" HD" if self.hd else "") + (" +1" if self.plus_one else "")
+
+    @property
+    def url(self):
+        # There is no stream grab an hour behind
+        return None if self.plus_one else self.station.url
+
+    @property
+    def logo(self):
+        return self.station.logo
+
+    @property
+    def offset(self):
+        """Seconds the channel's programmes are shown after the station's"""
+        return PLUS_ONE_OFFSET if self.plus_one else 0
+
+
+def new_channel_listings():
+    """Empty listings for a channel"""
+    return {
+        "next_refresh": 0,
+        "listings": [],
+        "start_times": array('d'),
+        "end_times": array('d'),
+    }
+
+
+def find_listing(channel_listings, timestamp, offset=0):
+    """Find the programme showing at a timestamp on a channel offset seconds behind the listings
+
+    Returns (listing, valid_from, valid_until) where listing is None if
+    nothing is showing, and the answer holds between the two times.
+    """
+    start_times = channel_listings["start_times"]
+    end_times = channel_listings["end_times"]
+    timestamp -= offset
+    index = bisect_right(start_times, timestamp) - 1
+    if index >= 0 and timestamp < end_times[index]:
+        listing = channel_listings["listings"][index]
+        return listing.shifted(offset) if offset else listing, start_times[index] + offset, end_times[index] + offset
+
+    valid_from = end_times[index] + offset if index >= 0 else float('-inf')
+    valid_until = start_times[index + 1] + offset if index + 1 < len(start_times) else float('inf')
+    return None, valid_from, valid_until
+
+
+def guide_channels_url():
+    return 'https://{0}/{1}/channels'.format(GUIDE_HOST, GUIDE_PATH)
+
+
+def channel_listings_url(station_id, cache_hours):
+    # Start far enough back to include what is showing on the +1 channel
+    start_time = int(time.time() - PLUS_ONE_OFFSET) * 1000
+    end_time = start_time + (3600 * cache_hours * 1000)
+    return "https://{0}/{1}/listings?byStationId={2}&byEndTime={3}~{4}&sort=startTime"\
+        .format(GUIDE_HOST, GUIDE_PATH, station_id, start_time, end_time)
+
+
+def add_guide_channel(guide_channels, channel, graph):
+    """Add a channel from the channels document, along with its related channels, and return its station"""
+    ch_number = channel["channelNumber"]
+    _LOGGER.debug("New channel [%s]", ch_number)
+    station_info = channel["stationSchedules"][0]["station"]
+    urls = station_info["images"]
+    station = GuideStation(
+        ch_number,
+        station_info["id"],
+        station_info["title"],
+        next(iter([a["url"] for a in urls
+                   if "url" in a and "assetType" in a and a["assetType"] == "imageStream"]), None),
+        next(iter([a["url"] for a in urls
+                   if "url" in a and "assetType" in a and a["assetType"] == "station-logo-large"]), None),
+    )
+    link_guide_station(guide_channels, station, graph)
+    return station
+
+
+def link_guide_station(guide_channels, station, graph):
+    """Add the channel for a station and point its related channels at the same station"""
+    ch_number = station.channel_number
+    guide_channels[ch_number] = GuideChannel(ch_number, station)
+    if ch_number in graph:
+        related_channels = graph.related_channels(ch_number)
+        _LOGGER.debug("Related channels: %s", related_channels)
+        for related_channel in related_channels:
+            if related_channel != ch_number:
+                guide_channels[related_channel] = GuideChannel(related_channel, station, graph.is_hd(related_channel),
+                                                               graph.is_plus_one(related_channel))
+                _LOGGER.debug("Linked channel [%d] to channel [%d]", related_channel, ch_number)
+
+
+def add_listing(prog_channel, listing, station_id):
+    """Add a programme from a listings document"""
+    start_time = listing["startTime"] / 1000
+    end_time = listing["endTime"] / 1000
+    prog_start_time = datetime.fromtimestamp(start_time)
+    program = listing["program"]
+    prog_title = program["title"]
+    if "description" in program:
+        prog_description = program["description"]
+    elif "longDescription" in program:
+        prog_description = program["longDescription"]
+    else:
+        prog_description = ""
+    if "seriesEpisodeNumber" in program and "seriesNumber" in program:
+        prog_episode_number = program["seriesEpisodeNumber"]
+        prog_series_number = program["seriesNumber"]
+    else:
+        prog_episode_number = None
+        prog_series_number = None
+    if "secondaryTitle" in program:
+        prog_episode_title = program["secondaryTitle"]
+    else:
+        prog_episode_title = None
+
+    if prog_channel["next_refresh"] < prog_start_time:
+        prog_channel["next_refresh"] = prog_start_time
+    _LOGGER.debug("Added [%s] [%s] to station [%s]", prog_title, prog_start_time, station_id)
+    prog_channel["listings"].append(Programme(start_time, end_time, prog_title, prog_description,
+                                              listing["stationId"], program["medium"], prog_episode_title,
+                                              prog_episode_number, prog_series_number))
+    prog_channel["start_times"].append(start_time)
+    prog_channel["end_times"].append(end_time)
+
+
+class GuideStore:
+    """Guide channels and listings saved in SQLite so a restart doesn't download everything again.
+
+    Every method blocks, so call them from the executor.
+    """
+
+    def __init__(self, path):
+        """Initialize the store, the file is created when first written."""
+        self.path = path
+
+    def load_stations(self):
+        """Return the saved guide stations and when they were saved"""
+        rows = self._run(lambda conn: conn.execute(
+            "SELECT channel_number, station_id, title, url, logo, saved FROM channels ORDER BY rowid").fetchall())
+        if not rows:
+            return [], None
+        return [GuideStation(*row[:5]) for row in rows], min(row[5] for row in rows)
+
+    def save_stations(self, stations):
+        """Replace the saved guide stations"""
+        saved = time.time()
+
+        def save(conn):
+            conn.execute("DELETE FROM channels")
+            conn.executemany("INSERT INTO channels VALUES (?, ?, ?, ?, ?, ?)",
+                             [(st.channel_number, st.id, st.title, st.url, st.logo, saved) for st in stations])
+        self._run(save)
+
+    def load_listings(self, station_id):
+        """Return the saved listings for a station that haven't finished yet, or None"""
+        def load(conn):
+            row = conn.execute("SELECT next_refresh FROM listings WHERE station_id = ?", (station_id,)).fetchone()
+            if row is None:
+                return None
+            programmes = conn.execute(
+                "SELECT start_time, end_time, title, description, station_id, prog_type, episode_title, "
+                "episode_number, series_number FROM programmes WHERE station_id = ? AND end_time > ? "
+                "ORDER BY start_time", (station_id, time.time() - PLUS_ONE_OFFSET)).fetchall()
+            return row[0], programmes
+
+        result = self._run(load)
+        if result is None:
+            return None
+        next_refresh, programmes = result
+        prog_channel = new_channel_listings()
+        prog_channel["next_refresh"] = datetime.fromtimestamp(next_refresh)
+        for row in programmes:
+            prog = Programme(*row)
+            prog_channel["listings"].append(prog)
+            prog_channel["start_times"].append(prog.start)
+            prog_channel["end_times"].append(prog.end)
+        return prog_channel
+
+    def save_listings(self, station_id, prog_channel):
+        """Replace the saved listings for a station"""
+        rows = [(station_id, prog.start, prog.end, prog.title, prog.description, prog.prog_type,
+                 prog.prog_episode_title, prog.prog_episode_number, prog.prog_series_number)
+                for prog in prog_channel["listings"]]
+
+        def save(conn):
+            conn.execute("INSERT OR REPLACE INTO listings VALUES (?, ?)",
+                         (station_id, prog_channel["next_refresh"].timestamp()))
+            conn.execute("DELETE FROM programmes WHERE station_id = ? OR end_time <= ?",
+                         (station_id, time.time() - PLUS_ONE_OFFSET))
+            conn.executemany("INSERT INTO programmes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._run(save)
+
+    def _run(self, func):
+        """Run func with an open connection, starting a new file if the old one is unusable"""
+        try:
+            with closing(sqlite3.connect(self.path)) as conn:
+                with conn:
+                    if conn.execute("PRAGMA user_version").fetchone()[0] != GUIDE_STORE_VERSION:
+                        conn.executescript(GUIDE_STORE_SCHEMA)
+                    return func(conn)
+        except sqlite3.OperationalError as e:
+            _LOGGER.warning("Could not use guide cache %s [%s]", self.path, str(e))
+        except sqlite3.DatabaseError as e:
+            _LOGGER.warning("Guide cache %s is corrupt, starting a new one [%s]", self.path, str(e))
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        return None
+
+
+class Guide:
+    """Programme guide shared by all the Tivo boxes.
+
+    Listings are kept per station, so the SD, HD and +1 versions of a channel
+    share one download and +1 times are worked out when they are looked up.
+    Only one download per station runs at a time and any other box asking for
+    the same station waits for its result.  Listings are downloaded again once
+    their next_refresh time has passed, and the least recently used stations
+    are dropped when the cache grows past cache_mb.  With a store, anything
+    downloaded is saved and read back the first time it is needed after a
+    restart, and used as a fallback when the guide can't be downloaded.
+    """
+
+    def __init__(self, graph, cache_hours=12, picture_refresh=60, enable_guide=True, cache_mb=DEFAULT_CACHE_MB,
+                 store=None, client=None):
+        """Initialize an empty guide, downloading through an HttpClient."""
+        self.graph = graph
+        self.store = store
+        self.client = client
+        self.cache_hours = cache_hours
+        self.picture_refresh = picture_refresh
+        self.enable_guide = enable_guide
+        self.max_programmes = max(1, cache_mb * 1024 * 1024 // PROGRAMME_BYTES)
+        self.channels = {}
+        self.listings = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fetch_time = Timing()
+        self._programmes = 0
+        self._inflight = {}
+
+    def set_graph(self, graph):
+        """Use a new channel graph, the guide channels are linked again when next loaded"""
+        self.graph = graph
+        self.channels = {}
+
+    async def async_load_channels(self):
+        """Download the guide channels unless already loaded"""
+        if not self.channels:
+            self.channels = await self._async_single_flight('channels', self._async_load_channels)
+        else:
+            _LOGGER.debug("Guide already populated")
+        return self.channels
+
+    async def async_get_listings(self, channel_id):
+        """Return the listings for a channel's station, downloading them if missing or due a refresh
+
+        Use find_listing with the channel's offset to allow for +1 channels.
+        """
+        if channel_id not in self.channels:
+            return None
+        station_id = self.channels[channel_id].id
+        entry = self.listings.get(station_id)
+        if entry is not None and entry["next_refresh"] > datetime.now():
+            self.hits += 1
+            self.listings.move_to_end(station_id)
+            return entry
+
+        self.misses += 1
+        try:
+            entry = await self._async_single_flight(station_id, self._async_load_listings, station_id)
+        except Exception as e:
+            _LOGGER.warning("Error getting listings [%s]", e)
+            entry = new_channel_listings()
+            entry["next_refresh"] = datetime.now() + timedelta(minutes=1)
+            _LOGGER.warning("Resetting next_refresh to %s", entry["next_refresh"])
+        self._store(station_id, entry)
+        return entry
+
+    async def async_prefetch(self, channel_ids):
+        """Load the listings for a set of channels ahead of time
+
+        Stations that are still current are skipped and each station is only
+        downloaded once, with a few downloads running at once.
+        """
+        if not self.enable_guide:
+            return
+        try:
+            await self.async_load_channels()
+        except Exception as e:
+            _LOGGER.debug("Not prefetching guide, no guide channels [%s]", str(e))
+            return
+
+        semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+
+        async def prefetch(channel_id):
+            async with semaphore:
+                await self.async_get_listings(channel_id)
+
+        stations = {self.channels[channel_id].id: channel_id for channel_id in channel_ids
+                    if channel_id in self.channels}
+        start = time.time()
+        await asyncio.gather(*(prefetch(channel_id) for channel_id in stations.values()))
+        _LOGGER.debug("Prefetched guide for %d stations in %.1f seconds", len(stations), time.time() - start)
+
+    def diagnostics(self):
+        """Cache statistics"""
+        return {
+            "guide_channels": len(self.channels),
+            "cached_stations": len(self.listings),
+            "cached_programmes": self._programmes,
+            "max_programmes": self.max_programmes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else None,
+            "evictions": self.evictions,
+            "in_flight": len(self._inflight),
+            "fetch_time": self.fetch_time.as_dict(),
+        }
+
+    async def _async_load_channels(self):
+        """Get the guide channels from the store if recent enough, otherwise download them"""
+        loop = asyncio.get_running_loop()
+        stations, saved = await loop.run_in_executor(None, self.store.load_stations) if self.store else ([], None)
+        channels = {}
+        for station in stations:
+            link_guide_station(channels, station, self.graph)
+        if channels and saved + CHANNELS_MAX_AGE > time.time():
+            _LOGGER.debug("Using saved guide channels")
+            return channels
+        try:
+            _LOGGER.debug("Retrieving guide channels")
+            downloaded = {}
+            stations = []
+            async for channel in self.client.async_iter_items(guide_channels_url(), 'channels', GUIDE_HEADERS,
+                                                              conditional=True):
+                stations.append(add_guide_channel(downloaded, channel, self.graph))
+        except Exception as e:
+            if not channels:
+                raise
+            _LOGGER.warning("Error getting guide channel list [%s], using saved version", str(e))
+            return channels
+        if self.store:
+            await loop.run_in_executor(None, self.store.save_stations, stations)
+        return downloaded
+
+    async def _async_load_listings(self, station_id):
+        """Get the listings from the store if still current, otherwise download them"""
+        loop = asyncio.get_running_loop()
+        saved = await loop.run_in_executor(None, self.store.load_listings, station_id) if self.store else None
+        if saved is not None and saved["next_refresh"] > datetime.now():
+            _LOGGER.debug("Using saved listings for station [%s]", station_id)
+            return saved
+        try:
+            url = channel_listings_url(station_id, self.cache_hours)
+            _LOGGER.debug("Retrieving guide for station %s [%s]", station_id, url)
+            prog_channel = new_channel_listings()
+            prog_channel["next_refresh"] = datetime.now() + timedelta(minutes=1)
+            start = time.perf_counter()
+            async for listing in self.client.async_iter_items(url, 'listings', GUIDE_HEADERS):
+                add_listing(prog_channel, listing, station_id)
+            self.fetch_time.record(time.perf_counter() - start)
+            _LOGGER.debug("Next refresh for station [%s]: %s", station_id,
+                          prog_channel["next_refresh"].strftime('%Y-%m-%d %H:%M'))
+        except Exception as e:
+            if saved is None:
+                raise
+            _LOGGER.warning("Error getting listings [%s], using saved version", str(e))
+            saved["next_refresh"] = datetime.now() + timedelta(minutes=1)
+            return saved
+        if self.store:
+            await loop.run_in_executor(None, self.store.save_listings, station_id, prog_channel)
+        return prog_channel
+
+    def _async_single_flight(self, key, func, *args):
+        """Run coroutine function func unless a call for the same key is already running"""
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return asyncio.shield(future)
+
+    def _store(self, station_id, entry):
+        old_entry = self.listings.pop(station_id, None)
+        if old_entry is not None:
+            self._programmes -= len(old_entry["listings"])
+        self.listings[station_id] = entry
+        self._programmes += len(entry["listings"])
+        while self._programmes > self.max_programmes and len(self.listings) > 1:
+            evicted_id, evicted = self.listings.popitem(last=False)
+            self._programmes -= len(evicted["listings"])
+            self.evictions += 1
+            _LOGGER.debug("Dropped listings for station [%s] from cache", evicted_id)
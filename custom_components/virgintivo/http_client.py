@@ -0,0 +1,138 @@
+"""
+HTTP downloads for the Virgin Tivo component
+
+All requests go through one aiohttp session so connections are pooled and
+responses are gzip compressed.  Documents fetched with conditional=True are
+saved in the cache folder along with their ETag/Last-Modified, so when they
+haven't changed the server only needs to answer 304 Not Modified.  Only the
+ETag/Last-Modified are kept in memory, the document is read back on a 304.  JSON arrays can be read an
+item at a time while they download instead of as one document.
+"""
+import asyncio
+import codecs
+import hashlib
+import json
+import logging
+import os
+
+import aiohttp
+
+from .json_stream import JsonArrayParser, iter_array_items
+
+_LOGGER = logging.getLogger(__name__)
+
+HTTP_CACHE_DIR = 'virgin_tivo_http'
+HTTP_TIMEOUT = 30
+READ_CHUNK_SIZE = 16384
+
+
+class HttpClient:
+    """Text downloads over a shared aiohttp session."""
+
+    def __init__(self, session, cache_dir=None, timeout=HTTP_TIMEOUT):
+        """Initialize the client, saved documents go in cache_dir."""
+        self._session = session
+        self._cache_dir = cache_dir
+        self._timeout = aiohttp.ClientTimeout(total=timeout)
+        self._validators = {}
+        self.downloads = 0
+        self.not_modified = 0
+
+    async def async_get(self, url, headers=None, conditional=False):
+        """Download a document as text, raises aiohttp.ClientError or asyncio.TimeoutError on failure"""
+        conditional = conditional and bool(self._cache_dir)
+        validators = await self._async_load_validators(url) if conditional else None
+        body = await self._async_download(url, headers, validators, conditional)
+        if body is not None:
+            return body
+
+        saved = await asyncio.get_running_loop().run_in_executor(None, self._read, url)
+        if saved is not None and (saved.get("etag"), saved.get("last_modified")) == validators:
+            _LOGGER.debug("%s not modified", url)
+            self.not_modified += 1
+            return saved["body"]
+        _LOGGER.debug("Saved copy of %s has changed or gone, downloading it again", url)
+        self._validators[url] = None
+        return await self._async_download(url, headers, None, conditional)
+
+    async def async_iter_items(self, url, key, headers=None, conditional=False):
+        """Yield the items of the array under key in a JSON document as they arrive
+
+        A conditional document is kept whole so it can be reused, but is still
+        parsed a piece at a time.  Raises ValueError if the document is invalid.
+        """
+        if conditional:
+            for item in iter_array_items(await self.async_get(url, headers, conditional=True), key):
+                yield item
+            return
+
+        parser = JsonArrayParser(key)
+        async with self._session.get(url, headers=headers, timeout=self._timeout) as response:
+            response.raise_for_status()
+            decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+            async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                for item in parser.feed(decoder.decode(chunk)):
+                    yield item
+            for item in parser.feed(decoder.decode(b'', final=True)):
+                yield item
+        parser.close()
+        self.downloads += 1
+
+    def _cache_file(self, url):
+        return os.path.join(self._cache_dir, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    async def _async_load_validators(self, url):
+        """The ETag and Last-Modified of the saved copy, or None"""
+        if url not in self._validators:
+            saved = await asyncio.get_running_loop().run_in_executor(None, self._read, url)
+            self._validators[url] = (saved.get("etag"), saved.get("last_modified")) if saved is not None else None
+        return self._validators[url]
+
+    async def _async_download(self, url, headers, validators, conditional):
+        """Download and save a document, returns None if it matches validators"""
+        request_headers = dict(headers or {})
+        if validators is not None:
+            etag, last_modified = validators
+            if etag:
+                request_headers['If-None-Match'] = etag
+            if last_modified:
+                request_headers['If-Modified-Since'] = last_modified
+
+        async with self._session.get(url, headers=request_headers, timeout=self._timeout) as response:
+            if response.status == 304 and validators is not None:
+                return None
+            response.raise_for_status()
+            body = await response.text()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+
+        self.downloads += 1
+        if conditional:
+            saved = {"url": url, "etag": etag, "last_modified": last_modified, "body": body}
+            written = (etag or last_modified) and \
+                await asyncio.get_running_loop().run_in_executor(None, self._write, url, saved)
+            self._validators[url] = (etag, last_modified) if written else None
+        return body
+
+    def _read(self, url):
+        try:
+            with open(self._cache_file(url)) as cache_file:
+                saved = json.load(cache_file)
+            return saved if saved.get("url") == url else None
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            _LOGGER.debug("Ignoring saved copy of %s [%s]", url, str(e))
+            return None
+
+    def _write(self, url, saved):
+        try:
+            os.makedirs(self._cache_dir, exist_ok=True)
+            temp_file = self._cache_file(url) + '.tmp'
+            with open(temp_file, 'w') as cache_file:
+                json.dump(saved, cache_file)
+            os.replace(temp_file, self._cache_file(url))
+            return True
+        except OSError as e:
+            _LOGGER.warning("Could not save a copy of %s [%s]", url, str(e))
+            return False
@@ -0,0 +1,180 @@
+"""
+Incremental JSON parsing for the Virgin Tivo component
+
+The guide API returns documents like {"entryCount": 10, "listings": [...]}.
+JsonArrayParser picks the items out of one top level array as the text
+arrives, so only the item being decoded is ever held in full.  An item that
+isn't all here yet is only decoded again once a character that could end it
+has arrived, and text that can't be the start of a valid document is
+rejected straight away rather than at the end.
+"""
+import json
+import re
+
+_WHITESPACE = ' \t\n\r'
+_TERMINATORS = _WHITESPACE + ',:]}'
+
+# Parser states
+_START = 0
+_KEY = 1
+_COLON = 2
+_VALUE = 3
+_NEXT_KEY = 4
+_ARRAY = 5
+_ITEM = 6
+_NEXT_ITEM = 7
+_DONE = 8
+
+_INCOMPLETE = object()
+
+# What has to arrive before a value starting with the key can be complete
+_CLOSERS = {'{': '}', '[': ']', '"': '"'}
+_LITERALS = ('true', 'false', 'null', 'NaN', 'Infinity', '-Infinity')
+_NUMBER_REST = re.compile(r'[0-9.eE+-]*\Z')
+_UNICODE_ESCAPE_LENGTH = 5
+
+
+def is_truncated(text, error):
+    """Return True if the JSONDecodeError for text could go away with more text"""
+    rest = text[error.pos:]
+    if error.msg.startswith('Unterminated string'):
+        return True
+    if error.msg.startswith('Invalid \\uXXXX escape'):
+        return len(rest) < _UNICODE_ESCAPE_LENGTH
+    # Either nothing after the error, or the start of a literal or of the rest of a number
+    return any(literal.startswith(rest) for literal in _LITERALS) or _NUMBER_REST.match(rest) is not None
+
+
+class JsonArrayParser:
+    """Incremental parser for the items of the array under a top level key."""
+
+    def __init__(self, key):
+        """Initialize the parser for the array under key."""
+        self.key = key
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._state = _START
+        self._current_key = None
+        self._scanned = None
+
+    def feed(self, text):
+        """Add the next piece of the document and return the items completed by it"""
+        if self._state == _DONE:
+            return []
+        if self._pos:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        self._buffer += text
+        items = []
+        while self._step(items):
+            pass
+        return items
+
+    def close(self):
+        """Check the document ended, raises ValueError if it was cut short"""
+        if self._state != _DONE:
+            raise ValueError("JSON document ended before '{}' was complete".format(self.key))
+
+    def _skip_whitespace(self):
+        buffer = self._buffer
+        pos = self._pos
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+            pos += 1
+        self._pos = pos
+        return pos < len(buffer)
+
+    def _expect(self, char):
+        if self._buffer[self._pos] != char:
+            raise ValueError("Unexpected '{}' at {} in JSON document".format(self._buffer[self._pos], self._pos))
+        self._pos += 1
+
+    def _decode(self):
+        """Decode the value at the current position, _INCOMPLETE if it isn't all here yet
+
+        A number can decode from part of its digits, so a value only counts
+        once the character after it, which every value has, has arrived.
+        Raises ValueError if the value can't be completed by more text.
+        """
+        buffer = self._buffer
+        pos = self._pos
+        if self._scanned is not None:
+            closer = _CLOSERS.get(buffer[pos])
+            if closer is not None and buffer.find(closer, pos + self._scanned) < 0:
+                self._scanned = len(buffer) - pos
+                return _INCOMPLETE
+        try:
+            value, end = self._decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError as e:
+            if not is_truncated(buffer, e):
+                raise
+            self._scanned = len(buffer) - pos
+            return _INCOMPLETE
+        if end >= len(buffer) or buffer[end] not in _TERMINATORS:
+            if _NUMBER_REST.match(buffer, end) is None:
+                raise ValueError("Unexpected '{}' at {} in JSON document".format(buffer[end], end))
+            # Complete apart from the character after it, so try again with the next text
+            self._scanned = None
+            return _INCOMPLETE
+        self._scanned = None
+        self._pos = end
+        return value
+
+    def _step(self, items):
+        """Move on by one token, returns False when more text is needed"""
+        if self._state == _DONE or not self._skip_whitespace():
+            return False
+        state = self._state
+        char = self._buffer[self._pos]
+        if state == _START:
+            self._expect('{')
+            self._state = _KEY
+        elif state == _KEY:
+            if char == '}':
+                raise ValueError("JSON document has no '{}' array".format(self.key))
+            key = self._decode()
+            if key is _INCOMPLETE:
+                return False
+            self._current_key = key
+            self._state = _COLON
+        elif state == _COLON:
+            self._expect(':')
+            self._state = _ARRAY if self._current_key == self.key else _VALUE
+        elif state == _VALUE:
+            if self._decode() is _INCOMPLETE:
+                return False
+            self._state = _NEXT_KEY
+        elif state == _NEXT_KEY:
+            if char == '}':
+                raise ValueError("JSON document has no '{}' array".format(self.key))
+            self._expect(',')
+            self._state = _KEY
+        elif state == _ARRAY:
+            self._expect('[')
+            self._state = _ITEM
+        elif state == _ITEM:
+            if char == ']':
+                self._pos += 1
+                self._state = _DONE
+                return False
+            item = self._decode()
+            if item is _INCOMPLETE:
+                return False
+            items.append(item)
+            self._state = _NEXT_ITEM
+        elif state == _NEXT_ITEM:
+            if char == ']':
+                self._pos += 1
+                self._state = _DONE
+                return False
+            self._expect(',')
+            self._state = _ITEM
+        return True
+
+
+def iter_array_items(text, key, chunk_size=65536):
+    """Yield the items of the array under key from a complete document"""
+    parser = JsonArrayParser(key)
+    for start in range(0, len(text), chunk_size):
+        yield from parser.feed(text[start:start + chunk_size])
+    parser.close()
@@ -4,21 +4,16 @@ Support for the Virgin Tivo boxes
 For more details about this platform, please refer to the documentation at
 https://home-assistant.io/components/virgintivo
 """
+import asyncio
 import logging
-import socket
+import os
 import time
-import re
-import types
-import requests
+from datetime import datetime
 import json
-from datetime import datetime, timedelta
-import copy
-import pickle
 
+import aiohttp
 import voluptuous as vol
 
-REQUIREMENTS = ['beautifulsoup4>=4.4.1']
-
 VERSION = '0.1.26'
 
 try:
@@ -33,11 +28,28 @@ from homeassistant.components.media_player import PLATFORM_SCHEMA
 from homeassistant.components.media_player.const import (
     DOMAIN, MediaType) # Update for HA support
 
+from homeassistant.core import callback
+
+try:
+    from homeassistant.core import SupportsResponse
+except ImportError:
+    SupportsResponse = None
+
 from homeassistant.const import (
     ATTR_ENTITY_ID, CONF_NAME, CONF_HOST, CONF_PORT, STATE_OFF, STATE_PLAYING, STATE_PAUSED, STATE_UNKNOWN,
-    ATTR_COMMAND, CONF_URL, CONF_SCAN_INTERVAL)
+    ATTR_COMMAND, CONF_URL, CONF_SCAN_INTERVAL, EVENT_HOMEASSISTANT_STOP)
 
 import homeassistant.helpers.config_validation as cv
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.event import async_track_time_interval
+
+from .channel_list import (
+    LINEUP_CACHE_FILE, Lineup, LineupCache, add_csv_channels, add_html_channels, add_override_channels,
+    content_hash, pair_channels, read_lineup_file, set_channel_options, to_channel_listings)
+from .http_client import HTTP_CACHE_DIR, HttpClient
+from .guide import DEFAULT_CACHE_MB, GUIDE_STORE_FILE, PREFETCH_INTERVAL, Guide, GuideStore, find_listing
+from .metrics import Timing, combined_average, to_ms
+from .tivo import ACK_TIMEOUT, EVENT_FAILED, IDLE_TIMEOUT, TIVO_PORT, TivoConnection, TivoSupervisor, latest_status
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -50,18 +62,19 @@ MEDIA_PLAYER_SCHEMA = vol.Schema({
 })
 
 DATA_VIRGINTIVO = 'virgintivo'
-TIVO_PORT = 31339
-GUIDE_HOST = 'web-api-pepper.horizon.tv'
-GUIDE_PATH = 'oesp/api/GB/eng/web/'
-GUIDE_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/41.0.2228.0 '
-                               'Safari/537.36'}
+DATA_DIAGNOSTICS = DATA_VIRGINTIVO + '_diagnostics'
+DIAGNOSTICS_FILE = 'virgin_tivo_diagnostics.json'
 CHANNEL_LIST_URL = 'https://raw.githubusercontent.com/bertbert72/HomeAssistant_VirginTivo/master/channels/channels.csv'
-MIN_PICTURE_REFRESH = 10
+SD_OVERRIDE_WINDOW = 5
+PICTURE_REFRESH_MARGIN = 0.5
+DEFAULT_SERVICE_CONCURRENCY = 4
+DEFAULT_SERVICE_TIMEOUT = 10
 
 CONF_TIVOS = 'tivos'                      # list of Tivo boxes
 CONF_CHANNELS = 'channels'                # list of channels
 CONF_GUIDE = 'guide'                      # guide parameters
 CONF_CHANNEL_LIST = 'tvchannellists'      # online channel list
+CONF_LINEUP_FILE = 'lineup_file'          # channel list compiled by resources/virginchannels.py
 CONF_OVERRIDE = 'override'                # online channel list override
 
 CONF_REGION = 'region'                    # Programme region
@@ -74,10 +87,14 @@ CONF_TARGET = 'target'                    # hass entity to switch
 CONF_SOURCE = 'source'                    # source to switch to
 CONF_DEFAULTISSHOW = 'default_is_show'    # show all channels in source list by default
 CONF_CACHE_HOURS = 'cache_hours'          # how many hours of guide to load into cache
+CONF_CACHE_MB = 'cache_mb'                # memory budget for guide cache
 CONF_PICTURE_REFRESH = 'picture_refresh'  # how long before updating screen capture
 CONF_ENABLE_GUIDE = 'enable_guide'        # show guide
-CONF_KEEP_CONNECTED = 'keep_connected'    # keep a permanent connection to Tivo boxes
+CONF_KEEP_CONNECTED = 'keep_connected'    # no longer used, connection is always kept open
 CONF_SHOW_PACKAGES = 'show_packages'      # TV packages to show by default
+CONF_SERVICE_CONCURRENCY = 'service_concurrency'  # Tivo boxes handling a service call at once
+CONF_SERVICE_TIMEOUT = 'service_timeout'  # seconds before giving up on a box in a service call
+CONF_RESYNC_INTERVAL = 'resync_interval'  # seconds of quiet before checking the Tivo for standby
 CONF_PACKAGE = 'package'                  # TV package channel belongs to
 CONF_ENABLE = 'enable'                    # Online: Use TVChannelLists
 CONF_IGNORE_CHANNELS = 'ignore_channels'  # Online: Channels to ignore
@@ -99,8 +116,24 @@ SERVICE_SEARCH = DATA_VIRGINTIVO + '_search'
 SERVICE_SUBTITLES_OFF = DATA_VIRGINTIVO + '_subtitles_off'
 SERVICE_SUBTITLES_ON = DATA_VIRGINTIVO + '_subtitles_on'
 SERVICE_TELEPORT = DATA_VIRGINTIVO + '_teleport'
+SERVICE_DIAGNOSTICS = DATA_VIRGINTIVO + '_diagnostics'
 ATTR_REPEATS = 'repeats'
 
+# Service name: coroutine taking (tivo, command, repeats)
+SERVICE_HANDLERS = {
+    SERVICE_FIND_REMOTE: lambda tivo, command, repeats: tivo.async_find_remote(),
+    SERVICE_IRCODE: lambda tivo, command, repeats: tivo.async_ircode(command, repeats),
+    SERVICE_KEYBOARD: lambda tivo, command, repeats: tivo.async_keyboard(command),
+    SERVICE_LAST_CHANNEL: lambda tivo, command, repeats: tivo.async_last_channel(),
+    SERVICE_LIVE_TV: lambda tivo, command, repeats: tivo.async_live_tv(),
+    SERVICE_PLUS_ONE_OFF: lambda tivo, command, repeats: tivo.async_plus_one_off(),
+    SERVICE_PLUS_ONE_ON: lambda tivo, command, repeats: tivo.async_plus_one_on(),
+    SERVICE_SEARCH: lambda tivo, command, repeats: tivo.async_search(command),
+    SERVICE_SUBTITLES_OFF: lambda tivo, command, repeats: tivo.async_subtitles_off(),
+    SERVICE_SUBTITLES_ON: lambda tivo, command, repeats: tivo.async_subtitles_on(),
+    SERVICE_TELEPORT: lambda tivo, command, repeats: tivo.async_teleport(command),
+}
+
 # Valid tivo ids: 1-100
 TIVO_IDS = vol.All(vol.Coerce(int), vol.Range(min=1, max=100))
 
@@ -133,6 +166,7 @@ CHANNEL_SCHEMA = vol.Schema({
 
 GUIDE_SCHEMA = vol.Schema({
     vol.Optional(CONF_CACHE_HOURS, default=12): cv.positive_int,
+    vol.Optional(CONF_CACHE_MB, default=DEFAULT_CACHE_MB): cv.positive_int,
     vol.Optional(CONF_PICTURE_REFRESH, default=60): cv.positive_int,
     vol.Optional(CONF_ENABLE_GUIDE, default=False): cv.boolean, # change default to False since this no longer is supported
 })
@@ -162,347 +196,272 @@ PLATFORM_SCHEMA = vol.All(
         vol.Optional(CONF_FORCEHD, default=False): cv.boolean,
         vol.Required(CONF_TIVOS): vol.Schema({TIVO_IDS: TIVO_SCHEMA}),
         vol.Optional(CONF_CHANNEL_LIST): vol.Schema(CHANNEL_LIST_SCHEMA),
+        vol.Optional(CONF_LINEUP_FILE): cv.string,
         vol.Optional(CONF_CHANNELS): vol.Schema({CHANNEL_IDS: CHANNEL_SCHEMA}),
         vol.Optional(CONF_GUIDE): vol.Schema(GUIDE_SCHEMA),
         vol.Optional(CONF_KEEP_CONNECTED, default=False): cv.boolean,
         vol.Optional(CONF_SHOW_PACKAGES, default="UNSET"): cv.string,
+        vol.Optional(CONF_SERVICE_CONCURRENCY, default=DEFAULT_SERVICE_CONCURRENCY): cv.positive_int,
+        vol.Optional(CONF_SERVICE_TIMEOUT, default=DEFAULT_SERVICE_TIMEOUT): cv.positive_int,
+        vol.Optional(CONF_RESYNC_INTERVAL, default=IDLE_TIMEOUT): vol.All(vol.Coerce(int), vol.Range(min=10)),
     }))
 
 
-def setup_platform(hass, config, add_devices, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the Virgin Tivo platform."""
     if DATA_VIRGINTIVO not in hass.data:
         hass.data[DATA_VIRGINTIVO] = {}
 
-    show_by_default = config.get(CONF_DEFAULTISSHOW) and config.get(CONF_SHOW_PACKAGES) == "UNSET"
-
-    guide = types.SimpleNamespace()
-    guide.channels = {}
-    guide.listings = {}
-    if CONF_GUIDE in config:
-        guide.cache_hours = config[CONF_GUIDE][CONF_CACHE_HOURS]
-        guide.picture_refresh = config[CONF_GUIDE][CONF_PICTURE_REFRESH]
-        guide.enable_guide = config[CONF_GUIDE][CONF_ENABLE_GUIDE]
-    else:
-        guide.cache_hours = 12
-        guide.picture_refresh = 60
-        guide.enable_guide = True
+    start = time.time()
+    client = HttpClient(async_get_clientsession(hass), os.path.join(hass.config.config_dir, HTTP_CACHE_DIR))
+    lineup_cache = LineupCache(os.path.join(hass.config.config_dir, LINEUP_CACHE_FILE))
 
-    channel_listings = {}
+    # Start with the last lineup if there is one and check the channel list once the boxes are added
+    channels = {}
+    refresh_lineup = False
     if CONF_CHANNEL_LIST in config:
         if config[CONF_CHANNEL_LIST][CONF_ENABLE]:
-            if "csv" in config[CONF_CHANNEL_LIST][CONF_URL]:
-                channel_listings = get_channel_listings_csv(config[CONF_CHANNEL_LIST], hass.config.config_dir)
+            channels = await hass.async_add_executor_job(lineup_cache.load, lineup_settings_hash(config)) or {}
+            if channels:
+                _LOGGER.info("Using cached automatic channel list until it has been checked")
+                refresh_lineup = True
             else:
-                channel_listings = get_channel_listings(config[CONF_CHANNEL_LIST], hass.config.config_dir)
+                channels = await async_load_lineup(hass, config, client, lineup_cache)
 
-    if len(channel_listings) == 0:
+    if len(channels) == 0 and CONF_LINEUP_FILE in config:
+        channels = await async_load_lineup_file(hass, config)
+
+    if len(channels) == 0:
         if CONF_CHANNELS in config:
-            channel_listings = config[CONF_CHANNELS]
+            channels = resolve_channels(config[CONF_CHANNELS], config)
             _LOGGER.info("Using channel list from configuration file")
         else:
             _LOGGER.error("No channel configuration available")
-    else:
-        _LOGGER.info("Using automatic channel list")
 
-    channels = {}
-    for channel_id, entry in channel_listings.items():
-        show = entry[CONF_SHOW].lower()
-        channel_info = {
-            CONF_NAME: entry[CONF_NAME],
-            CONF_LOGO: entry[CONF_LOGO],
-            CONF_HDCHANNEL: entry[CONF_HDCHANNEL] if entry[CONF_HDCHANNEL] > 0 else None,
-            CONF_PLUSONE: entry[CONF_PLUSONE] if entry[CONF_PLUSONE] > 0 else None,
-            CONF_SHOW: (show_by_default or show == 'true' or entry[CONF_PACKAGE] in
-                        config.get(CONF_SHOW_PACKAGES).split(",")) and show != 'false',
-            CONF_TARGET: entry[CONF_TARGET],
-            CONF_SOURCE: entry[CONF_SOURCE],
-        }
-        channels[channel_id] = channel_info
+    lineup = Lineup(channels)
+    graph = lineup.graph
+
+    guide_store = GuideStore(os.path.join(hass.config.config_dir, GUIDE_STORE_FILE))
+    if CONF_GUIDE in config:
+        guide = Guide(graph, config[CONF_GUIDE][CONF_CACHE_HOURS], config[CONF_GUIDE][CONF_PICTURE_REFRESH],
+                      config[CONF_GUIDE][CONF_ENABLE_GUIDE], config[CONF_GUIDE][CONF_CACHE_MB], guide_store, client)
+    else:
+        guide = Guide(graph, store=guide_store, client=client)
 
+    # One supervisor opens and reopens the connections to all the boxes
+    supervisor = TivoSupervisor()
     hass.data[DATA_VIRGINTIVO] = []
     for tivo_id, extra in config[CONF_TIVOS].items():
         _LOGGER.info("Adding Tivo %d - %s", tivo_id, extra[CONF_NAME])
         force_hd_on_tv = config.get(CONF_FORCEHD) or extra.get(CONF_FORCEHD)
-        keep_connected = config.get(CONF_KEEP_CONNECTED) or extra.get(CONF_KEEP_CONNECTED)
-        _LOGGER.debug("Force HD on TV is %s", str(force_hd_on_tv))
-        try:
-            hass.data[DATA_VIRGINTIVO].append(VirginTivo(extra[CONF_HOST], channels, tivo_id, extra[CONF_NAME],
-                                                         force_hd_on_tv, guide, keep_connected))
-        except socket.gaierror:
-            # Will no longer happen
-            _LOGGER.warning("Could not find Tivo %d - %s", tivo_id, extra[CONF_NAME])
-            pass
-
-    add_devices(hass.data[DATA_VIRGINTIVO], True)
-
-    def service_handle(service):
-        """Handle for services."""
+        _LOGGER.debug("Force HD on TV is %s", force_hd_on_tv)
+        hass.data[DATA_VIRGINTIVO].append(VirginTivo(extra[CONF_HOST], lineup, tivo_id, extra[CONF_NAME],
+                                                     force_hd_on_tv, guide, supervisor,
+                                                     config[CONF_RESYNC_INTERVAL]))
+
+    tivos = hass.data[DATA_VIRGINTIVO]
+    async_add_entities(tivos)
+    setup_time = time.time() - start
+    _LOGGER.info("Added %d Tivo boxes in %.2f seconds", len(tivos), setup_time)
+
+    def collect_diagnostics():
+        """Gather the statistics for the diagnostics service and sensors."""
+        return build_diagnostics(tivos, guide, client, channels, setup_time)
+
+    hass.data[DATA_DIAGNOSTICS] = collect_diagnostics
+
+    async def async_prefetch_guide(now=None):
+        """Keep the guide for the channels in the source list loaded."""
+        await guide.async_prefetch([k for k, v in channels.items() if v[CONF_SHOW]])
+
+    async def async_refresh_lineup():
+        """Load the current channel list and pass on any changes."""
+        nonlocal channels, lineup
+        refresh_start = time.time()
+        new_channels = await async_load_lineup(hass, config, client, lineup_cache)
+        _LOGGER.debug("Checked channel list in %.2f seconds", time.time() - refresh_start)
+        new_lineup = lineup.updated(new_channels) if new_channels else lineup
+        if new_lineup is not lineup:
+            _LOGGER.info("Channel list has changed, updating Tivo boxes")
+            if new_lineup.graph is not lineup.graph:
+                guide.set_graph(new_lineup.graph)
+            lineup = new_lineup
+            channels = lineup.channels
+            for tivo in hass.data[DATA_VIRGINTIVO]:
+                tivo.set_lineup(lineup)
+                tivo.async_write_state_if_changed()
+            if guide.enable_guide:
+                await async_prefetch_guide()
+
+    if refresh_lineup:
+        hass.async_create_task(async_refresh_lineup())
+
+    if guide.enable_guide:
+        hass.async_create_task(async_prefetch_guide())
+        remove_prefetch = async_track_time_interval(hass, async_prefetch_guide, PREFETCH_INTERVAL)
+
+        @callback
+        def stop_prefetch(event):
+            """Stop prefetching the guide when Home Assistant stops."""
+            remove_prefetch()
+
+        hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, stop_prefetch)
+
+    semaphore = asyncio.Semaphore(config[CONF_SERVICE_CONCURRENCY])
+    service_timeout = config[CONF_SERVICE_TIMEOUT]
+
+    async def async_call_tivo(tivo, handler, service):
+        """Run a service on one box, giving up after the timeout."""
+        async with semaphore:
+            try:
+                await asyncio.wait_for(handler(tivo, service.data.get(ATTR_COMMAND), service.data.get(ATTR_REPEATS)),
+                                       service_timeout)
+            except asyncio.TimeoutError:
+                _LOGGER.warning("%s: %s timed out after %d seconds", tivo.name, service.service, service_timeout)
+
+    async def async_service_handle(service):
+        """Handle for services, running the boxes at the same time."""
         entity_ids = service.data.get(ATTR_ENTITY_ID)
-        command = service.data.get(ATTR_COMMAND)
-        repeats = service.data.get(ATTR_REPEATS)
 
         if entity_ids:
             tivos = [device for device in hass.data[DATA_VIRGINTIVO] if device.entity_id in entity_ids]
         else:
             tivos = hass.data[DATA_VIRGINTIVO]
 
-        for tivo in tivos:
-            if service.service == SERVICE_FIND_REMOTE:
-                tivo.find_remote()
-            elif service.service == SERVICE_IRCODE:
-                tivo.ircode(command, repeats)
-            elif service.service == SERVICE_KEYBOARD:
-                tivo.keyboard(command)
-            elif service.service == SERVICE_LAST_CHANNEL:
-                tivo.last_channel()
-            elif service.service == SERVICE_LIVE_TV:
-                tivo.live_tv()
-            elif service.service == SERVICE_PLUS_ONE_OFF:
-                tivo.plus_one_off()
-            elif service.service == SERVICE_PLUS_ONE_ON:
-                tivo.plus_one_on()
-            elif service.service == SERVICE_SEARCH:
-                tivo.search(command)
-            elif service.service == SERVICE_SUBTITLES_OFF:
-                tivo.subtitles_off()
-            elif service.service == SERVICE_SUBTITLES_ON:
-                tivo.subtitles_on()
-            elif service.service == SERVICE_TELEPORT:
-                tivo.teleport(command)
-
-    hass.services.register(DOMAIN, SERVICE_FIND_REMOTE, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_IRCODE, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_KEYBOARD, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_LAST_CHANNEL, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_LIVE_TV, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_PLUS_ONE_OFF, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_PLUS_ONE_ON, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_SEARCH, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_SUBTITLES_OFF, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_SUBTITLES_ON, service_handle, schema=TIVO_SERVICE_SCHEMA)
-    hass.services.register(DOMAIN, SERVICE_TELEPORT, service_handle, schema=TIVO_SERVICE_SCHEMA)
+        handler = SERVICE_HANDLERS[service.service]
+        results = await asyncio.gather(*(async_call_tivo(tivo, handler, service) for tivo in tivos),
+                                       return_exceptions=True)
+        for tivo, result in zip(tivos, results):
+            if isinstance(result, Exception):
+                _LOGGER.error("%s: error handling %s [%s]", tivo.name, service.service, str(result))
+
+    for service_name in SERVICE_HANDLERS:
+        hass.services.async_register(DOMAIN, service_name, async_service_handle, schema=TIVO_SERVICE_SCHEMA)
+
+    async def async_diagnostics_handle(service):
+        """Save the diagnostics to a file and return them."""
+        diagnostics = collect_diagnostics()
+        path = hass.config.path(DIAGNOSTICS_FILE)
+        await hass.async_add_executor_job(write_diagnostics, path, diagnostics)
+        _LOGGER.info("Saved diagnostics to %s", path)
+        return diagnostics
+
+    if SupportsResponse is not None:
+        hass.services.async_register(DOMAIN, SERVICE_DIAGNOSTICS, async_diagnostics_handle,
+                                     supports_response=SupportsResponse.OPTIONAL)
+    else:
+        hass.services.async_register(DOMAIN, SERVICE_DIAGNOSTICS, async_diagnostics_handle)
 
 
 class VirginTivo(MediaPlayerEntity):
     """Representation of a Virgin Tivo box."""
 
-    def __init__(self, host, channels, tivo_id, tivo_name, force_hd_on_tv, guide, keep_connected):
+    def __init__(self, host, lineup, tivo_id, tivo_name, force_hd_on_tv, guide, supervisor=None,
+                 resync_interval=IDLE_TIMEOUT):
         """Initialize new Tivo."""
         self._host = host
-        self._channel_id_name = {k: v[CONF_NAME] for k, v in channels.items()}
-        self._channel_name_id = {v[CONF_NAME]: k for k, v in channels.items()}
-        channel_name_id_enabled = {v[CONF_NAME]: k for k, v in channels.items() if v[CONF_SHOW]}
-        self._channel_names = sorted(channel_name_id_enabled.keys(), key=lambda v: channel_name_id_enabled[v])
-        self._channels = channels
-        self._target_ids = {k: v[CONF_TARGET] for k, v in channels.items() if v[CONF_TARGET] != ""}
-        self._sources = {k: v[CONF_SOURCE] for k, v in channels.items() if v[CONF_TARGET] != ""}
         self._tivo_id = tivo_id
         self._name = tivo_name
         self._state = STATE_OFF
         self._channel_name = None
         self._channel_id = None
         self._last_channel = None
-        self._channel_pic_url = None
-        self._sock = None
-        self._port = TIVO_PORT
-        self._last_msg = ""
+        self.set_lineup(lineup)
+        self._conn = TivoConnection(host, TIVO_PORT, tivo_name, supervisor, resync_interval)
+        self._conn.on_events = self._handle_events
+        self._conn.on_standby = self._handle_standby
         self._force_hd_on_tv = force_hd_on_tv
         self._guide = guide
         self._guide_channel = None
-        self._last_screen_grab = 0
-        self._last_pic_url_update = 0
-        self._keep_connected = keep_connected
+        self._current_prog = None
+        self._prog_timer = None
+        self._picture_timer = None
+        self._last_fingerprint = None
+        self.suppressed_writes = 0
         self._paused = False
         self._sdoverride = {'enabled': False, 'channel_id': None, 'refresh_time': time.time()}
-        self._connected = False
-        self._running_command = False
-        self._running_update = False
         self._turning_off = False
-        self._turning_on = False
-
-        _LOGGER.debug("%s: initialising connection to [%s]", self._name, self._host)
-        self.connect()
-        if not self._keep_connected:
-            self.disconnect()
-
+        self.event_time = Timing()
+
+    def set_lineup(self, lineup):
+        """Use a new set of channels, the lookups are shared with the other boxes."""
+        last_channel_id = self._channel_name_id.get(self._last_channel) if self._last_channel is not None else None
+        self._lineup = lineup
+        self._channels = lineup.channels
+        self._graph = lineup.graph
+        self._channel_id_name = lineup.id_name
+        self._channel_name_id = lineup.name_id
+        self._target_ids = lineup.target_ids
+        self._sources = lineup.sources
+
+        # Follow the current and last channels if they have been renamed or removed
+        if self._channel_id is not None:
+            self._channel_name = self._channel_id_name.get(self._channel_id)
+        self._last_channel = self._channel_id_name.get(last_channel_id)
+
+    async def async_added_to_hass(self):
+        """Load the guide and start listening once the entity is registered."""
+        self._conn.start(self.hass.loop)
         if self._guide.enable_guide:
-            self.get_guide_channels()
-
-    def get_guide_channels(self):
-        """Retrieve list of channels available in guide"""
-
-        try:
-            if not self._guide.channels:
-                _LOGGER.debug("Retrieving guide channels")
-                url = 'https://{0}/{1}/channels'.format(GUIDE_HOST, GUIDE_PATH)
-                response = requests.get(url, headers=GUIDE_HEADERS)
-                channels_data = json.loads(response.text)
-                for channel in channels_data["channels"]:
-                    ch_number = channel["channelNumber"]
-                    _LOGGER.debug("New channel [%s]", str(ch_number))
-                    urls = channel["stationSchedules"][0]["station"]["images"]
-                    ch_info = {
-                        "channel_number": ch_number,
-                        "id": channel["stationSchedules"][0]["station"]["id"],
-                        "title": channel["stationSchedules"][0]["station"]["title"],
-                        "url": next(iter([a["url"] for a in urls
-                                          if "url" in a and "assetType" in a and a["assetType"] == "imageStream"]), None),
-                        "logo": next(iter([a["url"] for a in urls
-                                           if "url" in a and "assetType" in a and a["assetType"] == "station-logo-large"]), None),
-                    }
-                    self._guide.channels[ch_number] = ch_info
-                    if ch_number in self._channels:
-                        for related_channel in self.get_related_channels(ch_number):
-                            if related_channel != ch_number:
-                                self._guide.channels[related_channel] = copy.deepcopy(ch_info)
-                                self._guide.channels[related_channel]["channel_number"] = related_channel
-                                if self.is_hd_channel(related_channel):
-                                    self._guide.channels[related_channel]["title"] += " HD"
-                                if self.is_plus_one_channel(related_channel):
-                                    self._guide.channels[related_channel]["title"] += " +1"
-                                    self._guide.channels[related_channel]["url"] = None
-                                _LOGGER.debug("Copied channel [%d] to channel [%d]", ch_number, related_channel)
+            try:
+                await self._guide.async_load_channels()
+            except Exception as e:
+                _LOGGER.warning("%s: error getting guide channel list [%s]", self._name, str(e))
+
+    async def async_will_remove_from_hass(self):
+        """Stop listening when the entity is removed."""
+        if self._prog_timer is not None:
+            self._prog_timer.cancel()
+            self._prog_timer = None
+        if self._picture_timer is not None:
+            self._picture_timer.cancel()
+            self._picture_timer = None
+        await self._conn.async_stop()
 
-            else:
-                _LOGGER.debug("Guide already populated")
-
-        except Exception as e:
-            _LOGGER.debug("Error getting guide channel list [%s]", str(e))
-            raise
-
-    def get_related_channels(self, channel_id):
-        related_channels = {channel_id}
-        base_channel_name = self._channels[channel_id][CONF_NAME].replace(' HD', '')
-        for key, channel in self._channels.items():
-            if channel[CONF_HDCHANNEL] == channel_id or channel[CONF_PLUSONE] == channel_id \
-                    or channel[CONF_NAME].replace(' HD', '').replace(' +1', '') == base_channel_name:
-                related_channels.add(key)
-        _LOGGER.debug("Related channels: " + str(related_channels))
-        return related_channels
-
-    def get_guide_listings(self, channel_id):
-        """Retrieve list of programs for a channel"""
-
-        listings = self._guide.listings
-        try:
-            _LOGGER.debug("Channel [%s] in listings: %s", str(channel_id), str(channel_id in listings))
-            if channel_id not in listings or listings[channel_id]["next_refresh"] <= datetime.now():
-                start_time = int(time.time()) * 1000
-                end_time = start_time + (3600 * self._guide.cache_hours * 1000)
-                ch_id = self._guide.channels[channel_id]["id"]
-                url = "https://{0}/{1}/listings?byStationId={2}&byEndTime={3}~{4}&sort=startTime"\
-                    .format(GUIDE_HOST, GUIDE_PATH, ch_id, start_time, end_time)
-                _LOGGER.debug("%s: retrieving guide for channel %s [%s]", self._name, channel_id, url)
-
-                prog_channel = {
-                    "next_refresh": 0,
-                    "listings": [],
-                }
-                listings[channel_id] = prog_channel
-
-                # _LOGGER.debug("*** url request: [%s]", url);
-                response = requests.get(url, headers=GUIDE_HEADERS)
-                listings_data = json.loads(response.text)
-                # _LOGGER.debug("*** response: [%s]", str(response.text))
-                prog_end_time = datetime.now()
-                listings[channel_id]["next_refresh"] = datetime.now() + timedelta(minutes=1)
-                for listing in listings_data["listings"]:
-                    prog_start_time = datetime.fromtimestamp(listing["startTime"] / 1000)
-                    prog_end_time = datetime.fromtimestamp(listing["endTime"] / 1000)
-                    prog_title = listing["program"]["title"]
-                    if "description" in listing["program"]:
-                        prog_description = listing["program"]["description"]
-                    elif "longDescription" in listing["program"]:
-                        prog_description = listing["program"]["longDescription"]
-                    else:
-                        prog_description = ""
-                    if "seriesEpisodeNumber" in listing["program"] and "seriesNumber" in listing["program"]:
-                        prog_episode_number = listing["program"]["seriesEpisodeNumber"]
-                        prog_series_number = listing["program"]["seriesNumber"]
-                    else:
-                        prog_episode_number = None
-                        prog_series_number = None
-                    if "secondaryTitle" in listing["program"]:
-                        prog_episode_title = listing["program"]["secondaryTitle"]
-                    else:
-                        prog_episode_title = None
-
-                    prog_info = {
-                        "title": prog_title,
-                        "description": prog_description,
-                        "id": listing["stationId"],
-                        "start_time": prog_start_time,
-                        "end_time": prog_end_time,
-                        "duration": prog_end_time - prog_start_time,
-                        "prog_type": listing["program"]["medium"],
-                        "prog_episode_title": prog_episode_title,
-                        "prog_episode_number": prog_episode_number,
-                        "prog_series_number": prog_series_number,
-                    }
-
-                    listings[channel_id]["listings"].append(prog_info)
-                    if listings[channel_id]["next_refresh"] < prog_start_time:
-                        listings[channel_id]["next_refresh"] = prog_start_time
-                    _LOGGER.debug("Added [%s] [%s - %s] to channel [%d]", prog_title, str(prog_start_time), str(prog_end_time), channel_id)
-
-                if self.is_plus_one_channel(channel_id):
-                    for prog in listings[channel_id]["listings"]:
-                        prog["start_time"] += timedelta(hours=1)
-                        prog["end_time"] += timedelta(hours=1)
-                    _LOGGER.debug("Updated times for +1 channel [%d]", channel_id)
-
-                _LOGGER.debug("Next refresh for channel [%d]: %s", channel_id, listings[channel_id]["next_refresh"].strftime('%Y-%m-%d %H:%M'))
-
-        except Exception as e:
-            _LOGGER.warning("Error getting listings [%s]", str(e))
-            listings[channel_id]["next_refresh"] = datetime.now() + timedelta(minutes=1)
-            _LOGGER.warning("Resetting next_refresh to %s", str(listings[channel_id]["next_refresh"]))
+    @property
+    def connection(self):
+        """Return the connection to the Tivo."""
+        return self._conn
+
+    def diagnostics(self):
+        """Return the state of the box and its statistics."""
+        return {
+            "host": self._host,
+            "state": self._state,
+            "channel_id": self._channel_id,
+            "connection": self._conn.health,
+            "event_handling": self.event_time.as_dict(),
+            "suppressed_writes": self.suppressed_writes,
+        }
 
     def get_current_prog(self):
         """Determine currently running program"""
 
         if self._guide_channel:
-            channel_id = self._guide_channel["channel_number"]
-            if channel_id in self._guide.listings:
-                current_datetime = datetime.now()
-                for listing in self._guide.listings[channel_id]["listings"]:
-                    if listing["start_time"] <= current_datetime < listing["end_time"]:
-                        return listing
+            channel_listings = self._guide.listings.get(self._guide_channel.id)
+            if channel_listings:
+                now = time.time()
+                offset = self._guide_channel.offset
+                memo = self._current_prog
+                if memo and memo[0] is channel_listings and memo[1] == offset and memo[2] <= now < memo[3]:
+                    return memo[4]
+                listing, valid_from, valid_until = find_listing(channel_listings, now, offset)
+                self._current_prog = (channel_listings, offset, valid_from, valid_until, listing)
+                return listing
 
         return None
 
     def get_sd_channel(self, channel_id):
         """Get the SD version of a given channel"""
-
-        sd_channel = channel_id
-        for key, channel in self._channels.items():
-            if channel[CONF_HDCHANNEL] == sd_channel:
-                sd_channel = key
-
-        for key, channel in self._channels.items():
-            if channel[CONF_PLUSONE] == sd_channel:
-                sd_channel = key
-
-        return sd_channel
+        return self._graph.sd_channel(channel_id)
 
     def is_plus_one_channel(self, channel_id):
         """Check if channel is +1"""
-
-        for key, channel in self._channels.items():
-            if channel[CONF_PLUSONE] == channel_id:
-                return True
-
-        return False
+        return self._graph.is_plus_one(channel_id)
 
     def is_hd_channel(self, channel_id):
         """Check if channel is HD"""
-
-        for key, channel in self._channels.items():
-            if channel[CONF_HDCHANNEL] == channel_id:
-                return True
-
-        return False
+        return self._graph.is_hd(channel_id)
 
     def override_channel(self, channel_id):
         """Change channel to HD version if required"""
@@ -516,161 +475,152 @@ class VirginTivo(MediaPlayerEntity):
             else:
                 self._sdoverride['enabled'] = False
                 self._sdoverride['channel_id'] = channel_id
-                # self._sdoverride['refresh_time'] = time.time() + SCAN_INTERVAL.total_seconds() + 5
-                self._sdoverride['refresh_time'] = time.time() + 1 + 5
+                # Restarted when the Tivo confirms the switch, see _async_tune
+                self._sdoverride['refresh_time'] = time.time() + SD_OVERRIDE_WINDOW
 
                 channel_id = self._channels[channel_id][CONF_HDCHANNEL]
                 _LOGGER.debug("%s: automatically switching to HD channel", self._name)
 
         return channel_id
 
-    def tivo_cmd(self, cmd):
+    async def async_tivo_cmd(self, cmd):
         """Send command to Tivo box"""
-        self._running_command = True
-        self.connect()
-        if self._connected:
-            upper_cmd = cmd.upper()
-            _LOGGER.debug("%s: sending request [%s]", self._name, upper_cmd.replace('\r', '\\r'))
-            try:
-                self._sock.sendall(upper_cmd.encode())
-                self._running_command = False
-                if not self._keep_connected:
-                    self.disconnect()
-            except socket.timeout:
-                _LOGGER.warning("%s: connection timed out", self._name)
-        else:
-            _LOGGER.warning("%s: cannot send command when not connected", self._name)
-        self._running_command = False
-
-    def update(self):
-        """Retrieve latest state."""
-        if not self._turning_off and not self._turning_on and not self._running_update:
-            self._running_update = True
-            self.connect()
-            self._running_update = False
-            if not self._keep_connected:
-                self.disconnect()
+        return await self._conn.async_send(cmd.upper())
+
+    def _handle_standby(self):
+        """Tivo did not report a status so it is in standby."""
+        self._state = STATE_OFF
+        self.async_write_state_if_changed()
 
+    def _handle_events(self, events):
+        """Update the current channel from the Tivo status events."""
+        start = time.perf_counter()
+        if not self._turning_off:
+            self._state = STATE_PAUSED if self._paused else STATE_PLAYING
+        if events:
+            self._update_channel(events)
+        self.async_write_state_if_changed()
+        self.event_time.record(time.perf_counter() - start)
+
+    def _update_channel(self, events):
+        """Apply the latest channel status."""
         current_channel_name = self._channel_name
-        data = self._last_msg
-        if data is None or data == "":
-            _LOGGER.debug("%s: not on live TV", self._name)
-        else:
-            new_status = re.search(r'(?<=CH_STATUS )(\d+)', data)
-            if new_status is None:
-                new_status = re.search(r'(?<=CH_FAILED )(\w+)', data)
-                if new_status is not None:
-                    new_status = new_status.group(0)
-                    _LOGGER.warning("%s: failure message is [%s]", self._name, new_status)
-                    if new_status != "NO_LIVE":
-                        self.disconnect()
-            else:
-                new_status = new_status.group(0)
-                new_channel_id = int(new_status)
+        disconnect = False
+        for event in events:
+            if event.kind == EVENT_FAILED:
+                _LOGGER.warning("%s: failure message is [%s]", self._name, event.value)
+                disconnect = disconnect or event.value != "NO_LIVE"
 
-                if current_channel_name is not None:
-                    current_channel_id = self._channel_name_id[current_channel_name]
-                else:
-                    current_channel_id = -1
+        status = latest_status(events)
+        if status is not None:
+            new_channel_id = status.value
 
-                if new_channel_id != current_channel_id:
-                    _LOGGER.debug("%s: changing to channel [%s]", self._name, new_status)
-                    if new_channel_id not in self._channels:
-                        _LOGGER.warning("%s: incorrect channel configuration for channel [%d]", self.name, new_channel_id)
+            current_channel_id = self._channel_id if self._channel_id is not None else -1
 
+            if new_channel_id != current_channel_id:
+                _LOGGER.debug("%s: changing to channel [%d]", self._name, new_channel_id)
+                if new_channel_id not in self._channels:
+                    _LOGGER.warning("%s: incorrect channel configuration for channel [%d]", self.name, new_channel_id)
+
+                # Not repeated for a status of the current channel, e.g. after a resync
                 if new_channel_id in self._target_ids:
-                    _LOGGER.debug("%s: switcher source triggered %s,%s,%s", self._name, str(new_channel_id),
+                    _LOGGER.debug("%s: switcher source triggered %s,%s,%s", self._name, new_channel_id,
                                   self._sources[new_channel_id], self._target_ids[new_channel_id])
                     state = self.hass.states.get(self._target_ids[new_channel_id])
                     if state is not None:
                         service_data = dict([("entity_id", self._target_ids[new_channel_id]),
                                              ("source", self._sources[new_channel_id])])
-                        self.hass.services.call('media_player', 'select_source', service_data)
+                        self.hass.async_create_task(
+                            self.hass.services.async_call('media_player', 'select_source', service_data))
                         if current_channel_name is not None:
                             _LOGGER.debug("%s: reset channel back to [%d]", self._name, current_channel_id)
                             new_channel_id = current_channel_id
-                            self.select_source(self._channel_id_name[new_channel_id])
+                            # Not awaited as the acknowledgement arrives through this listener
+                            self.hass.async_create_task(self._async_tune(new_channel_id))
 
                 override_idx = self.override_channel(new_channel_id)
                 if override_idx != new_channel_id:
                     new_channel_id = override_idx
-                    self.select_source(self._channel_id_name[new_channel_id])
-
-                if new_channel_id != current_channel_id:
-                    if new_channel_id in self._channel_id_name:
-                        self._channel_name = self._channel_id_name[new_channel_id]
-                        self._channel_id = new_channel_id
-                    else:
-                        self._channel_name = None
-
-                if new_channel_id in self._guide.channels:
-                    _LOGGER.debug("%s: guide found for channel %d (%d)", self._name, new_channel_id, new_channel_id)
-                    self._guide_channel = self._guide.channels[new_channel_id]
-                else:
-                    _LOGGER.debug("%s: no guide found for channel %d", self._name, new_channel_id)
-                    self._guide_channel = None
-
-        # Check listing each time
-        #if self._guide_channel is not None:
-        #    self.get_guide_listings(self._guide_channel["channel_number"])
+                    self.hass.async_create_task(self._async_tune(new_channel_id, forced_hd=True))
+
+            if new_channel_id != current_channel_id:
+                self._channel_name = self._channel_id_name.get(new_channel_id)
+                self._channel_id = new_channel_id
+
+            if new_channel_id in self._guide.channels:
+                _LOGGER.debug("%s: guide found for channel %d (%d)", self._name, new_channel_id, new_channel_id)
+                self._guide_channel = self._guide.channels[new_channel_id]
+            else:
+                _LOGGER.debug("%s: no guide found for channel %d", self._name, new_channel_id)
+                self._guide_channel = None
+
+        # Load the listings for the new channel without holding up the listener
+        if self._guide_channel is not None and current_channel_name != self._channel_name:
+            self.hass.async_create_task(self._async_update_guide(self._guide_channel.channel_number))
 
         if current_channel_name != self._channel_name:
             self._last_channel = current_channel_name
-            self._last_screen_grab = 0
-
-    def connect(self):
-        bufsize = 1024
-        try:
-            if not self._connected:
-                _LOGGER.debug("%s: connecting to socket", self._name)
-                self._sock = socket.socket()
-                self._sock.settimeout(1)
-                self._sock.connect((self._host, self._port))
-                _LOGGER.debug("%s: connected OK", self._name)
-                self._connected = True
-            _LOGGER.debug("%s: reading data from socket", self._name)
-            data = self._sock.recv(bufsize).decode()
-            _LOGGER.debug("%s: response data [%s]", self._name, data)
-            self._last_msg = data
-            self._state = STATE_PAUSED if self._paused else STATE_PLAYING
-        except socket.timeout:
-            _LOGGER.debug("%s: socket timeout in 'connect'", self._name)
-            self._state = STATE_OFF
-            pass
-        except Exception as e:
-            try:
-                _LOGGER.debug("%s: connection attempt gave [%s]", self._name, str(e))
-                _LOGGER.debug("%s: connecting to [%s]", self._name, self._host)
-                self._sock = socket.socket()
-                self._sock.settimeout(1)
-                self._sock.connect((self._host, self._port))
-                self._connected = True
-                data = self._sock.recv(bufsize).decode()
-                _LOGGER.debug("%s: response data [%s]", self._name, data)
-                self._last_msg = data
-                self._state = STATE_PAUSED if self._paused else STATE_PLAYING
-            except (socket.timeout, socket.gaierror, OSError) as e:
-                if self._last_msg is not None:
-                    _LOGGER.warning("%s: %s, will retry", self._name, str(e))
-                    self._last_msg = None
-                self.disconnect()
-                _LOGGER.debug("%s: general socket error in 'connect'", self._name)
-                pass
-            except Exception:
-                raise
-
-    def disconnect(self):
-        if self._running_update or self._running_command:
-            _LOGGER.debug("%s: not disconnecting from [%s] due to update running", self._name, self._host)
-        elif self._running_command:
-            _LOGGER.debug("%s: not disconnecting from [%s] due to command running", self._name, self._host)
-        else:
-            if self._sock:
-                _LOGGER.debug("%s: disconnecting from [%s]", self._name, self._host)
-                time.sleep(0.1)
-                # self._sock.shutdown()
-                self._sock.close()
-            self._connected = False
+
+        if disconnect:
+            self._conn.disconnect()
+
+    async def _async_update_guide(self, channel_id):
+        """Make sure the guide listings for a channel are loaded."""
+        if await self._guide.async_get_listings(channel_id) is not None:
+            self.async_write_state_if_changed()
+
+    def _state_fingerprint(self):
+        """Everything shown by the entity apart from the screen grab's cache buster"""
+        current_prog = self.get_current_prog()
+        prog_key = (current_prog.start, current_prog.end, current_prog.title) if current_prog else None
+        return (self._state, self._channel_id, self._channel_name, prog_key, self._picture_url(),
+                self._lineup)
+
+    def async_write_state_if_changed(self):
+        """Write the state if anything shown has changed, otherwise count the write as suppressed."""
+        if self.hass is None:
+            return
+        fingerprint = self._state_fingerprint()
+        self._schedule_prog_check()
+        self._schedule_picture_refresh()
+        if fingerprint == self._last_fingerprint:
+            self.suppressed_writes += 1
+            return
+        self._last_fingerprint = fingerprint
+        self.async_write_ha_state()
+
+    def _schedule_prog_check(self):
+        """Check the state again when the current programme ends."""
+        if self._prog_timer is not None:
+            self._prog_timer.cancel()
+            self._prog_timer = None
+        memo = self._current_prog
+        if self._guide_channel and memo and memo[3] != float('inf'):
+            self._prog_timer = self.hass.loop.call_later(max(0, memo[3] - time.time()),
+                                                         self.async_write_state_if_changed)
+
+    def _schedule_picture_refresh(self):
+        """Write the state when the screen grab's URL next changes, while the box is on."""
+        if self._picture_timer is not None:
+            self._picture_timer.cancel()
+            self._picture_timer = None
+        if self._state in (STATE_PLAYING, STATE_PAUSED) and self._shows_screen_grab():
+            refresh = self._guide.picture_refresh
+            # Just after the boundary, so the new URL is seen even if the timer fires a little early
+            delay = refresh - time.time() % refresh + PICTURE_REFRESH_MARGIN
+            self._picture_timer = self.hass.loop.call_later(delay, self._refresh_picture)
+
+    def _refresh_picture(self):
+        """Show a new screen grab, nothing else needs to have changed."""
+        self._picture_timer = None
+        self._last_fingerprint = self._state_fingerprint()
+        self.async_write_ha_state()
+        self._schedule_picture_refresh()
+
+    @property
+    def should_poll(self):
+        """No polling needed, the Tivo pushes status changes."""
+        return False
 
     @property
     def name(self):
@@ -693,8 +643,8 @@ class VirginTivo(MediaPlayerEntity):
         current_prog = self.get_current_prog()
         if current_prog:
             # MEDIA_TYPE_MOVIE doesn't display as much info - see prog_type instead
-            # return MEDIA_TYPE_MOVIE if current_prog["prog_type"] == "Movie" else MEDIA_TYPE_TVSHOW
-            return MediaTYpe.TVSHOW
+            # return MEDIA_TYPE_MOVIE if current_prog.prog_type == "Movie" else MEDIA_TYPE_TVSHOW
+            return MediaType.TVSHOW
         else:
             return None
 
@@ -704,7 +654,7 @@ class VirginTivo(MediaPlayerEntity):
         # NB: doesn't seem to be displayed with TV shows
         current_prog = self.get_current_prog()
         if current_prog:
-            return int(current_prog["duration"].total_seconds())
+            return int(current_prog.duration.total_seconds())
         else:
             return None
 
@@ -714,30 +664,35 @@ class VirginTivo(MediaPlayerEntity):
         # NB: doesn't seem to be displayed with TV shows
         current_prog = self.get_current_prog()
         if current_prog:
-            return int((datetime.now() - current_prog["start_time"]).total_seconds())
+            return int((datetime.now() - current_prog.start_time).total_seconds())
         else:
             return None
 
+    def _picture_url(self):
+        """Screen grab or logo for the current channel, without the cache buster"""
+        if self._guide_channel:
+            return self._guide_channel.url or self._guide_channel.logo or None
+        if self._channel_id in self._channels and self._channels[self._channel_id][CONF_LOGO] != "":
+            return self._channels[self._channel_id][CONF_LOGO]
+        return None
+
+    def _shows_screen_grab(self):
+        """Check if the picture is a screen grab that changes over time"""
+        pic_url = self._picture_url()
+        return bool(pic_url and self._guide_channel and self._guide_channel.url
+                    and "?" not in pic_url and "Channel_Logos" not in pic_url)
+
     @property
     def media_image_url(self):
-        """Image url of current playing media."""
-        pic_url = self._channel_pic_url
-        if self._channel_id and (self._last_screen_grab + self._guide.picture_refresh) <= time.time():
-            # Workaround for issue with image caching
-            if self._last_pic_url_update + MIN_PICTURE_REFRESH <= time.time():
-                self._last_screen_grab = time.time()
-                if self._guide_channel:
-                    pic_url = self._guide_channel["url"]
-                    if not pic_url:
-                        pic_url = self._guide_channel["logo"]
-                    if "?" not in pic_url and "Channel_Logos" not in pic_url:
-                        pic_url = pic_url + "?" + str(int(time.time()))
-                else:
-                    if self._channels[self._channel_id][CONF_LOGO] != "":
-                        pic_url = self._channels[self._channel_id][CONF_LOGO]
-                if self._channel_pic_url != pic_url:
-                    self._last_pic_url_update = time.time()
-                    self._channel_pic_url = pic_url
+        """Image url of current playing media.
+
+        Home Assistant caches images by URL, so a screen grab's changes every
+        picture_refresh seconds for a new one to be fetched, see
+        _schedule_picture_refresh.
+        """
+        pic_url = self._picture_url()
+        if self._shows_screen_grab():
+            pic_url = pic_url + "?" + str(int(time.time() // self._guide.picture_refresh))
         return pic_url
 
     @property
@@ -745,18 +700,18 @@ class VirginTivo(MediaPlayerEntity):
         """Title of series of current playing media, TV show only."""
         current_prog = self.get_current_prog()
         if current_prog:
-            title = current_prog["title"]
+            title = current_prog.title
 
-            season = current_prog["prog_series_number"]
+            season = current_prog.prog_series_number
             if season and int(season) < 1000:
-                title += " S " + season + ", Ep " + current_prog["prog_episode_number"]
+                title += " S " + season + ", Ep " + current_prog.prog_episode_number
 
-            episode_title = current_prog["prog_episode_title"]
+            episode_title = current_prog.prog_episode_title
             if episode_title:
                 title += ": " + episode_title
 
-            start_time = current_prog["start_time"].strftime('%H:%M')
-            end_time = current_prog["end_time"].strftime('%H:%M')
+            start_time = current_prog.start_time.strftime('%H:%M')
+            end_time = current_prog.end_time.strftime('%H:%M')
             display_time = '{0} - {1}'.format(start_time, end_time)
 
             title += " " + display_time
@@ -771,7 +726,7 @@ class VirginTivo(MediaPlayerEntity):
         # disabled to allow inclusion in media series title - see prog_series_number instead
         # current_prog = self.get_current_prog()
         # if current_prog:
-        #     return current_prog["prog_series_number"]
+        #     return current_prog.prog_series_number
         # else:
         #     return None
         return None
@@ -782,7 +737,7 @@ class VirginTivo(MediaPlayerEntity):
         # disabled to allow inclusion in media series title - see prog_episode_number instead
         # current_prog = self.get_current_prog()
         # if current_prog:
-        #     return current_prog["prog_episode_number"]
+        #     return current_prog.prog_episode_number
         # else:
         #     return None
         return None
@@ -796,7 +751,7 @@ class VirginTivo(MediaPlayerEntity):
         """Return the current program info"""
         current_prog = self.get_current_prog()
         if current_prog:
-            return current_prog[attribute]
+            return getattr(current_prog, attribute)
         else:
             return None
 
@@ -812,126 +767,137 @@ class VirginTivo(MediaPlayerEntity):
             'prog_episode_title': self.get_prog_info('prog_episode_title'),
             'prog_episode_number': self.get_prog_info('prog_episode_number'),
             'prog_series_number': self.get_prog_info('prog_series_number'),
-            'base_channel_name': self._channels[self.get_sd_channel(self._channel_id)][CONF_NAME],
+            'base_channel_name': None,
         }
 
+        # No channel is known until the Tivo first reports its status
+        if self._channel_id in self._channels:
+            attr['base_channel_name'] = self._channels[self.get_sd_channel(self._channel_id)][CONF_NAME]
+
         return attr
 
     """Custom services"""
-    def find_remote(self):
-        self.tivo_cmd("IRCODE FIND_REMOTE\r")
+    async def async_find_remote(self):
+        await self.async_tivo_cmd("IRCODE FIND_REMOTE\r")
 
-    def ircode(self, cmd, repeats):
+    async def async_ircode(self, cmd, repeats):
         this_count = repeats
         this_cmd = ""
         while this_count > 0:
             this_cmd += "IRCODE " + cmd + "\r"
             this_count -= 1
-        self.tivo_cmd(this_cmd)
+        await self.async_tivo_cmd(this_cmd)
 
-    def keyboard(self, cmd):
-        self.tivo_cmd("KEYBOARD " + cmd + "\r")
+    async def async_keyboard(self, cmd):
+        await self.async_tivo_cmd("KEYBOARD " + cmd + "\r")
 
-    def last_channel(self):
+    async def async_last_channel(self):
         if self._last_channel:
-            self.select_source(self._last_channel)
+            await self.async_select_source(self._last_channel)
 
-    def live_tv(self):
-        self.tivo_cmd("IRCODE LIVETV\r")
+    async def async_live_tv(self):
+        await self.async_tivo_cmd("IRCODE LIVETV\r")
 
-    def plus_one_off(self):
+    async def async_plus_one_off(self):
         if self.is_plus_one_channel(self._channel_id):
             channel_id = self.override_channel(self.get_sd_channel(self._channel_id))
-            self.select_source(self._channels[channel_id][CONF_NAME])
+            await self.async_select_source(self._channels[channel_id][CONF_NAME])
 
-    def plus_one_on(self):
+    async def async_plus_one_on(self):
+        if self._channel_id not in self._channels:
+            return
         plus_one = self._channels[self.get_sd_channel(self._channel_id)][CONF_PLUSONE]
         if plus_one:
             if self._channels[plus_one][CONF_HDCHANNEL]:
                 plus_one = self._channels[plus_one][CONF_HDCHANNEL]
 
-            self.select_source(self._channels[plus_one][CONF_NAME])
+            await self.async_select_source(self._channels[plus_one][CONF_NAME])
 
-    def search(self, cmd):
-        self.tivo_cmd("TELEPORT SEARCH\r")
-        time.sleep(0.5)
+    async def async_search(self, cmd):
+        # The Tivo doesn't acknowledge search or keyboard commands, so give it time to catch up
+        await self.async_tivo_cmd("TELEPORT SEARCH\r")
+        await asyncio.sleep(0.5)
         result = ""
         for character in cmd:
             char = character.replace(' ', 'SPACE')
             result += "KEYBOARD " + char + "\r"
 
         result += "KEYBOARD RIGHT\r"
-        self.tivo_cmd(result)
-        time.sleep(1)
-        self.tivo_cmd("KEYBOARD SELECT\r")
+        await self.async_tivo_cmd(result)
+        await asyncio.sleep(1)
+        await self.async_tivo_cmd("KEYBOARD SELECT\r")
 
-    def subtitles_off(self):
-        self.tivo_cmd("IRCODE CC_OFF\r")
+    async def async_subtitles_off(self):
+        await self.async_tivo_cmd("IRCODE CC_OFF\r")
 
-    def subtitles_on(self):
-        self.tivo_cmd("IRCODE CC_ON\r")
+    async def async_subtitles_on(self):
+        await self.async_tivo_cmd("IRCODE CC_ON\r")
 
-    def teleport(self, cmd):
-        self.tivo_cmd("TELEPORT " + cmd + "\r")
+    async def async_teleport(self, cmd):
+        await self.async_tivo_cmd("TELEPORT " + cmd + "\r")
 
     """Standard services"""
-    def media_previous_track(self):
+    async def async_media_previous_track(self):
         """Send previous track command."""
 
-        self.last_channel()
+        await self.async_last_channel()
 
-    def media_next_track(self):
+    async def async_media_next_track(self):
         """Send next track command."""
 
         if self.is_plus_one_channel(self._channel_id):
-            self.plus_one_off()
+            await self.async_plus_one_off()
         else:
-            self.plus_one_on()
+            await self.async_plus_one_on()
 
-    def media_play(self):
+    async def async_media_play(self):
         """Send play command."""
 
         cmd = "IRCODE PLAY\r"
-        self.tivo_cmd(cmd)
+        await self.async_tivo_cmd(cmd)
         self._state = STATE_PLAYING
         self._paused = False
+        self.async_write_state_if_changed()
 
-    def media_pause(self):
+    async def async_media_pause(self):
         """Send pause command."""
 
         cmd = "IRCODE PAUSE\r"
-        self.tivo_cmd(cmd)
+        await self.async_tivo_cmd(cmd)
         self._state = STATE_PAUSED
         self._paused = True
+        self.async_write_state_if_changed()
 
-    def media_stop(self):
+    async def async_media_stop(self):
         """Send stop command."""
 
         cmd = "IRCODE STOP\r"
-        self.tivo_cmd(cmd)
+        await self.async_tivo_cmd(cmd)
         self._state = STATE_PLAYING
         self._paused = False
+        self.async_write_state_if_changed()
 
-    def turn_on(self):
+    async def async_turn_on(self):
         """Turn the media player on."""
 
         if self._state == STATE_OFF:
-            self._turning_on = True
             cmd = "IRCODE STANDBY\r"
-            self.tivo_cmd(cmd)
-            time.sleep(0.5)
-            # self._state = STATE_UNKNOWN
-            self._turning_on = False
+            if await self._conn.async_send_and_wait(cmd, ACK_TIMEOUT) is None:
+                _LOGGER.debug("%s: no status received after waking", self._name)
 
-    def turn_off(self):
+    async def async_turn_off(self):
         """Turn the media player off."""
         if self._state in (STATE_PLAYING, STATE_PAUSED):
             self._turning_off = True
             cmd = "IRCODE STANDBY\rIRCODE STANDBY\r"
-            self.tivo_cmd(cmd)
             self._state = STATE_OFF
-            time.sleep(0.5)
-            self._turning_off = False
+            self.async_write_state_if_changed()
+            # Ignore any status sent while the Tivo goes into standby, it doesn't acknowledge going off
+            try:
+                await self.async_tivo_cmd(cmd)
+                await asyncio.sleep(0.5)
+            finally:
+                self._turning_off = False
 
     @property
     def source(self):
@@ -941,9 +907,9 @@ class VirginTivo(MediaPlayerEntity):
     @property
     def source_list(self):
         """List of available input channels."""
-        return self._channel_names
+        return self._lineup.source_list
 
-    def select_source(self, channel):
+    async def async_select_source(self, channel):
         """Set input channel."""
         if channel not in self._channel_name_id:
             if channel + " HD" not in self._channel_name_id:
@@ -951,368 +917,183 @@ class VirginTivo(MediaPlayerEntity):
             else:
                 channel = channel + " HD"
 
-        channel_id = self.override_channel(self._channel_name_id[channel])
-        self._last_screen_grab = 0
+        requested_id = self._channel_name_id[channel]
+        channel_id = self.override_channel(requested_id)
+        await self._async_tune(channel_id, forced_hd=channel_id != requested_id)
+
+    async def _async_tune(self, channel_id, forced_hd=False):
+        """Change channel and wait for the Tivo to confirm it."""
         _LOGGER.debug("%s: setting channel to [%d]", self._name, channel_id)
 
         # Broken by Virgin Tivo change
         # cmd = "SETCH " + str(channel_id) + "\r"
 
-        for digits in str(channel_id):
-            cmd = "IRCODE NUM" + digits + "\r"
-            self.tivo_cmd(cmd)
-
-class ChannelListing:
-    def __init__(self, channel_id, channel_name, package, is_hd, is_plus_one = False, base_name = ""):
-        self.channel_id = channel_id
-        self.channel_name = channel_name
-        self.package = package
-        self.is_hd = is_hd
-        self.is_plus_one = is_plus_one
-        self.base_name = base_name
-        self.show = ""
-        self.hd_ver = ""
-        self.plus_one_ver = ""
-        self.logo = ""
-        self.target = ""
-        self.source = ""
-
-
-def get_channel_listings(config, cfg_dir):
-    from bs4 import BeautifulSoup
-    import os
-
-    cache_file = os.path.join(cfg_dir, 'virgin_tivo.pickle')
-
-    def contains(this_cell, this_string):
-        if this_string in this_cell:
-            return True
-        else:
-            return False
+        cmd = "".join("IRCODE NUM" + digits + "\r" for digits in str(channel_id))
+        # Only the new channel or a failure confirms the change, not a status from reconnecting
+        ack = await self._conn.async_send_and_wait(
+            cmd, ACK_TIMEOUT, match=lambda event: event.kind == EVENT_FAILED or event.value == channel_id)
+        if forced_hd and ack is not None:
+            # Allow time to switch back to SD from when the HD channel appears
+            self._sdoverride['refresh_time'] = time.time() + SD_OVERRIDE_WINDOW
+        return ack
+
+
+def build_diagnostics(tivos, guide, client, channels, setup_time):
+    """Statistics for all the boxes, the guide and downloads"""
+    conns = [tivo.connection for tivo in tivos]
+    return {
+        "version": VERSION,
+        "setup_seconds": round(setup_time, 2),
+        "channels": len(channels),
+        "totals": {
+            "boxes": len(tivos),
+            "connected": sum(1 for conn in conns if conn.connected),
+            "reconnects": sum(conn.reconnects for conn in conns),
+            "resyncs": sum(conn.resyncs for conn in conns),
+            "bytes_received": sum(conn.bytes_received for conn in conns),
+            "bytes_sent": sum(conn.bytes_sent for conn in conns),
+            "ack_timeouts": sum(conn.ack_timeouts for conn in conns),
+            "command_rtt_ms": to_ms(combined_average([conn.rtt for conn in conns])),
+            "event_handling_ms": to_ms(combined_average([tivo.event_time for tivo in tivos])),
+            "suppressed_writes": sum(tivo.suppressed_writes for tivo in tivos),
+        },
+        "boxes": {tivo.name: tivo.diagnostics() for tivo in tivos},
+        "guide": guide.diagnostics(),
+        "http": {"downloads": client.downloads, "not_modified": client.not_modified},
+    }
+
+
+def write_diagnostics(path, diagnostics):
+    """Save the diagnostics as JSON"""
+    try:
+        with open(path, 'w') as diagnostics_file:
+            json.dump(diagnostics, diagnostics_file, indent=2, default=str)
+    except OSError as e:
+        _LOGGER.warning("Could not save diagnostics to %s [%s]", path, e)
 
-    def base_name(name):
-        return str(name).replace(" +1", "").replace(" ja vu", "").replace(" HD", "")
 
-    channel_listings = {}
-    vc_url = ""
+def lineup_settings_hash(config):
+    """Hash of the settings that shape the channels built from the channel list"""
+    return content_hash(json.dumps(
+        [config[CONF_CHANNEL_LIST], config.get(CONF_DEFAULTISSHOW), config.get(CONF_SHOW_PACKAGES)],
+        sort_keys=True, default=str))
+
 
+async def async_load_lineup(hass, config, client, lineup_cache):
+    """Get the channels from the channel list, reusing the cached lineup if nothing has changed"""
+    vc_url = config[CONF_CHANNEL_LIST][CONF_URL]
+    settings_hash = lineup_settings_hash(config)
     try:
-        all_channels = {}
-        ignore_channels = []
-        hide_channels = []
-        show_channels = []
-        logos = {}
-        targets = {}
-        sources = {}
+        res_text = await client.async_get(vc_url, conditional=True)
+        source_hash = content_hash(res_text)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        _LOGGER.error("Could not fetch channel listings from %s, error %s, trying cache", vc_url, str(e))
+        res_text = None
+        source_hash = None
+
+    channels = await hass.async_add_executor_job(lineup_cache.load, settings_hash, source_hash)
+    if channels is not None:
+        _LOGGER.info("Using cached automatic channel list")
+        return channels
+    if res_text is None:
+        _LOGGER.error("Could not load cached version")
+        return {}
+
+    if "csv" in vc_url:
+        channel_listings = await hass.async_add_executor_job(get_channel_listings_csv, config[CONF_CHANNEL_LIST],
+                                                             res_text)
+    else:
+        channel_listings = await hass.async_add_executor_job(get_channel_listings, config[CONF_CHANNEL_LIST],
+                                                             res_text)
+    if len(channel_listings) == 0:
+        return {}
 
-        # The URL for the TV channels page
-        vc_url = config[CONF_URL]
-        # Channels to ignore
-        if CONF_IGNORE_CHANNELS in config:
-            ignore_channels = str(config[CONF_IGNORE_CHANNELS]).split(',')
-        # Channels to be shown in drop down (when default_is_show = False)
-        if CONF_SHOW_CHANNELS in config:
-            show_channels = str(config[CONF_SHOW_CHANNELS]).split(',')
-        # Channels to be shown in drop down (when default_is_show = True)
-        if CONF_HIDE_CHANNELS in config:
-            hide_channels = str(config[CONF_HIDE_CHANNELS]).split(',')
-        # Channel logos
-        if CONF_LOGOS in config:
-            logos = config[CONF_LOGOS]
-        # Targets
-        if CONF_TARGETS in config:
-            targets = config[CONF_TARGETS]
-        # Sources
-        if CONF_SOURCES in config:
-            sources = config[CONF_SOURCES]
-        # Channel overrides
-        if CONF_OVERRIDE in config:
-            for channel_id, override_conf in config[CONF_OVERRIDE].items():
-                str_channel_id = str(channel_id)
-                channel_name = override_conf[CONF_NAME].strip()
-                channel_name = "'{}'".format(channel_name) if "&" in channel_name else channel_name
-                package = override_conf[CONF_PACKAGE].strip()
-                is_hd = override_conf[CONF_IS_HD]
-                ignore_channels.append(str_channel_id)
-                all_channels[str_channel_id] = ChannelListing(str_channel_id, channel_name, package, is_hd)
-                if "+1" in channel_name or "ja vu" in channel_name:
-                    all_channels[str_channel_id].is_plus_one = True
-                all_channels[str_channel_id].base_name = base_name(channel_name)
-
-        res = requests.get(vc_url)
-        res.raise_for_status()
-        soup = BeautifulSoup(res.text, "html.parser")
-
-        parsed = False
-        for table in soup.find_all(class_=["wikitable sortable"]):
-            header = True
-            headers = table.findAll(["th"])
-            if headers[0].get_text().strip() == "HD":
-                is_tv_table = True
-            elif headers[0].get_text().strip() == "SD":
-                is_tv_table = False
-            else:
-                _LOGGER.debug("Ignoring unknown table found in channel lists")
-                break
-            for row in table.findAll("tr"):
-                cells = row.findAll(["td"])
-                if len(cells) >= 6 and not header:
-                    if is_tv_table:  # TV Channels
-                        CELL_HD = 0
-                        CELL_SD = 1
-                        CELL_PLUSONE = 2
-                        CELL_CHANNELNAME = 3
-                        CELL_PACKAGEHD = 9
-                        CELL_PACKAGESD = 10
-                    else:  # Radio Channels
-                        CELL_HD = 0
-                        CELL_SD = 0
-                        CELL_PLUSONE = 0
-                        CELL_CHANNELNAME = 1
-                        CELL_PACKAGEHD = 7
-                        CELL_PACKAGESD = 7
-
-                    if cells[CELL_CHANNELNAME].find(text=True) is not None:
-                        channel_name = cells[CELL_CHANNELNAME].get_text().lstrip().split('\n')[0]
-                        channel_name = re.sub(' e$', '', channel_name)
-                        channel_name = "'{}'".format(channel_name) if "&" in channel_name else channel_name
-                        package = cells[CELL_PACKAGEHD].find(text=True).strip()
-                        if not package:
-                            package = cells[CELL_PACKAGESD].find(text=True).strip()
-
-                        channel_id = cells[CELL_HD].find(text=True).strip()
-                        parsed = True
-                        if is_tv_table and channel_id and channel_id not in ignore_channels:
-                            ignore_channels.append(channel_id)
-                            all_channels[channel_id] = ChannelListing(channel_id, channel_name + " HD", package, is_hd=True,
-                                                                      is_plus_one=False, base_name=channel_name)
-
-                        channel_id = cells[CELL_SD].find(text=True).strip()
-                        if channel_id and channel_id not in ignore_channels:
-                            ignore_channels.append(channel_id)
-                            all_channels[channel_id] = ChannelListing(channel_id, channel_name, package, is_hd=False,
-                                                                      is_plus_one=False, base_name=channel_name)
-
-                        channel_id = cells[CELL_PLUSONE].find(text=True).strip()
-                        if channel_id and channel_id not in ignore_channels:
-                            ignore_channels.append(channel_id)
-                            all_channels[channel_id] = ChannelListing(channel_id, channel_name + " +1", package, is_hd=False,
-                                                                      is_plus_one=True, base_name=channel_name)
-                else:
-                    header = False
-
-        if not parsed:
-            _LOGGER.error("Unable to load channels from [%s] code [%s], trying cache", str(vc_url), str(res.status_code))
-            try:
-                all_channels = pickle.load(open(cache_file, 'rb'))
-            except (OSError, IOError) as e:
-                _LOGGER.error("Could not load cached version")
-                raise
-        else:
-            _LOGGER.debug("Writing channels cache")
-            try:
-                pickle.dump(all_channels, open(cache_file, 'wb'))
-            except Exception as e:
-                _LOGGER.error("Could not create cached version, skipping: %s", str(e))
-
-        for channel in all_channels.values():
-            if not channel.is_hd and not channel.is_plus_one:
-                hd_id = next((hd_id for hd_id, hd_ch in all_channels.items()
-                              if hd_ch.base_name == channel.base_name and hd_ch.is_hd), None)
-                if hd_id is not None:
-                    channel.hd_ver = hd_id
-            if not channel.is_plus_one:
-                plus_one_id = next((plus_one_id for plus_one_id, plus_one_ch in all_channels.items()
-                                    if plus_one_ch.base_name == channel.base_name and plus_one_ch.is_plus_one), None)
-                if plus_one_id is not None:
-                    channel.plus_one_ver = plus_one_id
-
-        for channel_id in show_channels:
-            if channel_id in all_channels:
-                all_channels[channel_id].show = "true"
-
-        for channel_id in hide_channels:
-            if channel_id in all_channels:
-                all_channels[channel_id].show = "false"
-
-        for channel_id, logo_url in logos.items():
-            if str(channel_id) in all_channels:
-                all_channels[str(channel_id)].logo = logo_url
-
-        for channel_id, source_name in sources.items():
-            if str(channel_id) in all_channels:
-                all_channels[str(channel_id)].source = source_name
-
-        for channel_id, target_name in targets.items():
-            if str(channel_id) in all_channels:
-                all_channels[str(channel_id)].target = target_name
-
-        for channel_id, channel in sorted(all_channels.items()):
-            channel_listing = {
-                CONF_NAME: channel.channel_name,
-                CONF_LOGO: channel.logo if channel.logo != "" else "",
-                CONF_HDCHANNEL: int(channel.hd_ver) if channel.hd_ver != "" else 0,
-                CONF_PLUSONE: int(channel.plus_one_ver) if channel.plus_one_ver != "" else 0,
-                CONF_SHOW: channel.show if channel.show != "" else "UNSET",
-                CONF_TARGET: channel.target if channel.target != "" else "",
-                CONF_SOURCE: channel.source if channel.source != "" else "",
-                CONF_PACKAGE: channel.package if channel.package != "" else "UNSET",
-            }
+    _LOGGER.info("Using automatic channel list")
+    channels = resolve_channels(channel_listings, config)
+    await hass.async_add_executor_job(lineup_cache.save, settings_hash, source_hash, channels)
+    return channels
 
-            try:
-                channel_listings[int(channel_id)] = channel_listing
-            except:
-                _LOGGER.debug("unexpected channel_id: %s (%s)", channel_id, channel.channel_name)
 
-        _LOGGER.debug(str(channel_listings))
+async def async_load_lineup_file(hass, config):
+    """Get the channels from a lineup compiled by resources/virginchannels.py"""
+    path = hass.config.path(config[CONF_LINEUP_FILE])
+    try:
+        channel_listings = await hass.async_add_executor_job(read_lineup_file, path)
+    except (OSError, ValueError) as e:
+        _LOGGER.error("Could not load channel lineup from %s [%s]", path, str(e))
+        return {}
+    _LOGGER.info("Using channel lineup from %s", path)
+    return resolve_channels(channel_listings, config)
+
 
-    except Exception as e:
-        _LOGGER.error("Could not fetch channel listings from %s, error %s", vc_url, str(e))
+def resolve_channels(channel_listings, config):
+    """Work out the channels to use from a channel list"""
+    show_by_default = config.get(CONF_DEFAULTISSHOW) and config.get(CONF_SHOW_PACKAGES) == "UNSET"
+
+    channels = {}
+    for channel_id, entry in channel_listings.items():
+        show = entry[CONF_SHOW].lower()
+        channel_info = {
+            CONF_NAME: entry[CONF_NAME],
+            CONF_LOGO: entry[CONF_LOGO],
+            CONF_HDCHANNEL: entry[CONF_HDCHANNEL] if entry[CONF_HDCHANNEL] > 0 else None,
+            CONF_PLUSONE: entry[CONF_PLUSONE] if entry[CONF_PLUSONE] > 0 else None,
+            CONF_SHOW: (show_by_default or show == 'true' or entry[CONF_PACKAGE] in
+                        config.get(CONF_SHOW_PACKAGES).split(",")) and show != 'false',
+            CONF_TARGET: entry[CONF_TARGET],
+            CONF_SOURCE: entry[CONF_SOURCE],
+        }
+        channels[channel_id] = channel_info
+    return channels
 
-    return channel_listings
 
+def get_channel_listings(config, res_text):
+    """Build the channel listings from a tvchannellists.com page"""
+    return build_channel_listings(config, lambda all_channels, ignore_channels: add_html_channels(
+        res_text, all_channels, ignore_channels))
 
-def get_channel_listings_csv(config, cfg_dir):
-    import os
 
-    cache_file = os.path.join(cfg_dir, 'virgin_tivo_csv.pickle')
+def get_channel_listings_csv(config, res_text):
+    """Build the channel listings from a CSV channel list"""
+    return build_channel_listings(config, lambda all_channels, ignore_channels: add_csv_channels(
+        res_text, all_channels, ignore_channels, config[CONF_REGION]))
 
-    def base_name(name):
-        return str(name).replace(" +1", "").replace(" ja vu", "").replace(" HD", "")
 
+def build_channel_listings(config, add_channels):
+    """Build the channel listings using the tvchannellists settings, add_channels adds the listed channels"""
     channel_listings = {}
     vc_url = ""
 
     try:
         all_channels = {}
-        ignore_channels = []
-        hide_channels = []
-        show_channels = []
-        logos = {}
-        targets = {}
-        sources = {}
+        ignore_channels = set()
 
         # The URL for the TV channels page
         vc_url = config[CONF_URL]
-        # Region for channels
-        region = config[CONF_REGION]
         # Channels to ignore
         if CONF_IGNORE_CHANNELS in config:
-            ignore_channels = str(config[CONF_IGNORE_CHANNELS]).split(',')
-        # Channels to be shown in drop down (when default_is_show = False)
-        if CONF_SHOW_CHANNELS in config:
-            show_channels = str(config[CONF_SHOW_CHANNELS]).split(',')
-        # Channels to be shown in drop down (when default_is_show = True)
-        if CONF_HIDE_CHANNELS in config:
-            hide_channels = str(config[CONF_HIDE_CHANNELS]).split(',')
-        # Channel logos
-        if CONF_LOGOS in config:
-            logos = config[CONF_LOGOS]
-        # Targets
-        if CONF_TARGETS in config:
-            targets = config[CONF_TARGETS]
-        # Sources
-        if CONF_SOURCES in config:
-            sources = config[CONF_SOURCES]
+            ignore_channels = set(str(config[CONF_IGNORE_CHANNELS]).split(','))
         # Channel overrides
         if CONF_OVERRIDE in config:
-            for channel_id, override_conf in config[CONF_OVERRIDE].items():
-                str_channel_id = str(channel_id)
-                channel_name = override_conf[CONF_NAME].strip()
-                channel_name = "'{}'".format(channel_name) if "&" in channel_name else channel_name
-                package = override_conf[CONF_PACKAGE].strip()
-                is_hd = override_conf[CONF_IS_HD]
-                ignore_channels.append(str_channel_id)
-                all_channels[str_channel_id] = ChannelListing(str_channel_id, channel_name, package, is_hd)
-                if "+1" in channel_name or "ja vu" in channel_name:
-                    all_channels[str_channel_id].is_plus_one = True
-                all_channels[str_channel_id].base_name = base_name(channel_name)
-
-        try:
-            res = requests.get(vc_url)
-            res.raise_for_status()
-            res_text = res.text
-        except Exception as e:
-            _LOGGER.error("Could not fetch channel listings from %s, error %s, trying cache", vc_url, str(e))
-            try:
-                res_text = pickle.load(open(cache_file, 'rb'))
-            except (OSError, IOError) as e:
-                _LOGGER.error("Could not load cached version")
-                raise
-
-        _LOGGER.debug("Writing channels cache")
-        try:
-            pickle.dump(res_text, open(cache_file, 'wb'))
-        except Exception as e:
-            _LOGGER.error("Could not create cached version, skipping: %s", str(e))
-
-        for row in res_text.splitlines():
-            items = row.split(',')
-            if items[0] == "ID":
-                continue
-            str_channel_id = items[0]
-            channel_no = re.match(r'\d+', str_channel_id)[0]
-            if channel_no != str_channel_id:
-                channel_region = str_channel_id[len(channel_no):]
-                if region not in channel_region:
-                    continue
-            channel_name = items[1]
-            package = items[2]
-            is_hd = ("HD" in channel_name)
-            is_plus_one = ("+1" in channel_name)
-            if channel_no not in all_channels and channel_no not in ignore_channels:
-                all_channels[channel_no] = ChannelListing(channel_no, channel_name, package, is_hd, is_plus_one, base_name(channel_name))
-
-        for channel in all_channels.values():
-            if not channel.is_hd and not channel.is_plus_one:
-                hd_id = next((hd_id for hd_id, hd_ch in all_channels.items()
-                              if hd_ch.base_name == channel.base_name and hd_ch.is_hd), None)
-                if hd_id is not None:
-                    channel.hd_ver = hd_id
-            if not channel.is_plus_one:
-                plus_one_id = next((plus_one_id for plus_one_id, plus_one_ch in all_channels.items()
-                                    if plus_one_ch.base_name == channel.base_name and plus_one_ch.is_plus_one), None)
-                if plus_one_id is not None:
-                    channel.plus_one_ver = plus_one_id
-
-        for channel_id in show_channels:
-            if channel_id in all_channels:
-                all_channels[channel_id].show = "true"
-
-        for channel_id in hide_channels:
-            if channel_id in all_channels:
-                all_channels[channel_id].show = "false"
-
-        for channel_id, logo_url in logos.items():
-            if str(channel_id) in all_channels:
-                all_channels[str(channel_id)].logo = logo_url
-
-        for channel_id, source_name in sources.items():
-            if str(channel_id) in all_channels:
-                all_channels[str(channel_id)].source = source_name
-
-        for channel_id, target_name in targets.items():
-            if str(channel_id) in all_channels:
-                all_channels[str(channel_id)].target = target_name
-
-        for channel_id, channel in sorted(all_channels.items()):
-            channel_listing = {
-                CONF_NAME: channel.channel_name,
-                CONF_LOGO: channel.logo if channel.logo != "" else "",
-                CONF_HDCHANNEL: int(channel.hd_ver) if channel.hd_ver != "" else 0,
-                CONF_PLUSONE: int(channel.plus_one_ver) if channel.plus_one_ver != "" else 0,
-                CONF_SHOW: channel.show if channel.show != "" else "UNSET",
-                CONF_TARGET: channel.target if channel.target != "" else "",
-                CONF_SOURCE: channel.source if channel.source != "" else "",
-                CONF_PACKAGE: channel.package if channel.package != "" else "UNSET",
-            }
+            add_override_channels({channel_id: (override_conf[CONF_NAME], override_conf[CONF_PACKAGE],
+                                                override_conf[CONF_IS_HD])
+                                   for channel_id, override_conf in config[CONF_OVERRIDE].items()},
+                                  all_channels, ignore_channels)
 
-            try:
-                channel_listings[int(channel_id)] = channel_listing
-            except:
-                _LOGGER.debug("unexpected channel_id: %s (%s)", channel_id, channel.channel_name)
+        if not add_channels(all_channels, ignore_channels):
+            _LOGGER.error("Unable to load channels from [%s]", str(vc_url))
+            return channel_listings
+
+        pair_channels(all_channels)
+
+        # Channels to be shown in drop down (when default_is_show = False), or hidden (when default_is_show = True)
+        set_channel_options(all_channels,
+                            str(config[CONF_SHOW_CHANNELS]).split(',') if CONF_SHOW_CHANNELS in config else (),
+                            str(config[CONF_HIDE_CHANNELS]).split(',') if CONF_HIDE_CHANNELS in config else (),
+                            config.get(CONF_LOGOS), config.get(CONF_TARGETS), config.get(CONF_SOURCES))
 
-        _LOGGER.debug(str(channel_listings))
+        channel_listings = to_channel_listings(all_channels)
+        _LOGGER.debug("%s", channel_listings)
 
     except Exception as e:
         _LOGGER.error("Could not fetch channel listings from %s, error %s", vc_url, str(e))
@@ -0,0 +1,51 @@
+"""
+Timing statistics for the Virgin Tivo component
+
+Kept cheap enough to record on every status line and command.
+"""
+
+
+class Timing:
+    """Count, total, last and longest of a repeated measurement in seconds."""
+
+    __slots__ = ('count', 'total', 'last', 'longest')
+
+    def __init__(self):
+        """Initialize with nothing recorded."""
+        self.count = 0
+        self.total = 0.0
+        self.last = None
+        self.longest = 0.0
+
+    def record(self, seconds):
+        """Add one measurement"""
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        if seconds > self.longest:
+            self.longest = seconds
+
+    @property
+    def average(self):
+        """Mean of the measurements, None if there are none"""
+        return self.total / self.count if self.count else None
+
+    def as_dict(self):
+        """The statistics in milliseconds"""
+        return {
+            "count": self.count,
+            "avg_ms": to_ms(self.average),
+            "last_ms": to_ms(self.last),
+            "max_ms": to_ms(self.longest) if self.count else None,
+        }
+
+
+def to_ms(seconds):
+    """Seconds as milliseconds rounded for display, None stays None"""
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def combined_average(timings):
+    """Mean over several Timings weighted by their counts, None if nothing was recorded"""
+    count = sum(timing.count for timing in timings)
+    return sum(timing.total for timing in timings) / count if count else None
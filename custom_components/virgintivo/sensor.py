@@ -0,0 +1,103 @@
+"""
+Sensors for the Virgin Tivo component's statistics
+
+Add under sensor: with platform: virgintivo once the media_player platform
+is set up.  The values come from the same statistics as the
+media_player.virgintivo_diagnostics service.
+"""
+import logging
+
+import voluptuous as vol
+
+try:
+    from homeassistant.components.sensor import SensorEntity
+except ImportError:
+    from homeassistant.helpers.entity import Entity
+
+    class SensorEntity(Entity):
+        """Older cores without SensorEntity read state and unit_of_measurement."""
+
+        @property
+        def state(self):
+            return self.native_value
+
+        @property
+        def unit_of_measurement(self):
+            return self.native_unit_of_measurement
+
+from homeassistant.components.sensor import PLATFORM_SCHEMA
+from homeassistant.const import CONF_MONITORED_CONDITIONS
+import homeassistant.helpers.config_validation as cv
+
+from .media_player import DATA_DIAGNOSTICS
+
+_LOGGER = logging.getLogger(__name__)
+
+# Sensor type: (name, unit, section of the diagnostics, key)
+SENSOR_TYPES = {
+    'connected': ("Virgin Tivo connected boxes", None, 'totals', 'connected'),
+    'reconnects': ("Virgin Tivo reconnects", None, 'totals', 'reconnects'),
+    'bytes_received': ("Virgin Tivo bytes received", 'B', 'totals', 'bytes_received'),
+    'command_rtt': ("Virgin Tivo command round trip", 'ms', 'totals', 'command_rtt_ms'),
+    'event_handling': ("Virgin Tivo status handling time", 'ms', 'totals', 'event_handling_ms'),
+    'suppressed_writes': ("Virgin Tivo suppressed state writes", None, 'totals', 'suppressed_writes'),
+    'guide_hit_rate': ("Virgin Tivo guide cache hit rate", '%', 'guide', 'hit_rate'),
+    'guide_fetch_time': ("Virgin Tivo guide fetch time", 'ms', 'guide', 'fetch_time'),
+}
+
+PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
+    vol.Optional(CONF_MONITORED_CONDITIONS, default=list(SENSOR_TYPES)): vol.All(cv.ensure_list,
+                                                                               [vol.In(SENSOR_TYPES)]),
+})
+
+
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
+    """Set up the Virgin Tivo statistics sensors."""
+    async_add_entities([VirginTivoSensor(sensor_type) for sensor_type in config[CONF_MONITORED_CONDITIONS]])
+
+
+def sensor_value(diagnostics, sensor_type):
+    """Pick a sensor's value out of the diagnostics"""
+    _, _, section, key = SENSOR_TYPES[sensor_type]
+    value = diagnostics[section][key]
+    if sensor_type == 'guide_hit_rate' and value is not None:
+        return round(value * 100, 1)
+    if sensor_type == 'guide_fetch_time':
+        return value['avg_ms']
+    return value
+
+
+class VirginTivoSensor(SensorEntity):
+    """One of the Virgin Tivo statistics, read when Home Assistant polls."""
+
+    def __init__(self, sensor_type):
+        """Initialize the sensor."""
+        self._type = sensor_type
+        self._name, self._unit = SENSOR_TYPES[sensor_type][:2]
+        self._state = None
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def native_value(self):
+        """Return the value of the statistic."""
+        return self._state
+
+    @property
+    def native_unit_of_measurement(self):
+        """Return the unit of the statistic."""
+        return self._unit
+
+    @property
+    def available(self):
+        """Return True once the media_player platform is running."""
+        return DATA_DIAGNOSTICS in self.hass.data
+
+    async def async_update(self):
+        """Read the statistic."""
+        collect_diagnostics = self.hass.data.get(DATA_DIAGNOSTICS)
+        if collect_diagnostics is not None:
+            self._state = sensor_value(collect_diagnostics(), self._type)
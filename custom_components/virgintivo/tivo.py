@@ -0,0 +1,547 @@
+"""
+Tivo remote protocol support for the Virgin Tivo boxes
+
+The Tivo sends '\\r' terminated status lines on port 31339, e.g.
+CH_STATUS 0101 LOCAL or CH_FAILED NO_LIVE.
+
+All the connections are looked after by one TivoSupervisor.  Reading and
+writing are done by the event loop's transports and timeouts by its timers,
+so the only tasks are the supervisor's fixed pool of connect workers,
+however many boxes there are.
+"""
+import asyncio
+import itertools
+import logging
+import random
+import socket
+import time
+from collections import namedtuple
+
+from .metrics import Timing
+
+_LOGGER = logging.getLogger(__name__)
+
+TIVO_PORT = 31339
+SOCKET_TIMEOUT = 1
+IDLE_TIMEOUT = 60
+KEEPALIVE_IDLE = 10
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+ACK_TIMEOUT = 3
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+BACKOFF_JITTER = 0.5
+CONNECT_WORKERS = 8
+UNHEALTHY_FAILURES = 3
+MAX_LINE_LENGTH = 1024
+LINE_END = b'\r'
+
+EVENT_STATUS = 'CH_STATUS'
+EVENT_FAILED = 'CH_FAILED'
+EVENT_UNKNOWN = 'UNKNOWN'
+
+TivoEvent = namedtuple('TivoEvent', ['kind', 'value', 'line'])
+
+
+def parse_line(line):
+    """Turn a single status line into an event"""
+    text = line.decode(errors='replace').strip()
+    parts = text.split()
+    if len(parts) >= 2 and parts[0] == EVENT_STATUS and parts[1].isdigit():
+        return TivoEvent(EVENT_STATUS, int(parts[1]), text)
+    if parts and parts[0] == EVENT_FAILED:
+        return TivoEvent(EVENT_FAILED, parts[1] if len(parts) > 1 else "", text)
+    return TivoEvent(EVENT_UNKNOWN, None, text)
+
+
+class TivoParser:
+    """Incremental parser for the Tivo response stream."""
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        """Initialize an empty buffer."""
+        self._buffer = bytearray()
+        self._max_line_length = max_line_length
+
+    def reset(self):
+        """Discard any partial line, e.g. after reconnecting."""
+        self._buffer.clear()
+
+    def feed(self, data):
+        """Add received bytes and return the events for all complete lines"""
+        buffer = self._buffer
+        buffer += data
+        events = []
+        start = 0
+        while True:
+            end = buffer.find(LINE_END, start)
+            if end < 0:
+                break
+            if end > start:
+                line = bytes(buffer[start:end])
+                if line.strip():
+                    events.append(parse_line(line))
+            start = end + 1
+        if start:
+            del buffer[:start]
+        if len(buffer) > self._max_line_length:
+            _LOGGER.debug("Discarding %d bytes without line end", len(buffer))
+            buffer.clear()
+        return events
+
+
+def is_ack(event):
+    """Return True if the event confirms a command, i.e. a channel status or failure"""
+    return event.kind in (EVENT_STATUS, EVENT_FAILED)
+
+
+def set_keepalive(sock):
+    """Have the OS probe an idle connection, so a box that has gone away is noticed without reconnecting"""
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, KEEPALIVE_IDLE)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, KEEPALIVE_INTERVAL)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, KEEPALIVE_COUNT)
+    except OSError as e:
+        _LOGGER.debug("Unable to set TCP keepalive [%s]", str(e))
+
+
+def latest_status(events):
+    """Return the most recent channel status in a list of events"""
+    for event in reversed(events):
+        if event.kind == EVENT_STATUS:
+            return event
+    return None
+
+
+class TivoSupervisor:
+    """Opens and reopens the connections to all the Tivo boxes.
+
+    Connections waiting to be opened are queued for a fixed pool of workers,
+    ones needed to send a command first.  Together with the jittered backoff
+    this spreads out the reconnects when many boxes drop at once.
+    """
+
+    def __init__(self, workers=CONNECT_WORKERS):
+        """Initialize the supervisor, the workers start with the first connection."""
+        self._worker_count = workers
+        self._workers = []
+        self._queue = None
+        self._connections = []
+        self._order = itertools.count()
+
+    @property
+    def connections(self):
+        """Return the supervised connections."""
+        return list(self._connections)
+
+    def health(self):
+        """Return the health of every connection by name"""
+        return {conn.name: conn.health for conn in self._connections}
+
+    def add(self, conn, loop):
+        """Look after a connection and start opening it."""
+        if not self._workers:
+            self._queue = asyncio.PriorityQueue()
+            self._workers = [loop.create_task(self._async_worker()) for _ in range(self._worker_count)]
+        self._connections.append(conn)
+
+    def remove(self, conn):
+        """Stop looking after a connection, stopping the workers with the last one."""
+        if conn in self._connections:
+            self._connections.remove(conn)
+        if not self._connections:
+            for worker in self._workers:
+                worker.cancel()
+            self._workers = []
+
+    def queue_connect(self, conn, urgent=False):
+        """Queue a connection to be opened by the next free worker."""
+        self._queue.put_nowait((0 if urgent else 1, next(self._order), conn))
+
+    async def _async_worker(self):
+        while True:
+            _, _, conn = await self._queue.get()
+            if conn.wants_connect:
+                await conn.async_open()
+
+
+class TivoProtocol(asyncio.Protocol):
+    """Passes what happens on one transport to its connection."""
+
+    def __init__(self, conn):
+        """Initialize the protocol for conn."""
+        self._conn = conn
+
+    def connection_made(self, transport):
+        self._conn.connection_made(self, transport)
+
+    def data_received(self, data):
+        self._conn.data_received(self, data)
+
+    def connection_lost(self, exc):
+        self._conn.connection_lost(self, exc)
+
+    def pause_writing(self):
+        self._conn.pause_writing(self)
+
+    def resume_writing(self):
+        self._conn.resume_writing(self)
+
+
+class TivoConnection:
+    """Persistent connection to a Tivo box, opened and reopened by a TivoSupervisor.
+
+    The status lines are passed to on_events as they arrive, and on_standby
+    is called when the box does not report a status after connecting.
+    Commands sent in the same pass of the event loop go in one write.  TCP
+    keepalive notices a dead connection, and after idle_timeout seconds of
+    quiet the connection is reopened to check whether the box is in standby.
+    """
+
+    def __init__(self, host, port=TIVO_PORT, name=None, supervisor=None, idle_timeout=IDLE_TIMEOUT):
+        """Initialize the connection, call start() to open it."""
+        self.host = host
+        self.port = port
+        self.name = name or host
+        self.idle_timeout = idle_timeout
+        self.on_events = None
+        self.on_standby = None
+        self._supervisor = supervisor
+        self._loop = None
+        self._running = False
+        self._transport = None
+        self._protocol = None
+        self._parser = TivoParser()
+        self._pending = []
+        self._pending_waiters = []
+        self._flush_handle = None
+        self._write_paused = False
+        self._drain_waiters = []
+        self._drain_timer = None
+        self._waiters = []
+        self._timer = None
+        self._connect_waiter = None
+        self._connecting = False
+        self._reconnect_handle = None
+        self._backoff = MIN_BACKOFF
+        self._error_logged = False
+        self._resyncing = False
+        self.failures = 0
+        self.connects = 0
+        self.resyncs = 0
+        self.last_error = None
+        self.last_received = None
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.ack_timeouts = 0
+        self.rtt = Timing()
+
+    @property
+    def connected(self):
+        """Return True if the connection is open."""
+        return self._transport is not None
+
+    @property
+    def wants_connect(self):
+        """Return True if a connect has been queued and is not already being tried."""
+        return self._connect_waiter is not None and not self._connect_waiter.done() and not self._connecting \
+            and self._transport is None
+
+    @property
+    def reconnects(self):
+        """Return the number of times the connection has been reopened after dropping, not counting resyncs."""
+        return max(0, self.connects - 1)
+
+    @property
+    def health(self):
+        """Return the state of the connection and its statistics."""
+        return {
+            'connected': self.connected,
+            'failures': self.failures,
+            'reconnects': self.reconnects,
+            'resyncs': self.resyncs,
+            'last_error': self.last_error,
+            'last_received': self.last_received,
+            'bytes_received': self.bytes_received,
+            'bytes_sent': self.bytes_sent,
+            'ack_timeouts': self.ack_timeouts,
+            'command_rtt': self.rtt.as_dict(),
+        }
+
+    def start(self, loop):
+        """Start opening the connection, keeping it open until stopped."""
+        if self._supervisor is None:
+            self._supervisor = TivoSupervisor(workers=1)
+        self._loop = loop
+        self._running = True
+        self._supervisor.add(self, loop)
+        self._request_connect()
+
+    async def async_stop(self):
+        """Close the connection and stop reopening it."""
+        self._running = False
+        if self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+            self._reconnect_handle = None
+        self.disconnect()
+        self._resolve_connect(False)
+        if self._supervisor is not None:
+            self._supervisor.remove(self)
+
+    async def async_send(self, cmd):
+        """Queue a command and wait until it has been written, returns False on failure"""
+        if not await self.async_connect():
+            _LOGGER.warning("%s: cannot send command when not connected", self.name)
+            return False
+        waiter = self._loop.create_future()
+        self._pending.append(cmd.encode())
+        self._pending_waiters.append(waiter)
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_soon(self._flush)
+        return await waiter
+
+    async def async_send_and_wait(self, cmd, timeout=ACK_TIMEOUT, match=is_ack):
+        """Send a command and wait for the Tivo to acknowledge it
+
+        Returns the first event accepted by match, or None if nothing arrives
+        within the timeout or the command could not be sent.
+        """
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        entry = (match, waiter)
+        self._waiters.append(entry)
+        start = loop.time()
+        try:
+            if not await self.async_send(cmd):
+                return None
+            event = await asyncio.wait_for(waiter, timeout)
+            self.rtt.record(loop.time() - start)
+            return event
+        except asyncio.TimeoutError:
+            _LOGGER.debug("%s: no acknowledgement within %s seconds", self.name, timeout)
+            self.ack_timeouts += 1
+            return None
+        finally:
+            self._waiters.remove(entry)
+
+    async def async_connect(self):
+        """Open the connection now if it is not already open, returns False on failure"""
+        if self._transport is not None:
+            return True
+        if not self._running:
+            return False
+        if self._reconnect_handle is not None:
+            self._reconnect_handle.cancel()
+            self._reconnect_handle = None
+        waiter = self._request_connect(urgent=True)
+        return await asyncio.shield(waiter)
+
+    def disconnect(self):
+        """Close the connection, it is reopened after the backoff."""
+        self._drop()
+
+    async def async_open(self):
+        """Try to open the connection, called by the supervisor's workers."""
+        if not self.wants_connect:
+            return
+        self._connecting = True
+        try:
+            _LOGGER.debug("%s: connecting to [%s]", self.name, self.host)
+            await asyncio.wait_for(
+                self._loop.create_connection(lambda: TivoProtocol(self), self.host, self.port), SOCKET_TIMEOUT)
+        except asyncio.TimeoutError:
+            _LOGGER.debug("%s: socket timeout in 'connect'", self.name)
+            self._connect_failed("connect timed out")
+            self._notify_standby()
+        except OSError as e:
+            self._connect_failed(str(e))
+            self._log_error(e)
+        finally:
+            self._connecting = False
+        self._resolve_connect(self._transport is not None)
+        if self._transport is None and self._running:
+            self._schedule_reconnect()
+
+    def connection_made(self, protocol, transport):
+        """The supervisor opened the connection."""
+        if not self._running or self._transport is not None:
+            transport.close()
+            return
+        _LOGGER.debug("%s: connected OK", self.name)
+        set_keepalive(transport.get_extra_info('socket'))
+        self._transport = transport
+        self._protocol = protocol
+        self._write_paused = False
+        self._parser.reset()
+        self._backoff = MIN_BACKOFF
+        if self.failures >= UNHEALTHY_FAILURES:
+            _LOGGER.info("%s: reconnected after %d failed attempts", self.name, self.failures)
+        self.failures = 0
+        if self._resyncing:
+            self.resyncs += 1
+            self._resyncing = False
+        else:
+            self.connects += 1
+        # The Tivo reports its status as soon as we connect unless it is in standby
+        self._set_timer(SOCKET_TIMEOUT, self._status_timeout)
+        self._resolve_connect(True)
+
+    def data_received(self, protocol, data):
+        """Pass on the events in data from the Tivo."""
+        if protocol is not self._protocol:
+            return
+        self._set_timer(self.idle_timeout, self._idle_timeout)
+        self._error_logged = False
+        self.last_received = time.time()
+        self.bytes_received += len(data)
+        _LOGGER.debug("%s: response data [%s]", self.name, data)
+        events = self._parser.feed(data)
+        self._resolve_waiters(events)
+        if self.on_events:
+            try:
+                self.on_events(events)
+            except Exception as e:
+                _LOGGER.error("%s: unexpected error handling status [%s]", self.name, str(e))
+
+    def connection_lost(self, protocol, exc):
+        """The connection was closed by the Tivo or failed."""
+        if protocol is not self._protocol:
+            return
+        error = exc or ConnectionResetError("connection closed by Tivo")
+        self.last_error = str(error)
+        self._log_error(error)
+        self._drop()
+
+    def pause_writing(self, protocol):
+        if protocol is self._protocol:
+            self._write_paused = True
+
+    def resume_writing(self, protocol):
+        if protocol is self._protocol:
+            self._write_paused = False
+            self._resolve_drain(True)
+
+    def _request_connect(self, urgent=False):
+        """Queue a connect with the supervisor, returning a future for the result"""
+        if self._connect_waiter is None or self._connect_waiter.done():
+            self._connect_waiter = self._loop.create_future()
+            self._supervisor.queue_connect(self, urgent)
+        elif urgent and not self._connecting:
+            # Move it up the queue, whichever entry a worker reaches first opens it
+            self._supervisor.queue_connect(self, urgent)
+        return self._connect_waiter
+
+    def _resolve_connect(self, result):
+        if self._connect_waiter is not None and not self._connect_waiter.done():
+            self._connect_waiter.set_result(result)
+
+    def _connect_failed(self, error):
+        # Count the connect that finally succeeds as a reconnect if a resync fails
+        self._resyncing = False
+        self.failures += 1
+        self.last_error = error
+        if self.failures == UNHEALTHY_FAILURES:
+            _LOGGER.warning("%s: unreachable after %d attempts, still retrying", self.name, self.failures)
+
+    def _schedule_reconnect(self, delay=None):
+        """Queue a connect after the backoff, with jitter so boxes dropped together don't all retry together"""
+        if self._reconnect_handle is not None or self.wants_connect:
+            return
+        if delay is None:
+            delay = self._backoff * random.uniform(1 - BACKOFF_JITTER, 1 + BACKOFF_JITTER)
+            self._backoff = min(self._backoff * 2, MAX_BACKOFF)
+        _LOGGER.debug("%s: reconnecting in %.1f seconds", self.name, delay)
+        self._reconnect_handle = self._loop.call_later(delay, self._reconnect)
+
+    def _reconnect(self):
+        self._reconnect_handle = None
+        if self._running and self._transport is None:
+            self._request_connect()
+
+    def _drop(self, resync=False):
+        """Forget the current transport, failing anything waiting on it, and arrange to reconnect."""
+        transport = self._transport
+        self._transport = None
+        self._protocol = None
+        self._set_timer(None)
+        self._resolve_drain(False)
+        if transport is None:
+            return
+        self._resyncing = resync
+        _LOGGER.debug("%s: disconnecting from [%s]", self.name, self.host)
+        transport.close()
+        if self._running:
+            self._schedule_reconnect(0 if resync else None)
+
+    def _flush(self):
+        """Write everything queued since the last write in one go."""
+        self._flush_handle = None
+        data = b''.join(self._pending)
+        waiters = self._pending_waiters
+        self._pending = []
+        self._pending_waiters = []
+        if self._transport is None:
+            _LOGGER.warning("%s: cannot send command when not connected", self.name)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(False)
+            return
+        _LOGGER.debug("%s: sending request [%s]", self.name, data)
+        self._transport.write(data)
+        self.bytes_sent += len(data)
+        self._drain_waiters.extend(waiters)
+        if not self._write_paused:
+            self._resolve_drain(True)
+        elif self._drain_timer is None:
+            self._drain_timer = self._loop.call_later(SOCKET_TIMEOUT, self._drain_timeout)
+
+    def _drain_timeout(self):
+        self._drain_timer = None
+        _LOGGER.warning("%s: connection timed out", self.name)
+        self._drop()
+
+    def _resolve_drain(self, result):
+        if self._drain_timer is not None:
+            self._drain_timer.cancel()
+            self._drain_timer = None
+        waiters = self._drain_waiters
+        self._drain_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(result)
+
+    def _set_timer(self, delay, callback=None):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._loop.call_later(delay, callback) if delay is not None else None
+
+    def _status_timeout(self):
+        _LOGGER.debug("%s: no status received, assuming standby", self.name)
+        self._notify_standby()
+        self._set_timer(self.idle_timeout, self._idle_timeout)
+
+    def _idle_timeout(self):
+        self._timer = None
+        _LOGGER.debug("%s: nothing received for %d seconds, reconnecting", self.name, self.idle_timeout)
+        self._drop(resync=True)
+
+    def _resolve_waiters(self, events):
+        """Wake any commands waiting for an acknowledgement."""
+        for match, waiter in self._waiters:
+            if not waiter.done():
+                event = next((event for event in events if match(event)), None)
+                if event is not None:
+                    waiter.set_result(event)
+
+    def _notify_standby(self):
+        if self.on_standby:
+            self.on_standby()
+
+    def _log_error(self, error):
+        if not self._error_logged:
+            _LOGGER.warning("%s: %s, will retry", self.name, str(error))
+            self._error_logged = True
+        _LOGGER.debug("%s: general socket error in 'connect'", self.name)
@@ -0,0 +1,447 @@
+"""
+Benchmarks for the Virgin Tivo component
+
+Usage: python3 benchmark.py pairing [--sizes 1000,10000,50000]
+       python3 benchmark.py memory [--channels 300] [--hours 72]
+       python3 benchmark.py html [--file ../channels.html]
+       python3 benchmark.py graph [--file ../channels/channels.csv] [--region E]
+       python3 benchmark.py tivo [--boxes 1,10,100] [--changes 20] [--delay 0] [--drop 0] [--partial]
+"""
+import argparse
+import asyncio
+import functools
+import logging
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+RESOURCES_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(RESOURCES_DIR, '..', 'custom_components'))
+from virgintivo.channel_list import (ChannelListing, Lineup, add_csv_channels, add_html_channels, pair_channels,
+                                     to_channel_listings)
+from virgintivo.guide import add_listing, new_channel_listings
+from virgintivo.tivo import EVENT_FAILED, EVENT_STATUS, TivoConnection, TivoSupervisor
+from tivo_simulator import SimulatorThread
+
+
+def synthetic_lineup(size):
+    """Build a lineup of SD, HD and +1 channels with plenty of shared base names"""
+    all_channels = {}
+    for channel_no in range(1, size + 1):
+        base_name = "Channel {}".format(channel_no // 3)
+        kind = channel_no % 3
+        if kind == 0:
+            channel = ChannelListing(str(channel_no), base_name, "Mix", False, False, base_name)
+        elif kind == 1:
+            channel = ChannelListing(str(channel_no), base_name + " HD", "Mix", True, False, base_name)
+        else:
+            channel = ChannelListing(str(channel_no), base_name + " +1", "Mix", False, True, base_name)
+        all_channels[str(channel_no)] = channel
+    return all_channels
+
+
+def synthetic_listings(station_no, hours):
+    """Build listings[] items as returned by the guide API, half hour programmes with repeated titles"""
+    start = int(time.time()) * 1000
+    listings = []
+    for prog_no in range(hours * 2):
+        program = {
+            "title": "Programme {}".format(prog_no % 12),
+            "description": "Episode {} of a programme on station {}".format(prog_no, station_no),
+            "medium": "TV",
+            "seriesNumber": "1",
+            "seriesEpisodeNumber": str(prog_no),
+        }
+        listings.append({
+            "startTime": start + prog_no * 1800000,
+            "endTime": start + (prog_no + 1) * 1800000,
+            "stationId": "station-{}".format(station_no),
+            "program": program,
+        })
+    return listings
+
+
+def add_listing_dict(prog_channel, listing, station_id, plus_one=False):
+    """Programmes as they were cached before, one dict with datetimes per programme"""
+    program = listing["program"]
+    prog_start_time = datetime.fromtimestamp(listing["startTime"] / 1000)
+    prog_end_time = datetime.fromtimestamp(listing["endTime"] / 1000)
+    prog_channel["listings"].append({
+        "title": program["title"],
+        "description": program["description"],
+        "id": listing["stationId"],
+        "start_time": prog_start_time,
+        "end_time": prog_end_time,
+        "duration": prog_end_time - prog_start_time,
+        "prog_type": program["medium"],
+        "prog_episode_title": None,
+        "prog_episode_number": program["seriesEpisodeNumber"],
+        "prog_series_number": program["seriesNumber"],
+    })
+    prog_channel["start_times"].append(listing["startTime"] / 1000)
+    prog_channel["end_times"].append(listing["endTime"] / 1000)
+
+
+def allocated(func, *args):
+    """Memory still allocated by whatever func returns"""
+    tracemalloc.start()
+    result = func(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def bench_pairing(args):
+    print("{:>8} {:>12} {:>14}".format("channels", "total ms", "us/channel"))
+    for size in args.sizes:
+        all_channels = synthetic_lineup(size)
+        elapsed = min(timed(pair_channels, all_channels) for _ in range(args.repeat))
+        print("{:>8} {:>12.2f} {:>14.3f}".format(size, elapsed * 1000, elapsed / size * 1e6))
+
+
+def bench_memory(args):
+    # The decoded JSON is freed as it is parsed, so don't count it
+    all_listings = [synthetic_listings(station_no, args.hours) for station_no in range(args.channels)]
+    programmes = sum(len(listings) for listings in all_listings)
+
+    def build_guide(add):
+        guide = {}
+        for station_no, listings in enumerate(all_listings):
+            prog_channel = {"listings": [], "start_times": [], "end_times": []} \
+                if add is add_listing_dict else new_channel_listings()
+            prog_channel["next_refresh"] = datetime.now()
+            for listing in listings:
+                add(prog_channel, copy_listing(listing), "station-{}".format(station_no))
+            guide[station_no] = prog_channel
+        return guide
+
+    def build_channels(listing_class):
+        return {str(channel_no): listing_class(str(channel_no), "Channel {}".format(channel_no), "Mix", False)
+                for channel_no in range(args.channels)}
+
+    plain_listing = type('PlainChannelListing', (), {'__init__': ChannelListing.__init__})
+    print("{:>10} {:>8} {:>12} {:>12}".format("", "count", "before B", "after B"))
+    print("{:>10} {:>8} {:>12.0f} {:>12.0f}".format(
+        "programme", programmes, allocated(build_guide, add_listing_dict) / programmes,
+        allocated(build_guide, add_listing) / programmes))
+    print("{:>10} {:>8} {:>12.0f} {:>12.0f}".format(
+        "channel", args.channels, allocated(build_channels, plain_listing) / args.channels,
+        allocated(build_channels, ChannelListing) / args.channels))
+
+
+def copy_listing(listing):
+    """Fresh strings for each programme, as if just decoded from the response"""
+    program = {key: "".join(value) if isinstance(value, str) else value for key, value in listing["program"].items()}
+    return dict(listing, stationId="".join(listing["stationId"]), program=program)
+
+
+def add_html_channels_bs4(text, all_channels, ignore_channels):
+    """The channel table scraping as it was done with BeautifulSoup"""
+    from bs4 import BeautifulSoup
+
+    parsed = False
+    for table in BeautifulSoup(text, "html.parser").find_all(class_=["wikitable sortable"]):
+        header = True
+        headers = table.find_all(["th"])
+        if headers[0].get_text().strip() == "HD":
+            cells_no = (0, 1, 2, 3, 9, 10)
+        elif headers[0].get_text().strip() == "SD":
+            cells_no = (0, 0, 0, 1, 7, 7)
+        else:
+            break
+        is_tv_table = cells_no[0] != cells_no[1]
+        cell_hd, cell_sd, cell_plus_one, cell_name, cell_package_hd, cell_package_sd = cells_no
+        for row in table.find_all("tr"):
+            cells = row.find_all(["td"])
+            if len(cells) >= 6 and not header:
+                if cells[cell_name].find(string=True) is not None:
+                    channel_name = cells[cell_name].get_text().lstrip().split('\n')[0]
+                    channel_name = re.sub(' e$', '', channel_name)
+                    channel_name = "'{}'".format(channel_name) if "&" in channel_name else channel_name
+                    package = cells[cell_package_hd].find(string=True).strip()
+                    if not package:
+                        package = cells[cell_package_sd].find(string=True).strip()
+                    parsed = True
+                    versions = [(cell_sd, channel_name, False, False),
+                                (cell_plus_one, channel_name + " +1", False, True)]
+                    if is_tv_table:
+                        versions.insert(0, (cell_hd, channel_name + " HD", True, False))
+                    for cell_no, name, is_hd, is_plus_one in versions:
+                        channel_id = cells[cell_no].find(string=True).strip()
+                        if channel_id and channel_id not in ignore_channels:
+                            ignore_channels.append(channel_id)
+                            all_channels[channel_id] = ChannelListing(channel_id, name, package, is_hd, is_plus_one,
+                                                                      channel_name)
+            else:
+                header = False
+    return parsed
+
+
+def bench_html(args):
+    with open(args.file) as html_file:
+        text = html_file.read()
+    print("{:>14} {:>10} {:>12}".format("parser", "channels", "total ms"))
+    parsers = [("html.parser", add_html_channels, set)]
+    try:
+        import bs4  # noqa: F401
+        parsers.insert(0, ("BeautifulSoup", add_html_channels_bs4, list))
+    except ImportError:
+        print("BeautifulSoup is not installed, only timing the current parser")
+    for name, parse, ignore_type in parsers:
+        all_channels = {}
+        parse(text, all_channels, ignore_type())
+        elapsed = min(timed(parse, text, {}, ignore_type()) for _ in range(args.repeat))
+        print("{:>14} {:>10} {:>12.2f}".format(name, len(all_channels), elapsed * 1000))
+
+
+def csv_lineup(path, region):
+    """The lineup from a CSV channel list, resolved as the component does"""
+    with open(path, encoding='utf-8') as csv_file:
+        text = csv_file.read()
+    all_channels = {}
+    add_csv_channels(text, all_channels, set(), region)
+    pair_channels(all_channels)
+    return Lineup({channel_id: dict(entry, hd_channel=entry['hd_channel'] or None, plus_one=entry['plus_one'] or None,
+                                    show=entry['show'] != 'false')
+                   for channel_id, entry in to_channel_listings(all_channels).items()})
+
+
+def scan_sd_channel(channels, channel_id):
+    """get_sd_channel as it was, scanning every channel"""
+    sd_channel = channel_id
+    for key, channel in channels.items():
+        if channel['hd_channel'] == sd_channel:
+            sd_channel = key
+
+    for key, channel in channels.items():
+        if channel['plus_one'] == sd_channel:
+            sd_channel = key
+
+    return sd_channel
+
+
+def scan_is_plus_one(channels, channel_id):
+    """is_plus_one_channel as it was, scanning every channel"""
+    for key, channel in channels.items():
+        if channel['plus_one'] == channel_id:
+            return True
+
+    return False
+
+
+def scan_related_channels(channels, channel_id):
+    """get_related_channels as it was, scanning every channel"""
+    related_channels = {channel_id}
+    base_channel_name = channels[channel_id]['name'].replace(' HD', '')
+    for key, channel in channels.items():
+        if channel['hd_channel'] == channel_id or channel['plus_one'] == channel_id \
+                or channel['name'].replace(' HD', '').replace(' +1', '') == base_channel_name:
+            related_channels.add(key)
+    return related_channels
+
+
+def bench_graph(args):
+    lineup = csv_lineup(args.file, args.region)
+    channels = dict(lineup.channels)
+    graph = lineup.graph
+    channel_ids = list(channels)
+    lookups = [
+        ("sd_channel", scan_sd_channel, graph.sd_channel),
+        ("is_plus_one", scan_is_plus_one, graph.is_plus_one),
+        ("related", scan_related_channels, graph.related_channels),
+    ]
+
+    def lookup_all(lookup):
+        for channel_id in channel_ids:
+            lookup(channel_id)
+
+    print("{} channels from {}".format(len(channels), args.file))
+    print("{:>12} {:>10} {:>10} {:>8}".format("lookup", "scan us", "graph us", "differ"))
+    for name, scan, lookup in lookups:
+        scan_lookup = functools.partial(scan, channels)
+        # Where the SD and HD versions share a +1 channel the graph picks the SD one, the scan whichever is last
+        differ = sum(1 for channel_id in channel_ids if scan_lookup(channel_id) != lookup(channel_id))
+        scan_time = min(timed(lookup_all, scan_lookup) for _ in range(args.repeat))
+        graph_time = min(timed(lookup_all, lookup) for _ in range(args.repeat))
+        print("{:>12} {:>10.2f} {:>10.3f} {:>8}".format(
+            name, scan_time / len(channel_ids) * 1e6, graph_time / len(channel_ids) * 1e6, differ))
+
+
+def percentile(values, fraction):
+    """Value below which the fraction of values fall, None if there are none"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def format_ms(seconds):
+    return "{:.1f}".format(seconds * 1000) if seconds is not None else "-"
+
+
+class StatusWatcher:
+    """Collects the channel status events from a connection and the time spent handling them"""
+
+    def __init__(self, conn):
+        self.events = 0
+        self.handling = 0
+        self._status = None
+        conn.on_events = self.handle_events
+
+    def expect_status(self):
+        """Future for the next channel status"""
+        self._status = asyncio.get_running_loop().create_future()
+        return self._status
+
+    def handle_events(self, events):
+        # Stands in for VirginTivo._handle_events
+        start = time.thread_time()
+        self.events += len(events)
+        if self._status is not None and not self._status.done():
+            if any(event.kind == EVENT_STATUS for event in events):
+                self._status.set_result(time.perf_counter())
+        self.handling += time.thread_time() - start
+
+
+async def async_wait_statuses(futures, start, timeout):
+    """Seconds from start until each status arrived, leaving out any that didn't"""
+    done, _ = await asyncio.wait(futures, timeout=timeout)
+    return [future.result() - start for future in done]
+
+
+async def async_bench_tivo(simulator, args):
+    """Connect, change channels and reconnect on every box, returns the measurements"""
+    boxes = len(simulator.tivos)
+    supervisor = TivoSupervisor()
+    conns = [TivoConnection('127.0.0.1', tivo.port, "Tivo {}".format(box_no), supervisor)
+             for box_no, tivo in enumerate(simulator.tivos)]
+    watchers = [StatusWatcher(conn) for conn in conns]
+    loop = asyncio.get_running_loop()
+    result = {}
+
+    # Connect, the boxes report their channel straight away
+    statuses = [watcher.expect_status() for watcher in watchers]
+    start = time.perf_counter()
+    for conn in conns:
+        conn.start(loop)
+    connected = await async_wait_statuses(statuses, start, args.timeout)
+    result['connect'] = percentile(connected, 0.5)
+
+    # Change channel on every box at once, the way the component sends it
+    rng = random.Random(0)
+    latencies = []
+    failed = 0
+    cpu_start = time.thread_time()
+    events_start = sum(watcher.events for watcher in watchers)
+
+    async def async_change(conn):
+        channel = rng.randint(101, 999)
+        cmd = "".join("IRCODE NUM" + digits + "\r" for digits in str(channel))
+        change_start = time.perf_counter()
+        ack = await conn.async_send_and_wait(
+            cmd, match=lambda event: event.kind == EVENT_FAILED or event.value == channel)
+        if ack is None or ack.kind != EVENT_STATUS:
+            return None
+        return time.perf_counter() - change_start
+
+    for _ in range(args.changes):
+        for latency in await asyncio.gather(*(async_change(conn) for conn in conns)):
+            if latency is None:
+                failed += 1
+            else:
+                latencies.append(latency)
+    cpu = time.thread_time() - cpu_start
+    events = sum(watcher.events for watcher in watchers) - events_start
+    result['p50'] = percentile(latencies, 0.5)
+    result['p95'] = percentile(latencies, 0.95)
+    result['failed'] = failed
+    result['cpu_per_box'] = cpu / boxes
+    result['status_cost'] = sum(watcher.handling for watcher in watchers) / events if events else None
+
+    # Drop every connection and time how long until each box reports its channel again
+    statuses = [watcher.expect_status() for watcher in watchers]
+    start = time.perf_counter()
+    simulator.call(async_drop_all(simulator.tivos))
+    reconnected = await async_wait_statuses(statuses, start, args.timeout)
+    result['reconnect'] = percentile(reconnected, 0.5)
+    result['missing'] = (boxes - len(connected)) + (boxes - len(reconnected))
+
+    for conn in conns:
+        await conn.async_stop()
+    return result
+
+
+async def async_drop_all(tivos):
+    for tivo in tivos:
+        await tivo.async_drop_connections()
+
+
+def bench_tivo(args):
+    # Expected reconnections and timeouts would otherwise be logged for every box
+    logging.basicConfig(level=logging.ERROR)
+    print("{:>6} {:>11} {:>10} {:>10} {:>7} {:>13} {:>10} {:>13} {:>8}".format(
+        "boxes", "connect ms", "p50 ms", "p95 ms", "failed", "reconnect ms", "status us", "cpu ms/box", "missing"))
+    for boxes in args.boxes:
+        simulator = SimulatorThread(boxes, delay=args.delay, drop_rate=args.drop, partial=args.partial, seed=0)
+        simulator.start()
+        try:
+            result = asyncio.run(async_bench_tivo(simulator, args))
+        finally:
+            simulator.stop()
+        status_cost = "{:.1f}".format(result['status_cost'] * 1e6) if result['status_cost'] is not None else "-"
+        print("{:>6} {:>11} {:>10} {:>10} {:>7} {:>13} {:>10} {:>13.2f} {:>8}".format(
+            boxes, format_ms(result['connect']), format_ms(result['p50']), format_ms(result['p95']),
+            result['failed'], format_ms(result['reconnect']), status_cost, result['cpu_per_box'] * 1000,
+            result['missing']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement, best is reported")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    pairing = subparsers.add_parser('pairing', help="HD/+1 pairing of the channel list")
+    pairing.add_argument('--sizes', type=lambda v: [int(size) for size in v.split(',')],
+                         default=[1000, 10000, 50000])
+    pairing.set_defaults(func=bench_pairing)
+
+    memory = subparsers.add_parser('memory', help="bytes per cached programme and channel")
+    memory.add_argument('--channels', type=int, default=300)
+    memory.add_argument('--hours', type=int, default=72, help="hours of listings per channel")
+    memory.set_defaults(func=bench_memory)
+
+    html = subparsers.add_parser('html', help="scraping the channel tables from a tvchannellists.com page")
+    html.add_argument('--file', default=os.path.join(RESOURCES_DIR, '..', 'channels.html'))
+    html.set_defaults(func=bench_html)
+
+    graph = subparsers.add_parser('graph', help="SD, +1 and related channel lookups against scanning the channels")
+    graph.add_argument('--file', default=os.path.join(RESOURCES_DIR, '..', 'channels', 'channels.csv'))
+    graph.add_argument('--region', default="E", help="region of the CSV channel list")
+    graph.set_defaults(func=bench_graph)
+
+    tivo = subparsers.add_parser('tivo', help="channel changes and reconnects against simulated Tivo boxes")
+    tivo.add_argument('--boxes', type=lambda v: [int(size) for size in v.split(',')], default=[1, 10, 100])
+    tivo.add_argument('--changes', type=int, default=20, help="channel changes per box")
+    tivo.add_argument('--delay', type=float, default=0, help="seconds before each simulated response")
+    tivo.add_argument('--drop', type=float, default=0, help="chance of each simulated response being lost")
+    tivo.add_argument('--partial', action='store_true', help="simulated responses are written in two pieces")
+    tivo.add_argument('--timeout', type=float, default=10, help="seconds to wait for boxes to (re)connect")
+    tivo.set_defaults(func=bench_tivo)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,256 @@
+"""
+Fake Tivo boxes speaking the Tivo remote protocol
+
+Each box listens on its own port and answers like a Virgin Tivo: it reports
+CH_STATUS on connect unless in standby, tunes after IRCODE NUMn digits or
+SETCH, goes into standby after two STANDBY codes in a row and wakes after
+one, handles CHANNELUP/DOWN and LIVETV, and accepts KEYBOARD and TELEPORT
+commands.  Responses can be delayed, dropped or written in pieces
+to see how the component copes.
+
+Usage: python3 tivo_simulator.py [--boxes 1] [--host 127.0.0.1] [--port 31339]
+                                 [--delay 0] [--drop 0] [--partial]
+
+The component always connects on port 31339, so to run several boxes for
+Home Assistant start one simulator per address, e.g. --host 127.0.0.2.
+"""
+import argparse
+import asyncio
+import random
+import threading
+
+TIVO_PORT = 31339
+DEFAULT_CHANNEL = 101
+DIGIT_TIMEOUT = 0.01
+MAX_DIGITS = 4
+PARTIAL_GAP = 0.001
+LINE_END = b'\r'
+
+
+class FakeTivo:
+    """One simulated Tivo box.
+
+    delay is the seconds before each response is written, drop_rate the
+    chance a response is lost, and with partial set each response is
+    written in pieces.  Only channels in channels can be tuned, any channel
+    if it is None.
+    """
+
+    def __init__(self, channel=DEFAULT_CHANNEL, channels=None, delay=0, drop_rate=0, partial=False, seed=None):
+        """Initialize the box, call async_start() to listen."""
+        self.channel = channel
+        self.channels = set(channels) if channels is not None else None
+        self.delay = delay
+        self.drop_rate = drop_rate
+        self.partial = partial
+        self.standby = False
+        self._standby_pressed = False
+        self.port = None
+        self.commands = 0
+        self.responses = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._server = None
+        self._clients = {}
+        self._digits = ""
+        self._tune_timer = None
+
+    async def async_start(self, host='127.0.0.1', port=0):
+        """Listen for connections, port 0 picks a free port."""
+        self._server = await asyncio.start_server(self._async_handle_client, host, port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def async_stop(self):
+        """Stop listening and close every connection."""
+        self._server.close()
+        await self.async_drop_connections()
+        await self._server.wait_closed()
+
+    async def async_drop_connections(self):
+        """Close every connection, as when the box reboots or the network drops."""
+        for writer in list(self._clients):
+            writer.close()
+        self._clients.clear()
+
+    async def _async_handle_client(self, reader, writer):
+        self._clients[writer] = asyncio.Lock()
+        if not self.standby:
+            self._respond(self._status())
+        buffer = b''
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+                buffer += data
+                *lines, buffer = buffer.split(LINE_END)
+                for line in lines:
+                    if line.strip():
+                        self.commands += 1
+                        self._handle_command(line.decode(errors='replace').strip())
+        except OSError:
+            pass
+        finally:
+            if self._clients.pop(writer, None) is not None:
+                writer.close()
+
+    def _handle_command(self, command):
+        parts = command.upper().split()
+        kind = parts[0]
+        arg = parts[1] if len(parts) > 1 else ""
+        # The first STANDBY only asks for confirmation, anything else cancels it
+        standby_pressed, self._standby_pressed = self._standby_pressed, False
+        if kind == 'IRCODE':
+            if arg.startswith('NUM') and arg[3:].isdigit():
+                self._add_digit(arg[3:])
+            elif arg == 'STANDBY':
+                if self.standby:
+                    self.standby = False
+                    self._respond(self._status())
+                elif standby_pressed:
+                    self.standby = True
+                else:
+                    self._standby_pressed = True
+            elif arg in ('CHANNELUP', 'CHANNELDOWN'):
+                self._tune(self._next_channel(1 if arg == 'CHANNELUP' else -1))
+            elif arg == 'LIVETV':
+                self._respond(self._status())
+        elif kind == 'SETCH' and arg.isdigit():
+            self._tune(int(arg))
+        elif kind == 'TELEPORT' and arg == 'LIVETV':
+            self._respond(self._status())
+
+    def _add_digit(self, digit):
+        """Tune once the digits stop arriving, as the box does"""
+        self._digits += digit
+        if self._tune_timer is not None:
+            self._tune_timer.cancel()
+        if len(self._digits) >= MAX_DIGITS:
+            self._tune_digits()
+        else:
+            self._tune_timer = asyncio.get_running_loop().call_later(DIGIT_TIMEOUT, self._tune_digits)
+
+    def _tune_digits(self):
+        self._tune_timer = None
+        digits, self._digits = self._digits, ""
+        self._tune(int(digits))
+
+    def _tune(self, channel):
+        if self.standby:
+            self._respond("CH_FAILED NO_LIVE")
+        elif self.channels is not None and channel not in self.channels:
+            self._respond("CH_FAILED INVALID_CHANNEL")
+        else:
+            self.channel = channel
+            self._respond(self._status())
+
+    def _next_channel(self, step):
+        if self.channels is None:
+            return max(1, self.channel + step)
+        channels = sorted(self.channels)
+        index = channels.index(self.channel) if self.channel in channels else 0
+        return channels[(index + step) % len(channels)]
+
+    def _status(self):
+        return "CH_STATUS {:04d} LOCAL".format(self.channel)
+
+    def _respond(self, line):
+        """Send a line to every connection"""
+        data = line.encode() + LINE_END
+        for writer, lock in self._clients.items():
+            if self._random.random() < self.drop_rate:
+                self.dropped += 1
+                continue
+            asyncio.get_running_loop().create_task(self._async_write(writer, lock, data))
+
+    async def _async_write(self, writer, lock, data):
+        async with lock:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            pieces = [data]
+            if self.partial and len(data) > 1:
+                split = self._random.randint(1, len(data) - 1)
+                pieces = [data[:split], data[split:]]
+            try:
+                for piece in pieces:
+                    if writer.is_closing():
+                        return
+                    writer.write(piece)
+                    await writer.drain()
+                    if len(pieces) > 1:
+                        await asyncio.sleep(PARTIAL_GAP)
+                self.responses += 1
+            except OSError:
+                pass
+
+
+async def async_start_boxes(count, host='127.0.0.1', port=0, **options):
+    """Start count boxes on consecutive ports from port, or on free ports if port is 0"""
+    tivos = []
+    for box_no in range(count):
+        tivo = FakeTivo(**options)
+        await tivo.async_start(host, port + box_no if port else 0)
+        tivos.append(tivo)
+    return tivos
+
+
+class SimulatorThread(threading.Thread):
+    """Boxes running on their own event loop, so they don't share a thread with what is being measured."""
+
+    def __init__(self, count, **options):
+        """Initialize the thread, the boxes are started by start()."""
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.tivos = []
+        self._count = count
+        self._options = options
+        self._ready = threading.Event()
+
+    def start(self):
+        """Start the thread and wait until the boxes are listening."""
+        super().start()
+        self._ready.wait()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.tivos = self.loop.run_until_complete(async_start_boxes(self._count, **self._options))
+        self._ready.set()
+        self.loop.run_forever()
+
+    def call(self, coro):
+        """Run a coroutine on the simulator loop and return its result"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def stop(self):
+        """Stop the boxes and the thread."""
+        for tivo in self.tivos:
+            self.call(tivo.async_stop())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+        self.loop.close()
+
+
+async def async_main(args):
+    tivos = await async_start_boxes(args.boxes, args.host, args.port, delay=args.delay, drop_rate=args.drop,
+                                    partial=args.partial)
+    for tivo in tivos:
+        print("Fake Tivo listening on {}:{}".format(args.host, tivo.port))
+    await asyncio.Event().wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--boxes', type=int, default=1, help="boxes to run, on consecutive ports")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=TIVO_PORT)
+    parser.add_argument('--delay', type=float, default=0, help="seconds before each response")
+    parser.add_argument('--drop', type=float, default=0, help="chance of each response being lost")
+    parser.add_argument('--partial', action='store_true', help="write each response in two pieces")
+    try:
+        asyncio.run(async_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,118 +1,140 @@
-import requests
-from bs4 import BeautifulSoup
-
-from virginchannels_config import *
-
-
-class Channel:
-    def __init__(self, channel_id, channel_name, package, is_hd):
-        self.channel_id = channel_id
-        self.channel_name = channel_name
-        self.package = package
-        self.is_hd = is_hd
-        self.is_plus_one = False
-        self.base_name = ""
-        self.show = ""
-        self.hd_ver = ""
-        self.plus_one_ver = ""
-        self.logo = ""
-        self.target = ""
-        self.source = ""
-
-
-def contains(this_cell, this_string):
-    if this_string in this_cell:
-        return True
+"""
+Channel lineup compiler for the Virgin Tivo component
+
+Builds the channels from the tvchannellists.com page or a CSV channel list,
+using the same parsing and pairing as the component, and writes them as
+YAML for the configuration and/or as a lineup file the component loads with
+its lineup_file setting.
+
+Usage: python3 virginchannels.py [source] [--yaml virgintivo.yaml] [--lineup virgin_tivo_channels.json]
+
+source is a URL or a local .csv or .html file, vc_url from the settings by default.
+"""
+import argparse
+import os
+import runpy
+import sys
+import time
+
+RESOURCES_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(RESOURCES_DIR, '..', 'custom_components', 'virgintivo'))
+from channel_list import (add_csv_channels, add_html_channels, add_override_channels, content_hash, pair_channels,
+                          set_channel_options, to_channel_listings, write_lineup_file)
+
+# Settings not given in the settings file
+DEFAULT_SETTINGS = {
+    'region': "E",
+    'ignore_ids': [],
+    'show_channels': [],
+    'hide_channels': [],
+    'logos': {},
+    'targets': {},
+    'sources': {},
+    'override': {},
+    'top_of_config': "",
+}
+
+# Order of the settings for each channel in the YAML, settings with these values are left out
+YAML_DEFAULTS = {
+    'name': None,
+    'show': "UNSET",
+    'package': None,
+    'hd_channel': 0,
+    'plus_one': 0,
+    'logo': "",
+    'target': "",
+    'source': "",
+}
+
+
+def read_source(source):
+    """The channel list text from a URL or a local file"""
+    if source.startswith(('http://', 'https://')):
+        import requests
+
+        res = requests.get(source, timeout=30)
+        res.raise_for_status()
+        return res.text
+    with open(source, encoding='utf-8') as source_file:
+        return source_file.read()
+
+
+def parse_source(source, text, settings):
+    """The channels from the channel list and overrides, with the ids in the settings ignored"""
+    all_channels = {}
+    ignore_channels = set(str(channel_id) for channel_id in settings['ignore_ids'])
+    add_override_channels(settings['override'], all_channels, ignore_channels)
+    if "csv" in source.lower():
+        parsed = add_csv_channels(text, all_channels, ignore_channels, settings['region'])
     else:
-        return False
-
-
-def base_name(channel_name):
-    return str(channel_name).replace(" +1", "").replace(" ja vu", "").replace(" HD", "")
-
-
-res = requests.get(vc_url)
-soup = BeautifulSoup(res.text, "html.parser")
-
-all_channels = {}
-
-for channel_id, channel_details in override.items():
-    if channel_id not in ignore_ids:
-        channel_name = channel_details[0].strip()
-        channel_name = "'{}'".format(channel_name) if "&" in channel_name else channel_name
-        package = channel_details[1].strip()
-        is_hd = channel_details[2]
-        ignore_ids.append(channel_id)
-        all_channels[channel_id] = Channel(channel_id, channel_name, package, is_hd)
-        if "+1" in channel_name or "ja vu" in channel_name:
-            all_channels[channel_id].is_plus_one = True
-        if base_name(channel_name) != channel_name:
-            all_channels[channel_id].base_name = base_name(channel_name)
-
-for table in soup.find_all(class_=["wikitable sortable"]):
-    for row in table.findAll("tr"):
-        cells = row.findAll(["td"])
-        if len(cells) >= 6:
-            if cells[1].find(text=True).strip() == "Local TV":
-                cells[5] = BeautifulSoup("Player", "html.parser")
-                cells[6] = BeautifulSoup("SDTV", "html.parser")
-            if cells[6].find(text=True) is not None:
-                channel_id = cells[0].find(text=True).strip()
-                if channel_id not in ignore_ids:
-                    channel_name = cells[1].find(text=True).split('/')[0].strip()
-                    channel_name = "'{}'".format(channel_name) if "&" in channel_name else channel_name
-                    package = cells[5].find(text=True).strip()
-                    is_hd = contains(cells[6].find(text=True), "HDTV")
-                    ignore_ids.append(channel_id)
-                    all_channels[channel_id] = Channel(channel_id, channel_name, package, is_hd)
-                    if "+1" in channel_name or "ja vu" in channel_name:
-                        all_channels[channel_id].is_plus_one = True
-                    all_channels[channel_id].base_name = base_name(channel_name)
-
-for channel in all_channels.values():
-    if not channel.is_hd and not channel.is_plus_one:
-        hd_id = next((hd_id for hd_id, hd_ch in all_channels.items()
-                      if hd_ch.base_name == channel.base_name and hd_ch.is_hd), None)
-        if hd_id is not None:
-            channel.hd_ver = hd_id
-    if not channel.is_plus_one:
-        plus_one_id = next((plus_one_id for plus_one_id, plus_one_ch in all_channels.items()
-                            if plus_one_ch.base_name == channel.base_name and plus_one_ch.is_plus_one), None)
-        if plus_one_id is not None:
-            channel.plus_one_ver = plus_one_id
-
-for channel_id in show_channels:
-    if channel_id in all_channels:
-        all_channels[channel_id].show = "true"
-
-for channel_id in hide_channels:
-    if channel_id in all_channels:
-        all_channels[channel_id].show = "false"
-
-for channel_id, logo_url in logos.items():
-    if channel_id in all_channels:
-        all_channels[channel_id].logo = logo_url
-
-for channel_id, source_name in sources.items():
-    if channel_id in all_channels:
-        all_channels[channel_id].source = source_name
-
-for channel_id, target_name in targets.items():
-    if channel_id in all_channels:
-        all_channels[channel_id].target = target_name
-
-entry = "    channels:\n"
-for channel_id, channel in sorted(all_channels.items()):
-    entry += "      {}:\n".format(channel.channel_id)
-    entry += "        name: {}\n".format(channel.channel_name)
-    entry += "        show: {}\n".format(channel.show) if channel.show != "" else ""
-    entry += "        package: {}\n".format(channel.package)
-    entry += "        hd_channel: {}\n".format(channel.hd_ver) if channel.hd_ver != "" else ""
-    entry += "        plus_one: {}\n".format(channel.plus_one_ver) if channel.plus_one_ver != "" else ""
-    entry += "        logo: {}\n".format(channel.logo) if channel.logo != "" else ""
-    entry += "        target: {}\n".format(channel.target) if channel.target != "" else ""
-    entry += "        source: {}\n".format(channel.source) if channel.source != "" else ""
-
-with open(config_filename, 'w') as f:
-    print(top_of_config, file=f)
-    print(entry, file=f)
+        parsed = add_html_channels(text, all_channels, ignore_channels)
+    if not parsed:
+        raise ValueError("no channels found in {}".format(source))
+    return all_channels
+
+
+def channels_yaml(channel_listings, top_of_config=""):
+    """The channels section of the configuration"""
+    lines = [top_of_config] if top_of_config else []
+    lines.append("    channels:")
+    for channel_no, channel in channel_listings.items():
+        lines.append("      {}:".format(channel_no))
+        for key, default in YAML_DEFAULTS.items():
+            if channel[key] != default:
+                lines.append("        {}: {}".format(key, channel[key]))
+    return "\n".join(lines) + "\n"
+
+
+def write_text(path, text):
+    """Replace a file with text"""
+    with open(path, 'w') as output_file:
+        output_file.write(text)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('source', nargs='?', help="URL or local .csv/.html channel list, vc_url by default")
+    parser.add_argument('--settings', default=os.path.join(RESOURCES_DIR, 'virginchannels_config.py'),
+                        help="settings file, see virginchannels_config.py")
+    parser.add_argument('--yaml', help="YAML output, config_filename from the settings by default")
+    parser.add_argument('--lineup', help="lineup file for the lineup_file setting of the component")
+    parser.add_argument('--region', help="region for a CSV channel list, e.g. E")
+    args = parser.parse_args()
+
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({key: value for key, value in runpy.run_path(args.settings).items() if not key.startswith('_')})
+    if args.region:
+        settings['region'] = args.region
+    source = args.source or settings['vc_url']
+    # With no outputs given write the YAML, as before
+    yaml_file = args.yaml
+    if not yaml_file and not args.lineup:
+        yaml_file = settings['config_filename']
+
+    stages = []
+
+    def stage(name, func, *func_args):
+        start = time.perf_counter()
+        result = func(*func_args)
+        stages.append((name, time.perf_counter() - start))
+        return result
+
+    text = stage("read", read_source, source)
+    all_channels = stage("parse", parse_source, source, text, settings)
+    stage("pair", pair_channels, all_channels)
+    stage("options", set_channel_options, all_channels, settings['show_channels'], settings['hide_channels'],
+          settings['logos'], settings['targets'], settings['sources'])
+    channel_listings = stage("listings", to_channel_listings, all_channels)
+    if yaml_file:
+        stage("yaml", lambda: write_text(yaml_file, channels_yaml(channel_listings, settings['top_of_config'])))
+    if args.lineup:
+        stage("lineup", write_lineup_file, args.lineup, channel_listings, content_hash(text))
+
+    print("{} channels from {}".format(len(channel_listings), source), file=sys.stderr)
+    for name, elapsed in stages:
+        print("{:>10} {:>10.2f} ms".format(name, elapsed * 1000), file=sys.stderr)
+    print("{:>10} {:>10.2f} ms".format("total", sum(elapsed for _, elapsed in stages) * 1000), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
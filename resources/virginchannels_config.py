@@ -2,6 +2,8 @@
 vc_url = "https://www.tvchannellists.com/List_of_channels_on_Virgin_Media_(UK)"
 # Configuration filename
 config_filename = "virgintivo.yaml"
+# Region for a CSV channel list
+region = "E"
 
 # Channels to ignore
 ignore_ids = ["0"]
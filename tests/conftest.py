@@ -0,0 +1,7 @@
+"""Make the component importable as virgintivo and the simulator as tivo_simulator"""
+import os
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT_DIR, 'custom_components'))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'resources'))
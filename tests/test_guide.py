@@ -0,0 +1,168 @@
+"""Tests for the guide cache: +1 lookups, shared downloads, eviction and the SQLite store"""
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from virgintivo.channel_list import ChannelGraph
+from virgintivo.guide import (GUIDE_STORE_VERSION, PLUS_ONE_OFFSET, Guide, GuideStore, Programme, find_listing,
+                              new_channel_listings)
+
+# BBC One with its HD and +1 versions sharing station 1, and BBC Two on station 2
+GRAPH = ChannelGraph({101: "BBC One", 108: "BBC One HD", 201: "BBC One +1", 102: "BBC Two", 103: "ITV"},
+                     {101: 108}, {101: 201})
+STATIONS = {101: "station-1", 102: "station-2", 103: "station-3"}
+
+
+def guide_channel(channel_number, station_id):
+    return {"channelNumber": channel_number, "stationSchedules": [{"station": {
+        "id": station_id, "title": "Station {}".format(channel_number),
+        "images": [{"assetType": "imageStream", "url": "https://grab/{}".format(station_id)}]}}]}
+
+
+def guide_listings(station_id, count=2):
+    """count half hour programmes from now, the last starting in the future"""
+    now = int(time.time())
+    return [{"startTime": (now + slot * 1800) * 1000, "endTime": (now + (slot + 1) * 1800) * 1000,
+             "stationId": station_id, "program": {"title": "{} {}".format(station_id, slot), "medium": "TV"}}
+            for slot in range(count)]
+
+
+class FakeClient:
+    """Serves the guide documents, counting downloads and optionally holding them until released"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.downloads = []
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def async_iter_items(self, url, key, headers=None, conditional=False):
+        self.downloads.append(key)
+        if self.fail:
+            raise OSError("guide unavailable")
+        await self.release.wait()
+        if key == 'channels':
+            items = [guide_channel(channel, station) for channel, station in STATIONS.items()]
+        else:
+            items = guide_listings(url.split('byStationId=')[1].split('&')[0])
+        for item in items:
+            yield item
+
+
+def sample_listings(start, *lengths):
+    """Listings with programmes of the given lengths back to back from start"""
+    channel_listings = new_channel_listings()
+    for number, length in enumerate(lengths):
+        prog = Programme(start, start + length, "Programme {}".format(number), "", "station-1", "TV")
+        channel_listings["listings"].append(prog)
+        channel_listings["start_times"].append(prog.start)
+        channel_listings["end_times"].append(prog.end)
+        start += length
+    return channel_listings
+
+
+def test_find_listing_plus_one_boundary():
+    channel_listings = sample_listings(10000, 1800, 1800)
+
+    listing, valid_from, valid_until = find_listing(channel_listings, 10000 + PLUS_ONE_OFFSET, PLUS_ONE_OFFSET)
+    assert listing.title == "Programme 0"
+    assert (listing.start, listing.end) == (10000 + PLUS_ONE_OFFSET, 11800 + PLUS_ONE_OFFSET)
+    assert (valid_from, valid_until) == (10000 + PLUS_ONE_OFFSET, 11800 + PLUS_ONE_OFFSET)
+
+    assert find_listing(channel_listings, 11800 + PLUS_ONE_OFFSET, PLUS_ONE_OFFSET)[0].title == "Programme 1"
+    # The +1 channel hasn't started the listings yet when the SD channel has
+    listing, valid_from, valid_until = find_listing(channel_listings, 10000 + PLUS_ONE_OFFSET - 1, PLUS_ONE_OFFSET)
+    assert listing is None
+    assert valid_until == 10000 + PLUS_ONE_OFFSET
+    assert find_listing(channel_listings, 13600 + PLUS_ONE_OFFSET, PLUS_ONE_OFFSET) == (
+        None, 13600 + PLUS_ONE_OFFSET, float('inf'))
+    # Listings are not changed by looking up the +1 channel
+    assert channel_listings["listings"][0].start == 10000
+
+
+def test_single_flight():
+    async def async_test():
+        client = FakeClient()
+        guide = Guide(GRAPH, client=client)
+        await guide.async_load_channels()
+        assert guide.channels[108].id == guide.channels[201].id == "station-1"
+
+        client.release.clear()
+        tasks = [asyncio.ensure_future(guide.async_get_listings(channel)) for channel in (101, 108, 201)]
+        await asyncio.sleep(0)
+        assert guide.diagnostics()["in_flight"] == 1
+        client.release.set()
+        entries = await asyncio.gather(*tasks)
+
+        assert client.downloads == ['channels', 'listings']
+        assert entries[0] is entries[1] is entries[2]
+        assert await guide.async_get_listings(108) is entries[0]
+        assert guide.hits == 1
+        assert guide.diagnostics()["in_flight"] == 0
+
+    asyncio.run(async_test())
+
+
+def test_eviction_by_programme_count():
+    async def async_test():
+        guide = Guide(GRAPH, client=FakeClient())
+        guide.max_programmes = 4
+        await guide.async_load_channels()
+        await guide.async_get_listings(101)
+        await guide.async_get_listings(102)
+        # Using station 1 again makes station 2 the least recently used
+        await guide.async_get_listings(101)
+        await guide.async_get_listings(103)
+
+        assert list(guide.listings) == ["station-1", "station-3"]
+        assert guide.evictions == 1
+        assert guide.diagnostics()["cached_programmes"] == 4
+
+    asyncio.run(async_test())
+
+
+def test_restart_reload_from_store(tmp_path):
+    store = GuideStore(str(tmp_path / 'guide.db'))
+
+    async def async_download():
+        guide = Guide(GRAPH, store=store, client=FakeClient())
+        await guide.async_load_channels()
+        return await guide.async_get_listings(101)
+
+    async def async_restart():
+        client = FakeClient(fail=True)
+        guide = Guide(GRAPH, store=store, client=client)
+        await guide.async_load_channels()
+        entry = await guide.async_get_listings(201)
+        return guide, client, entry
+
+    downloaded = asyncio.run(async_download())
+    guide, client, entry = asyncio.run(async_restart())
+    assert client.downloads == []
+    assert guide.channels[201].plus_one and guide.channels[201].url is None
+    assert [prog.title for prog in entry["listings"]] == [prog.title for prog in downloaded["listings"]]
+    assert list(entry["start_times"]) == list(downloaded["start_times"])
+    assert entry["next_refresh"] == downloaded["next_refresh"]
+
+
+def test_store_replaces_old_version(tmp_path):
+    path = str(tmp_path / 'guide.db')
+    with sqlite3.connect(path) as conn:
+        conn.executescript("CREATE TABLE channels (number INTEGER, data BLOB); PRAGMA user_version = 1;")
+    conn.close()
+
+    store = GuideStore(path)
+    assert store.load_stations() == ([], None)
+    with sqlite3.connect(path) as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == GUIDE_STORE_VERSION
+    conn.close()
+
+
+@pytest.mark.parametrize("contents", [b"not a database" * 100, b""])
+def test_store_unusable_file(tmp_path, contents):
+    path = tmp_path / 'guide.db'
+    path.write_bytes(contents)
+    store = GuideStore(str(path))
+    assert store.load_listings("station-1") is None
@@ -0,0 +1,172 @@
+"""Tests for the pooled HTTP client against a local aiohttp stub server"""
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from virgintivo import http_client
+from virgintivo.http_client import HttpClient
+
+ETAG = '"v1"'
+LAST_MODIFIED = 'Sat, 17 Oct 2026 10:00:00 GMT'
+CHANNELS = "Channel,Name\n101,BBC One\n102,BBC Two\n"
+LISTINGS = [{"title": "Programme {}".format(prog_no), "text": "café – {}".format(prog_no)}
+            for prog_no in range(50)]
+
+
+class StubServer:
+    """Serves a channel list with an ETag and Last-Modified, and a guide streamed in small pieces"""
+
+    def __init__(self):
+        self.requests = []
+        self.app = web.Application()
+        self.app.router.add_get('/channels.csv', self.handle_channels)
+        self.app.router.add_get('/listings', self.handle_listings)
+
+    async def handle_channels(self, request):
+        self.requests.append(dict(request.headers))
+        if request.headers.get('If-None-Match') == ETAG or \
+                request.headers.get('If-Modified-Since') == LAST_MODIFIED:
+            return web.Response(status=304)
+        return web.Response(text=CHANNELS, headers={'ETag': ETAG, 'Last-Modified': LAST_MODIFIED})
+
+    async def handle_listings(self, request):
+        self.requests.append(dict(request.headers))
+        body = json.dumps({"total": len(LISTINGS), "listings": LISTINGS}, ensure_ascii=False).encode()
+        response = web.StreamResponse(headers={'Content-Type': 'application/json; charset=utf-8'})
+        await response.prepare(request)
+        # Odd sized pieces so items, strings and multi-byte characters are split between chunks
+        for start in range(0, len(body), 37):
+            await response.write(body[start:start + 37])
+            await asyncio.sleep(0)
+        await response.write_eof()
+        return response
+
+
+def run(test, tmp_path):
+    """Run test(stub, new_client, url) against a stub server, new_client() makes a client saving to tmp_path"""
+    async def async_run():
+        stub = StubServer()
+        async with TestServer(stub.app) as server:
+            async with aiohttp.ClientSession() as session:
+                await test(stub, lambda: HttpClient(session, str(tmp_path)), lambda path: str(server.make_url(path)))
+
+    asyncio.run(async_run())
+
+
+def test_conditional_round_trip(tmp_path):
+    async def async_test(stub, new_client, url):
+        client = new_client()
+        assert await client.async_get(url('/channels.csv'), conditional=True) == CHANNELS
+        assert 'If-None-Match' not in stub.requests[0]
+        assert await client.async_get(url('/channels.csv'), conditional=True) == CHANNELS
+        assert stub.requests[1]['If-None-Match'] == ETAG
+        assert stub.requests[1]['If-Modified-Since'] == LAST_MODIFIED
+        assert (client.downloads, client.not_modified) == (1, 1)
+
+    run(async_test, tmp_path)
+
+
+def test_not_modified_from_saved_copy(tmp_path):
+    async def async_test(stub, new_client, url):
+        await new_client().async_get(url('/channels.csv'), conditional=True)
+        # A new client, as after a restart, only has the copy saved on disk
+        client = new_client()
+        assert await client.async_get(url('/channels.csv'), conditional=True) == CHANNELS
+        assert stub.requests[1]['If-None-Match'] == ETAG
+        assert (client.downloads, client.not_modified) == (0, 1)
+
+    run(async_test, tmp_path)
+
+
+def test_only_validators_in_memory(tmp_path):
+    async def async_test(stub, new_client, url):
+        client = new_client()
+        await client.async_get(url('/channels.csv'), conditional=True)
+        assert client._validators == {url('/channels.csv'): (ETAG, LAST_MODIFIED)}
+        # The unchanged document is read back from the saved copy
+        saved_file, = tmp_path.iterdir()
+        saved = json.loads(saved_file.read_text())
+        saved_file.write_text(json.dumps(dict(saved, body="Saved channels")))
+        assert await client.async_get(url('/channels.csv'), conditional=True) == "Saved channels"
+        assert (client.downloads, client.not_modified) == (1, 1)
+
+    run(async_test, tmp_path)
+
+
+def test_saved_copy_removed(tmp_path):
+    async def async_test(stub, new_client, url):
+        client = new_client()
+        await client.async_get(url('/channels.csv'), conditional=True)
+        saved_file, = tmp_path.iterdir()
+        saved_file.unlink()
+
+        # Not modified, but with nothing to read back the document is downloaded again
+        assert await client.async_get(url('/channels.csv'), conditional=True) == CHANNELS
+        assert stub.requests[1]['If-None-Match'] == ETAG
+        assert 'If-None-Match' not in stub.requests[2]
+        assert (client.downloads, client.not_modified) == (2, 0)
+        assert saved_file.exists()
+
+    run(async_test, tmp_path)
+
+
+def test_unconditional_get_not_saved(tmp_path):
+    async def async_test(stub, new_client, url):
+        client = new_client()
+        assert await client.async_get(url('/channels.csv')) == CHANNELS
+        assert await client.async_get(url('/channels.csv')) == CHANNELS
+        assert all('If-None-Match' not in headers for headers in stub.requests)
+        assert client.downloads == 2
+
+    run(async_test, tmp_path)
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.parametrize('damage', ['corrupt', 'other_url'])
+def test_damaged_saved_copy(tmp_path, damage):
+    async def async_test(stub, new_client, url):
+        await new_client().async_get(url('/channels.csv'), conditional=True)
+        saved_file, = tmp_path.iterdir()
+        if damage == 'corrupt':
+            saved_file.write_text('{"url": "trunc')
+        else:
+            saved = json.loads(saved_file.read_text())
+            saved.update(url='http://elsewhere/channels.csv', body="Someone else's channels")
+            saved_file.write_text(json.dumps(saved))
+
+        # The damaged copy is ignored and the document downloaded again
+        client = new_client()
+        assert await client.async_get(url('/channels.csv'), conditional=True) == CHANNELS
+        assert 'If-None-Match' not in stub.requests[1]
+        assert (client.downloads, client.not_modified) == (1, 0)
+        assert json.loads(saved_file.read_text())["body"] == CHANNELS
+
+    run(async_test, tmp_path)
+
+
+def test_streamed_items(tmp_path, monkeypatch):
+    monkeypatch.setattr(http_client, 'READ_CHUNK_SIZE', 5)
+
+    async def async_test(stub, new_client, url):
+        client = new_client()
+        items = [item async for item in client.async_iter_items(url('/listings'), 'listings')]
+        assert items == LISTINGS
+        assert client.downloads == 1
+
+    run(async_test, tmp_path)
+
+
+def test_streamed_items_conditional(tmp_path):
+    async def async_test(stub, new_client, url):
+        client = new_client()
+        for _ in range(2):
+            items = [item async for item in client.async_iter_items(url('/listings'), 'listings', conditional=True)]
+            assert items == LISTINGS
+        # Without an ETag or Last-Modified there is nothing to check against
+        assert (client.downloads, client.not_modified) == (2, 0)
+
+    run(async_test, tmp_path)
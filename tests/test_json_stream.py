@@ -0,0 +1,92 @@
+"""Tests for the incremental guide JSON parser"""
+import json
+import random
+
+import pytest
+
+from virgintivo import json_stream
+from virgintivo.json_stream import JsonArrayParser, iter_array_items
+
+DOCUMENT = json.dumps({
+    "entryCount": 3, "meta": {"updated": [1.5e3, -2, None, True, False]}, "note": "a \"quoted\" } ] \\ string",
+    "listings": [
+        {"title": "Café – News", "startTime": 1697500000000, "rating": 4.25, "tags": ["a", "b"]},
+        -12.5e-3, "plain", None, True, [], {},
+        {"nested": {"deep": [[1, 2], {"x": "}]"}]}, "escape": "\\u00e9\\n"},
+    ],
+    "after": "ignored",
+})
+
+
+def parse_in_chunks(text, sizes):
+    parser = JsonArrayParser('listings')
+    items = []
+    start = 0
+    for size in sizes:
+        items.extend(parser.feed(text[start:start + size]))
+        start += size
+    items.extend(parser.feed(text[start:]))
+    parser.close()
+    return items
+
+
+def test_random_chunks_match_json_loads():
+    expected = json.loads(DOCUMENT)["listings"]
+    rng = random.Random(0)
+    for _ in range(300):
+        sizes = [rng.randint(1, 12) for _ in range(len(DOCUMENT))]
+        assert parse_in_chunks(DOCUMENT, sizes) == expected
+    assert parse_in_chunks(DOCUMENT, [1] * len(DOCUMENT)) == expected
+    assert list(iter_array_items(DOCUMENT, 'listings', chunk_size=7)) == expected
+
+
+def test_large_item_not_decoded_per_chunk(monkeypatch):
+    item = {"description": "x" * 20000, "title": "Long"}
+    text = json.dumps({"listings": [item]})
+    parser = JsonArrayParser('listings')
+    calls = []
+    raw_decode = parser._decoder.raw_decode
+
+    def counting_raw_decode(*args):
+        calls.append(args[1])
+        return raw_decode(*args)
+
+    monkeypatch.setattr(parser._decoder, 'raw_decode', counting_raw_decode)
+    items = []
+    for start in range(0, len(text), 10):
+        items.extend(parser.feed(text[start:start + 10]))
+    parser.close()
+    assert items == [item]
+    # Tried when the item starts and again on each closing quote or brace, not for every chunk
+    assert len(calls) < 20
+
+
+@pytest.mark.parametrize('text', [
+    '{"listings": [{"a": 1 "b": 2}, ',
+    '{"listings": [{"a": 1.x}, ',
+    '{"listings": [1, 2 3, ',
+    '{"listings": [{"a": nope}, ',
+    '{"listings": ["ok"x, ',
+])
+def test_malformed_fails_early(text):
+    parser = JsonArrayParser('listings')
+    with pytest.raises(ValueError):
+        for char in text + ' ' * 10:
+            parser.feed(char)
+
+
+def test_truncated_document():
+    parser = JsonArrayParser('listings')
+    assert parser.feed('{"listings": [{"a": "unfinished \\u00') == []
+    with pytest.raises(ValueError):
+        parser.close()
+    assert json_stream.is_truncated('"ab\\u00', _decode_error('"ab\\u00'))
+    assert not json_stream.is_truncated('"ab\\u00zz"', _decode_error('"ab\\u00zz"'))
+
+
+def _decode_error(text):
+    try:
+        json.JSONDecoder().raw_decode(text)
+    except json.JSONDecodeError as e:
+        return e
+    raise AssertionError("decoded")
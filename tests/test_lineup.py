@@ -0,0 +1,149 @@
+"""Tests for starting up from the cached lineup"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+from virgintivo.channel_list import (Lineup, LineupCache, add_csv_channels, content_hash, pair_channels,
+                                     to_channel_listings)
+
+CHANNELS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'channels', 'channels.csv')
+SETTINGS_HASH = content_hash("default settings")
+
+
+def read_channel_list():
+    with open(CHANNELS_CSV, encoding='utf-8') as csv_file:
+        return csv_file.read()
+
+
+def build_channels(text):
+    """The channels as resolved by the component with the default settings, every channel shown"""
+    all_channels = {}
+    add_csv_channels(text, all_channels, set(), "E")
+    pair_channels(all_channels)
+    return {channel_id: {
+        'name': entry['name'],
+        'logo': entry['logo'],
+        'hd_channel': entry['hd_channel'] or None,
+        'plus_one': entry['plus_one'] or None,
+        'show': entry['show'] != 'false',
+        'target': entry['target'],
+        'source': entry['source'],
+    } for channel_id, entry in to_channel_listings(all_channels).items()}
+
+
+def start_cold(text):
+    """Setup's lineup work without a cache: parse and pair the channel list, then index it"""
+    lineup = Lineup(build_channels(text))
+    lineup.source_list
+    return lineup
+
+
+def start_warm(lineup_cache):
+    """Setup's lineup work from a warm cache: load the saved channels, then index them"""
+    lineup = Lineup(lineup_cache.load(SETTINGS_HASH))
+    lineup.source_list
+    return lineup
+
+
+def count_calls(func, *args):
+    """Python function calls made by func(*args), a measure of its work that doesn't depend on the machine"""
+    calls = 0
+
+    def profile(frame, event, arg):
+        nonlocal calls
+        if event == 'call':
+            calls += 1
+
+    sys.setprofile(profile)
+    try:
+        result = func(*args)
+    finally:
+        sys.setprofile(None)
+    return calls, result
+
+
+def test_warm_setup_does_less_work(tmp_path):
+    text = read_channel_list()
+    lineup_cache = LineupCache(str(tmp_path / 'lineup.json'))
+    cold_calls, cold_lineup = count_calls(start_cold, text)
+    lineup_cache.save(SETTINGS_HASH, content_hash(text), dict(cold_lineup.channels))
+
+    warm_calls, warm_lineup = count_calls(start_warm, lineup_cache)
+    assert dict(warm_lineup.channels) == dict(cold_lineup.channels)
+    assert warm_lineup.source_list == cold_lineup.source_list
+    assert warm_calls * 2 < cold_calls
+
+
+class StubHass:
+    """Runs executor jobs straight away"""
+
+    async def async_add_executor_job(self, func, *args):
+        return func(*args)
+
+
+class StubClient:
+    """Returns the channel list, or fails as if the download did"""
+
+    def __init__(self, text=None):
+        self.text = text
+        self.requests = 0
+
+    async def async_get(self, url, headers=None, conditional=False):
+        self.requests += 1
+        if self.text is None:
+            raise asyncio.TimeoutError()
+        return self.text
+
+
+def test_load_lineup_from_warm_cache(tmp_path, monkeypatch):
+    pytest.importorskip('homeassistant')
+    import voluptuous as vol
+    from virgintivo import media_player
+
+    text = read_channel_list()
+    config = {
+        media_player.CONF_CHANNEL_LIST: vol.Schema(media_player.CHANNEL_LIST_SCHEMA)({}),
+        media_player.CONF_DEFAULTISSHOW: True,
+        media_player.CONF_SHOW_PACKAGES: "UNSET",
+    }
+    lineup_cache = LineupCache(str(tmp_path / 'lineup.json'))
+    parses = []
+    parse_csv = media_player.get_channel_listings_csv
+
+    def counting_parse_csv(*args):
+        parses.append(args)
+        return parse_csv(*args)
+
+    monkeypatch.setattr(media_player, 'get_channel_listings_csv', counting_parse_csv)
+    cold_channels = asyncio.run(media_player.async_load_lineup(StubHass(), config, StubClient(text), lineup_cache))
+    assert cold_channels and len(parses) == 1
+
+    # An unchanged channel list, or one that can't be downloaded, is taken from the cache without parsing
+    for client in (StubClient(text), StubClient()):
+        channels = asyncio.run(media_player.async_load_lineup(StubHass(), config, client, lineup_cache))
+        assert channels == cold_channels
+        assert client.requests == 1
+    assert len(parses) == 1
+
+
+def test_cache_checks_source_and_settings(tmp_path):
+    text = read_channel_list()
+    channels = build_channels(text)
+    lineup_cache = LineupCache(str(tmp_path / 'lineup.json'))
+    assert lineup_cache.load(SETTINGS_HASH) is None
+    lineup_cache.save(SETTINGS_HASH, content_hash(text), channels)
+
+    assert lineup_cache.load(SETTINGS_HASH) == channels
+    assert lineup_cache.load(SETTINGS_HASH, content_hash(text)) == channels
+    assert lineup_cache.load(SETTINGS_HASH, content_hash(text + "999,New Channel,Mixit\n")) is None
+    assert lineup_cache.load(content_hash("other settings")) is None
+
+
+def test_corrupt_cache(tmp_path):
+    path = tmp_path / 'lineup.json'
+    path.write_text('{"version": 1, "settings": ')
+    assert LineupCache(str(path)).load(SETTINGS_HASH) is None
+    path.write_text('{"version": 1, "settings": "%s", "source": null, "channels": {"x": {}}}' % SETTINGS_HASH)
+    assert LineupCache(str(path)).load(SETTINGS_HASH) is None
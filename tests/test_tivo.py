@@ -0,0 +1,221 @@
+"""Tests for the Tivo response parser and connection, against the fake Tivo from resources/tivo_simulator.py"""
+import asyncio
+import socket
+
+from tivo_simulator import FakeTivo
+from virgintivo.tivo import (EVENT_FAILED, EVENT_STATUS, EVENT_UNKNOWN, MAX_LINE_LENGTH, TivoConnection, TivoParser,
+                             TivoSupervisor, latest_status)
+
+
+def test_split_line():
+    parser = TivoParser()
+    assert parser.feed(b'CH_STA') == []
+    assert parser.feed(b'TUS 0101 LO') == []
+    events = parser.feed(b'CAL\r')
+    assert [(event.kind, event.value) for event in events] == [(EVENT_STATUS, 101)]
+    assert events[0].line == 'CH_STATUS 0101 LOCAL'
+
+
+def test_coalesced_lines():
+    parser = TivoParser()
+    events = parser.feed(b'CH_STATUS 0101 LOCAL\rCH_FAILED NO_LIVE\rCH_STATUS 0102 LOCAL\rCH_STA')
+    assert [(event.kind, event.value) for event in events] == [
+        (EVENT_STATUS, 101), (EVENT_FAILED, 'NO_LIVE'), (EVENT_STATUS, 102)]
+    assert [event.value for event in parser.feed(b'TUS 0103 LOCAL\r')] == [103]
+
+
+def test_blank_lines():
+    parser = TivoParser()
+    assert parser.feed(b'\r\r  \r\n\r') == []
+    assert [event.value for event in parser.feed(b'\rCH_STATUS 0101 LOCAL\r\r')] == [101]
+
+
+def test_unknown_line():
+    events = TivoParser().feed(b'LIVETV_READY\r')
+    assert [(event.kind, event.value, event.line) for event in events] == [(EVENT_UNKNOWN, None, 'LIVETV_READY')]
+
+
+def test_runaway_line():
+    parser = TivoParser()
+    assert parser.feed(b'X' * (MAX_LINE_LENGTH + 1)) == []
+    # The rest of the discarded line is ignored as an unknown line, the next line is parsed as normal
+    events = parser.feed(b'XXX\rCH_STATUS 0101 LOCAL\r')
+    assert [event.kind for event in events] == [EVENT_UNKNOWN, EVENT_STATUS]
+    assert events[-1].value == 101
+
+
+def test_runaway_line_limit():
+    parser = TivoParser(max_line_length=16)
+    parser.feed(b'CH_STATUS 0101 LOCAL')
+    assert parser.feed(b'\r') == []
+
+
+def test_latest_status():
+    events = TivoParser().feed(b'CH_STATUS 0101 LOCAL\rCH_STATUS 0102 LOCAL\rCH_FAILED NO_LIVE\rIGNORED\r')
+    assert latest_status(events).value == 102
+    assert latest_status(TivoParser().feed(b'CH_FAILED NO_LIVE\r')) is None
+    assert latest_status([]) is None
+
+
+async def async_connect(tivo, **options):
+    """Connect to a fake Tivo, collecting the events it sends"""
+    conn = TivoConnection('127.0.0.1', tivo.port, 'Test', TivoSupervisor(workers=1), **options)
+    events = []
+    conn.on_events = events.extend
+    conn.start(asyncio.get_running_loop())
+    assert await conn.async_connect()
+    return conn, events
+
+
+async def async_wait_for(condition, timeout=2):
+    """Wait until condition() is true"""
+    loop = asyncio.get_running_loop()
+    end = loop.time() + timeout
+    while not condition():
+        assert loop.time() < end, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def test_connection_partial_responses():
+    async def async_test():
+        tivo = FakeTivo(channel=101, partial=True, seed=1)
+        await tivo.async_start()
+        conn, events = await async_connect(tivo)
+        try:
+            await async_wait_for(lambda: events)
+            assert [(event.kind, event.value) for event in events] == [(EVENT_STATUS, 101)]
+
+            for channel in (102, 1001, 7):
+                ack = await conn.async_send_and_wait(
+                    "".join("IRCODE NUM" + digit + "\r" for digit in str(channel)))
+                assert (ack.kind, ack.value) == (EVENT_STATUS, channel)
+            assert [event.value for event in events] == [101, 102, 1001, 7]
+            assert conn.ack_timeouts == 0
+            assert conn.rtt.count == 3
+        finally:
+            await conn.async_stop()
+            await tivo.async_stop()
+
+    asyncio.run(async_test())
+
+
+def test_connection_failure_ack():
+    async def async_test():
+        tivo = FakeTivo(channel=101, channels=[101, 102], partial=True, seed=2)
+        await tivo.async_start()
+        conn, events = await async_connect(tivo)
+        try:
+            await async_wait_for(lambda: events)
+            ack = await conn.async_send_and_wait("SETCH 999\r")
+            assert (ack.kind, ack.value) == (EVENT_FAILED, 'INVALID_CHANNEL')
+        finally:
+            await conn.async_stop()
+            await tivo.async_stop()
+
+    asyncio.run(async_test())
+
+
+def test_connection_reconnects():
+    async def async_test():
+        tivo = FakeTivo(channel=101, partial=True, seed=3)
+        await tivo.async_start()
+        conn, events = await async_connect(tivo)
+        try:
+            await async_wait_for(lambda: events)
+            await tivo.async_drop_connections()
+            await async_wait_for(lambda: not conn.connected)
+            # Sending reconnects straight away rather than waiting for the backoff,
+            # the status sent on connecting may arrive first
+            ack = await conn.async_send_and_wait("SETCH 102\r", match=lambda event: event.value == 102)
+            assert ack.value == 102
+            assert conn.reconnects == 1
+        finally:
+            await conn.async_stop()
+            await tivo.async_stop()
+
+    asyncio.run(async_test())
+
+
+def test_urgent_connect_while_connecting():
+    async def async_test():
+        tivo = FakeTivo(channel=101)
+        await tivo.async_start()
+        loop = asyncio.get_running_loop()
+        opened = []
+        create_connection = loop.create_connection
+
+        async def slow_create_connection(*args, **kwargs):
+            opened.append(args)
+            await asyncio.sleep(0.05)
+            return await create_connection(*args, **kwargs)
+
+        loop.create_connection = slow_create_connection
+        conn = TivoConnection('127.0.0.1', tivo.port, 'Test', TivoSupervisor(workers=2))
+        try:
+            conn.start(loop)
+            await asyncio.sleep(0.01)
+            # The first connect is still running, so sending must wait for it rather than open another
+            assert await conn.async_connect()
+            await asyncio.sleep(0.1)
+            assert len(opened) == 1
+            assert len(tivo._clients) == 1
+        finally:
+            await conn.async_stop()
+        await async_wait_for(lambda: not tivo._clients)
+        await tivo.async_stop()
+
+    asyncio.run(async_test())
+
+
+def test_connection_resync_not_reconnect():
+    async def async_test():
+        tivo = FakeTivo(channel=101)
+        await tivo.async_start()
+        conn, events = await async_connect(tivo, idle_timeout=0.05)
+        try:
+            await async_wait_for(lambda: conn.resyncs >= 2)
+            assert conn.reconnects == 0
+            assert conn.health['resyncs'] == conn.resyncs
+        finally:
+            await conn.async_stop()
+            await tivo.async_stop()
+
+    asyncio.run(async_test())
+
+
+def test_connection_keepalive():
+    async def async_test():
+        tivo = FakeTivo(channel=101)
+        await tivo.async_start()
+        conn, events = await async_connect(tivo)
+        try:
+            await async_wait_for(lambda: events)
+            sock = conn._transport.get_extra_info('socket')
+            assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+            assert conn.resyncs == 0
+        finally:
+            await conn.async_stop()
+            await tivo.async_stop()
+
+    asyncio.run(async_test())
+
+
+def test_connection_standby_and_wake():
+    async def async_test():
+        tivo = FakeTivo(channel=101)
+        await tivo.async_start()
+        conn, events = await async_connect(tivo)
+        try:
+            await async_wait_for(lambda: events)
+            # Going into standby takes a second STANDBY to confirm and isn't acknowledged
+            assert await conn.async_send("IRCODE STANDBY\rIRCODE STANDBY\r")
+            await async_wait_for(lambda: tivo.standby)
+            ack = await conn.async_send_and_wait("IRCODE STANDBY\r")
+            assert (ack.kind, ack.value) == (EVENT_STATUS, 101)
+            assert not tivo.standby
+            assert conn.ack_timeouts == 0
+        finally:
+            await conn.async_stop()
+            await tivo.async_stop()
+
+    asyncio.run(async_test())